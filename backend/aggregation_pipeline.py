@@ -1,75 +1,884 @@
-import firebase_admin
-from firebase_admin import credentials, firestore
 from datetime import datetime, timedelta, timezone
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import bisect
+import cProfile
+import functools
+import hashlib
+import itertools
+import json
+import math
 import logging
+import multiprocessing
 import os
 import re
-import pytz
+import threading
+import time
+from zoneinfo import ZoneInfo
+import numpy as np
+
+from complaint_classifier import ComplaintClassifier
+from duplicate_index import DEFAULT_WINDOW_HOURS, DuplicateIndex
+from metrics_storage import FirestoreStorage, create_storage
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Set timezone to IST (UTC+5:30)
-IST = pytz.timezone('Asia/Kolkata')
+IST = ZoneInfo('Asia/Kolkata')
+
+# Only the fields calculate_metrics reads; free-text requestDetails is fetched only to classify or deduplicate,
+# and the requesting authorId only to deduplicate
+REQUEST_FIELDS = ['createdAt', 'acceptedAt', 'closedAt', 'status', 'technicianId', 'technicianName']
+DETAILS_FIELD = 'requestDetails'
+AUTHOR_FIELD = 'authorId'
+
+# Documents fetched per cursor page when streaming requests
+REQUESTS_PAGE_SIZE = 500
+
+# bytes_read is extrapolated from the size of every Nth fetched request; sizing costs a to_dict() copy
+SIZE_SAMPLE_INTERVAL = 50
+
+# Metric engines: 'columnar' vectorizes with NumPy, 'python' is the per-document loop
+METRIC_ENGINES = ('columnar', 'python')
+
+# Latency percentiles reported alongside the averages
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# Relative accuracy of the latency sketches (1% of the true value)
+SKETCH_RELATIVE_ACCURACY = 0.01
+
+# Latency metrics that carry a sum, count and sketch in every metrics document
+LATENCY_METRICS = ('assign', 'resolution')
+
+# Materialized rollups: (granularity, collection, source collection merged into it)
+ROLLUP_LEVELS = (
+    ('hourly', 'service_metrics_hourly', 'service_metrics'),
+    ('daily', 'service_metrics_daily', 'service_metrics_hourly'),
+    ('weekly', 'service_metrics_weekly', 'service_metrics_daily'),
+)
+
+# Technicians kept in each rollup's precomputed leaderboard
+TOP_TECHNICIANS_LIMIT = 5
+
+# Metrics sink: documents per WriteBatch (Firestore caps a batch at 500), concurrent
+# commits, seconds before a partially filled batch is flushed, retries per commit
+SINK_BATCH_SIZE = 400
+SINK_MAX_IN_FLIGHT = 4
+SINK_FLUSH_INTERVAL = 2.0
+SINK_MAX_RETRIES = 3
+
+# Re-scan this far behind the watermark so server timestamps that commit out of order are not missed
+WATERMARK_OVERLAP = timedelta(minutes=1)
+
+# The real-time listener is re-attached at the eviction horizon once it has moved this far past where the
+# listener started, so the watched result set stays about one retention window wide
+WATCH_RESUBSCRIBE_AFTER = timedelta(days=1)
+
+# Stages timed by RunStats and the I/O counters reported next to them
+PIPELINE_STAGES = ('fetch', 'compute', 'classify', 'dedup', 'save', 'rollup')
+RUN_COUNTERS = ('documents_scanned', 'bytes_read', 'documents_written', 'write_retries', 'write_failures',
+                'texts_classified', 'classifier_cache_hits', 'duplicates_found', 'dedup_candidates')
+
+# Metric name prefix for the Prometheus text-format export
+PROMETHEUS_PREFIX = 'service_metrics_pipeline'
+
+# Shards handed to each worker process in sharded mode; more than one evens out uneven load
+SHARDS_PER_PROCESS = 4
+
+# Length of the primary service_metrics intervals unless AGGREGATION_INTERVAL_MINUTES overrides it
+DEFAULT_INTERVAL_MINUTES = 15
+
+# Zone of the '@local' series and of each metrics doc's local_hourly_distribution
+LOCAL_TIMEZONE = os.environ.get('LOCAL_TIMEZONE', 'Asia/Kolkata')
+LOCAL_ZONE = ZoneInfo(LOCAL_TIMEZONE)
+
+# Extra series bucketed from the same scan as the primary intervals, each written to
+# service_metrics_<name>: '<n>m' or '<n>h' UTC buckets, '@local' or '@<IANA zone>' for wall-clock buckets
+# Opt-in: every series multiplies a run's writes, e.g. '1m,5m,1h@local'
+DEFAULT_RESOLUTIONS = ''
+
+# Per-request arrays of `load_request_columns` output (the rest are label lists);
+# category only when classifying, duplicate only with a duplicate index
+REQUEST_COLUMNS = ('created', 'accepted', 'closed', 'status', 'technician', 'local_hour', 'category', 'duplicate')
 
-def get_interval_from_env(interval_minutes=15):
+def get_interval_minutes():
+    """Primary interval length from AGGREGATION_INTERVAL_MINUTES (default 15); must divide a day evenly"""
+    interval_minutes = int(os.environ.get('AGGREGATION_INTERVAL_MINUTES', DEFAULT_INTERVAL_MINUTES))
+    if interval_minutes <= 0 or (24 * 60) % interval_minutes:
+        raise ValueError(f"AGGREGATION_INTERVAL_MINUTES must divide a day evenly, got {interval_minutes}")
+    return interval_minutes
+
+def get_interval_start(timestamp, interval_minutes=DEFAULT_INTERVAL_MINUTES):
+    """Round a timestamp down to the start of its UTC interval"""
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    interval = timedelta(minutes=interval_minutes)
+    return epoch + ((timestamp - epoch) // interval) * interval
+
+def get_current_interval(interval_minutes=None):
+    """Return the UTC (start, end) of the interval containing now"""
+    interval_minutes = interval_minutes or get_interval_minutes()
+    start_time = get_interval_start(datetime.now(timezone.utc), interval_minutes)
+    return start_time, start_time + timedelta(minutes=interval_minutes)
+
+def get_interval_from_env(interval_minutes=None):
+    """Return the interval starting at INTERVAL_START (UTC ISO), or the current interval"""
+    interval_minutes = interval_minutes or get_interval_minutes()
     interval_start_str = os.environ.get('INTERVAL_START')
     if interval_start_str:
         # Parse ISO string in UTC
         start_time = datetime.strptime(interval_start_str, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
         end_time = start_time + timedelta(minutes=interval_minutes)
         return start_time, end_time
-    else:
-        # Fallback to old logic (local time, rounded down)
-        now = datetime.now(timezone.utc)
-        minutes_to_subtract = now.minute % interval_minutes
-        start_time = now.replace(minute=now.minute - minutes_to_subtract, second=0, microsecond=0)
-        end_time = start_time + timedelta(minutes=interval_minutes)
-        return start_time, end_time
+    return get_current_interval(interval_minutes)
+
+def parse_resolutions(spec):
+    """Parse e.g. '1m,5m,1h,1h@local' into (series name, minutes, time zone name) tuples.
+
+    UTC series are named by their size ('5m'); zoned ones get the zone
+    appended ('1h_local', '1h_america_new_york').
+    """
+    resolutions = []
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        size, _, zone = part.partition('@')
+        match = re.fullmatch(r'(\d+)([mh])', size)
+        minutes = int(match.group(1)) * (60 if match.group(2) == 'h' else 1) if match else 0
+        if minutes <= 0 or (24 * 60) % minutes:
+            raise ValueError(f"Resolution '{part}' must be <n>m or <n>h dividing a day evenly")
+        tz_name = LOCAL_TIMEZONE if zone == 'local' else zone or 'UTC'
+        try:
+            ZoneInfo(tz_name)
+        except Exception:
+            raise ValueError(f"Unknown time zone '{zone}' in resolution '{part}'")
+        name = size if zone in ('', 'UTC') else f"{size}_{re.sub(r'[^a-z0-9]+', '_', zone.lower())}"
+        resolutions.append((name, minutes, tz_name))
+    return tuple(resolutions)
+
+def get_resolutions_from_env():
+    return parse_resolutions(os.environ.get('AGGREGATION_RESOLUTIONS', DEFAULT_RESOLUTIONS))
+
+def get_classify_from_env():
+    return os.environ.get('CLASSIFY_COMPLAINTS', '').lower() in ('1', 'true', 'yes')
+
+def get_duplicate_index_from_env():
+    """DuplicateIndex at DUPLICATE_INDEX (a local directory) with a DUPLICATE_WINDOW_HOURS window, or None.
+
+    DUPLICATE_AUTHOR_SCOPED=false matches repeats across authors.
+    """
+    root = os.environ.get('DUPLICATE_INDEX')
+    if not root:
+        return None
+    return DuplicateIndex(root, window_hours=float(os.environ.get('DUPLICATE_WINDOW_HOURS', DEFAULT_WINDOW_HOURS)),
+                          author_scoped=os.environ.get('DUPLICATE_AUTHOR_SCOPED', 'true').lower() in ('1', 'true', 'yes'))
+
+def series_collection(name):
+    """Collection holding the buckets of one extra resolution"""
+    return f"service_metrics_{name}"
+
+@functools.lru_cache(maxsize=1024)
+def _local_day_boundaries(minutes, tz_name, day):
+    """Epoch seconds of every wall-clock bucket start on one local calendar day"""
+    midnight = datetime(day.year, day.month, day.day, tzinfo=ZoneInfo(tz_name))
+    return np.array([(midnight + timedelta(minutes=offset)).timestamp() for offset in range(0, 24 * 60, minutes)],
+                    dtype=np.int64)
+
+def bucket_boundaries(minutes, tz_name, start_time, end_time):
+    """Sorted int64 epoch seconds of the bucket boundaries spanning [start_time, end_time].
+
+    The first boundary is at or before start_time and the last at or after
+    end_time. Zoned buckets follow the wall clock, so around DST changes a
+    bucket can be shorter or longer. Computing the boundaries once lets a
+    whole scan be bucketed with np.searchsorted instead of per-request
+    datetime arithmetic.
+    """
+    step = minutes * 60
+    start, end = math.floor(start_time.timestamp()), math.ceil(end_time.timestamp())
+    if tz_name == 'UTC':
+        return np.arange(start - start % step, end + (-end) % step + 1, step, dtype=np.int64)
+    zone = ZoneInfo(tz_name)
+    first_day = datetime.fromtimestamp(start, zone).date()
+    days = (datetime.fromtimestamp(end, zone).date() - first_day).days + 2
+    # Wall times skipped by a DST change resolve onto the next boundary, hence np.unique
+    boundaries = np.unique(np.concatenate([_local_day_boundaries(minutes, tz_name, first_day + timedelta(days=n))
+                                           for n in range(days)]))
+    first = np.searchsorted(boundaries, start, side='right') - 1
+    last = np.searchsorted(boundaries, end, side='left')
+    return boundaries[first:last + 1]
+
+def local_hours(created, tz_name=LOCAL_TIMEZONE):
+    """Local hour of day (-1 where NaN) of epoch-second timestamps, looked up from precomputed hour boundaries"""
+    hours = np.full(created.size, -1, dtype=np.int8)
+    valid = ~np.isnan(created)
+    if valid.any():
+        values = created[valid]
+        boundaries = bucket_boundaries(60, tz_name, datetime.fromtimestamp(values.min(), timezone.utc),
+                                       datetime.fromtimestamp(values.max(), timezone.utc))
+        zone = ZoneInfo(tz_name)
+        boundary_hours = np.array([datetime.fromtimestamp(boundary, zone).hour for boundary in boundaries.tolist()],
+                                  dtype=np.int8)
+        hours[valid] = boundary_hours[np.searchsorted(boundaries, values, side='right') - 1]
+    return hours
+
+class LatencySketch:
+    """Mergeable log-bucketed histogram for approximate latency quantiles.
+
+    Values are counted in buckets whose width grows geometrically, so any
+    quantile is reported within SKETCH_RELATIVE_ACCURACY of the true value.
+    Two sketches merge exactly by adding bucket counts, which lets interval
+    documents be rolled up without rescanning requests.
+    """
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.zero_count = 0
+        self.bins = defaultdict(int)
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.bins.values())
+
+    def add(self, value, count=1):
+        """Add a single latency value (seconds)"""
+        if value <= 0:
+            self.zero_count += count
+        else:
+            self.bins[math.ceil(math.log(value) / self.log_gamma)] += count
+
+    def add_array(self, values):
+        """Add a NumPy array of latency values (seconds) in one vectorized pass"""
+        positive = values[values > 0]
+        self.zero_count += int(values.size - positive.size)
+        if positive.size:
+            indexes, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64), return_counts=True)
+            for index, count in zip(indexes.tolist(), counts.tolist()):
+                self.bins[index] += count
+
+    @classmethod
+    def from_groups(cls, values, groups, group_count):
+        """One sketch per group code in [0, group_count), each holding its values, built in one vectorized pass"""
+        sketches = [cls() for _ in range(group_count)]
+        if not values.size:
+            return sketches
+        positive = values > 0
+        for group, count in enumerate(np.bincount(groups[~positive], minlength=group_count).tolist()):
+            sketches[group].zero_count = count
+        if positive.any():
+            indexes = np.ceil(np.log(values[positive]) / sketches[0].log_gamma).astype(np.int64)
+            lowest = int(indexes.min())
+            width = int(indexes.max()) - lowest + 1
+            keys, counts = np.unique(groups[positive].astype(np.int64) * width + (indexes - lowest), return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                sketches[key // width].bins[key % width + lowest] += count
+        return sketches
+
+    def merge(self, other):
+        """Add another sketch's counts into this one"""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge latency sketches with different relative accuracy")
+        self.zero_count += other.zero_count
+        for index, count in other.bins.items():
+            self.bins[index] += count
+        return self
+
+    def quantile(self, q):
+        """Approximate the q-th quantile (0 <= q <= 1); 0 when the sketch is empty"""
+        total = self.count
+        if not total:
+            return 0
+        rank = q * (total - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0
+        for index in sorted(self.bins):
+            if self.bins[index] <= 0:
+                continue
+            seen += self.bins[index]
+            if rank < seen:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(index for index, count in self.bins.items() if count > 0) / (self.gamma + 1)
+
+    def to_dict(self):
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'zero_count': self.zero_count,
+            'bins': {str(index): count for index, count in self.bins.items() if count}
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data.get('relative_accuracy', SKETCH_RELATIVE_ACCURACY))
+        sketch.zero_count = data.get('zero_count', 0)
+        for index, count in (data.get('bins') or {}).items():
+            sketch.bins[int(index)] += count
+        return sketch
+
+def category_performance_entry(total_requests, total_resolution_time, sketch, percentiles=None):
+    """One category_performance entry; p50/p90/p99 come from the resolution sketch unless given exactly"""
+    resolved = sketch.count
+    if percentiles is None:
+        percentiles = [sketch.quantile(percentile / 100) for percentile in LATENCY_PERCENTILES]
+    entry = {
+        'total_requests': total_requests,
+        'resolved_requests': resolved,
+        'total_resolution_time': total_resolution_time if resolved else 0,
+        'avg_resolution_time': total_resolution_time / resolved if resolved else 0
+    }
+    for percentile, value in zip(LATENCY_PERCENTILES, percentiles):
+        entry[f'p{percentile}_resolution_time'] = float(value)
+    entry['resolution_time_sketch'] = sketch.to_dict()
+    return entry
+
+def get_status_transitions(accepted, closed):
+    """Status transitions a request has gone through, derived from its timestamps"""
+    transitions = []
+    if accepted:
+        transitions.append('pending_to_active')
+    if closed:
+        transitions.append('active_to_closed' if accepted else 'pending_to_closed')
+    return transitions
+
+class MetricsAccumulator:
+    """Signed running totals behind the python engine and the real-time mode.
+
+    Adding a request with sign=-1 retracts an earlier add of the same data,
+    so a document change can be applied as remove-old/add-new deltas.
+    """
 
-class ServiceMetricsAggregator:
     def __init__(self):
-        """Initialize Firebase Admin and Firestore client"""
+        self.total_requests = 0
+        self.requests_by_status = defaultdict(int)
+        self.requests_by_technician = defaultdict(int)
+        self.hourly_distribution = defaultdict(int)
+        self.local_hourly_distribution = defaultdict(int)
+        self.status_transitions = defaultdict(int)
+        self.latency_totals = {name: 0 for name in LATENCY_METRICS}
+        self.latency_counts = {name: 0 for name in LATENCY_METRICS}
+        self.latency_sketches = {name: LatencySketch() for name in LATENCY_METRICS}
+        self.technician_performance = defaultdict(lambda: {
+            'total_requests': 0,
+            'completed_requests': 0,
+            'total_resolution_time': 0,
+            'resolved_requests': 0,
+            'resolution_time_sketch': LatencySketch()
+        })
+        # Complaint categories are only reported once a request was added with one
+        self.categorized = False
+        self.requests_by_category = defaultdict(int)
+        self.category_performance = defaultdict(lambda: {
+            'total_requests': 0,
+            'total_resolution_time': 0,
+            'resolution_time_sketch': LatencySketch()
+        })
+        # Deduplicated counts are only reported once a request was added with a duplicate flag
+        self.deduplicated = False
+        self.duplicate_requests = 0
+        self.unique_requests_by_technician = defaultdict(int)
+
+    def add(self, data, sign=1, category=None, duplicate=None):
+        """Apply one request document (as a dict) with weight sign (+1 or -1).
+
+        Optionally in a complaint `category`, and flagged by `duplicate` as a
+        near-duplicate (True) or not (False) of an earlier request.
+        """
+        self.total_requests += sign
+
+        created = data.get('createdAt')
+        accepted = data.get('acceptedAt')
+        closed = data.get('closedAt')
+
+        status = data.get('status', 'unknown')
+        technician_id = data.get('technicianId')
+        technician_name = data.get('technicianName', 'Unknown')
+
+        # Status distribution
+        self.requests_by_status[status] += sign
+        for transition in get_status_transitions(accepted, closed):
+            self.status_transitions[transition] += sign
+
+        # Technician distribution
+        if technician_id:
+            self.requests_by_technician[technician_name] += sign
+
+        # Hourly distribution, by UTC hour and by LOCAL_TIMEZONE hour
+        if created:
+            self.hourly_distribution[created.astimezone(timezone.utc).hour] += sign
+            self.local_hourly_distribution[created.astimezone(LOCAL_ZONE).hour] += sign
+
+        # Time metrics are running totals so memory stays flat
+        latencies = {
+            'assign': (accepted - created).total_seconds() if created and accepted else None,
+            'resolution': (closed - created).total_seconds() if created and closed else None
+        }
+        for name, value in latencies.items():
+            if value is not None:
+                self.latency_totals[name] += sign * value
+                self.latency_counts[name] += sign
+                self.latency_sketches[name].add(value, sign)
+
+        # Technician performance metrics
+        if technician_id and technician_name:
+            tech_metrics = self.technician_performance[technician_name]
+            tech_metrics['total_requests'] += sign
+            if status == 'closed':
+                tech_metrics['completed_requests'] += sign
+            if latencies['resolution'] is not None:
+                tech_metrics['total_resolution_time'] += sign * latencies['resolution']
+                tech_metrics['resolved_requests'] += sign
+                tech_metrics['resolution_time_sketch'].add(latencies['resolution'], sign)
+
+        # Complaint category distribution and resolution latency
+        if category is not None:
+            self.categorized = True
+            self.requests_by_category[category] += sign
+            category_metrics = self.category_performance[category]
+            category_metrics['total_requests'] += sign
+            if latencies['resolution'] is not None:
+                category_metrics['total_resolution_time'] += sign * latencies['resolution']
+                category_metrics['resolution_time_sketch'].add(latencies['resolution'], sign)
+
+        # Deduplicated totals and technician workload
+        if duplicate is not None:
+            self.deduplicated = True
+            if duplicate:
+                self.duplicate_requests += sign
+            elif technician_id:
+                self.unique_requests_by_technician[technician_name] += sign
+
+    def to_metrics(self):
+        """Finalize into the metrics document schema, dropping entries that netted out to zero"""
+        def nonzero(counts):
+            return {key: count for key, count in counts.items() if count}
+
+        metrics = {
+            'total_requests': self.total_requests,
+            'requests_by_status': nonzero(self.requests_by_status),
+            'requests_by_technician': nonzero(self.requests_by_technician),
+            'requests_by_hour': {},
+            'hourly_distribution': nonzero(self.hourly_distribution),
+            'local_hourly_distribution': nonzero(self.local_hourly_distribution),
+            'status_transitions': nonzero(self.status_transitions)
+        }
+        for name in LATENCY_METRICS:
+            count = self.latency_counts[name]
+            metrics[f'total_{name}_time'] = self.latency_totals[name] if count else 0
+            metrics[f'{name}_count'] = count
+            metrics[f'avg_{name}_time'] = self.latency_totals[name] / count if count else 0
+            sketch = self.latency_sketches[name]
+            for percentile in LATENCY_PERCENTILES:
+                metrics[f'p{percentile}_{name}_time'] = sketch.quantile(percentile / 100)
+            metrics[f'{name}_time_sketch'] = sketch.to_dict()
+
+        technician_performance = {}
+        for tech_name, tech_data in self.technician_performance.items():
+            if not tech_data['total_requests']:
+                continue
+            completed = tech_data['completed_requests']
+            technician_performance[tech_name] = {
+                'total_requests': tech_data['total_requests'],
+                'completed_requests': completed,
+                'avg_resolution_time': tech_data['total_resolution_time'] / completed if completed > 0 else 0,
+                'total_resolution_time': tech_data['total_resolution_time'] if tech_data['resolved_requests'] else 0,
+                'resolved_requests': tech_data['resolved_requests'],
+                'resolution_time_sketch': tech_data['resolution_time_sketch'].to_dict()
+            }
+        metrics['technician_performance'] = technician_performance
+
+        if self.categorized:
+            metrics['requests_by_category'] = nonzero(self.requests_by_category)
+            metrics['category_performance'] = {
+                category: category_performance_entry(category_data['total_requests'],
+                                                     category_data['total_resolution_time'],
+                                                     category_data['resolution_time_sketch'])
+                for category, category_data in self.category_performance.items() if category_data['total_requests']
+            }
+        if self.deduplicated:
+            metrics['duplicate_requests'] = self.duplicate_requests
+            metrics['unique_requests'] = self.total_requests - self.duplicate_requests
+            metrics['unique_requests_by_technician'] = nonzero(self.unique_requests_by_technician)
+        return metrics
+
+def _value_size(value):
+    kind = type(value)
+    if kind is str:
+        return len(value) + 1  # character count; exact for the ASCII fields the pipeline reads
+    if value is None or kind is bool:
+        return 1
+    if kind is dict:
+        return sum(len(key) + 1 + _value_size(item) for key, item in value.items())
+    if kind is list or kind is tuple:
+        return sum(_value_size(item) for item in value)
+    return 8  # numbers and timestamps
+
+def estimate_document_size(doc_id, data, collection='requests'):
+    """Approximate a document's size in bytes using Firestore's storage size rules"""
+    size = len(collection) + len(str(doc_id)) + 50  # document name plus fixed per-document overhead
+    for key, value in data.items():
+        size += len(key) + 1 + _value_size(value)
+    return size
+
+class RunStats:
+    """Wall and CPU time per pipeline stage plus I/O counters, safe to share between worker threads.
+
+    Stage time is exclusive: entering a stage pauses the stage already open
+    on the same thread, so requests streamed lazily into calculate_metrics
+    count as fetch rather than compute. CPU time is per-thread. Each thread
+    accumulates into its own totals so the per-document fetch timing takes
+    no lock; `stages` sums them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread_totals = []  # {stage: [wall, cpu, calls]} per thread that timed a stage
+        self.counters = dict.fromkeys(RUN_COUNTERS, 0)
+        self.backfill_lag_seconds = None
+
+    def _thread_state(self):
+        state = getattr(self.local, 'state', None)
+        if state is None:
+            totals = {stage: [0.0, 0.0, 0] for stage in PIPELINE_STAGES}
+            with self.lock:
+                self.thread_totals.append(totals)
+            state = self.local.state = ([], totals)
+        return state
+
+    @property
+    def stages(self):
+        with self.lock:
+            thread_totals = list(self.thread_totals)
+        return {
+            stage: {
+                'wall_seconds': sum(totals[stage][0] for totals in thread_totals),
+                'cpu_seconds': sum(totals[stage][1] for totals in thread_totals),
+                'calls': sum(totals[stage][2] for totals in thread_totals)
+            }
+            for stage in PIPELINE_STAGES
+        }
+
+    def enter(self, stage):
+        stack, totals = self._thread_state()
+        wall, cpu = time.perf_counter(), time.thread_time()
+        if stack:
+            outer = stack[-1]
+            outer_totals = totals[outer[0]]
+            outer_totals[0] += wall - outer[1]
+            outer_totals[1] += cpu - outer[2]
+        stack.append([stage, wall, cpu])
+
+    def exit(self, call=True):
+        stack, totals = self._thread_state()
+        wall, cpu = time.perf_counter(), time.thread_time()
+        stage, started_wall, started_cpu = stack.pop()
+        stage_totals = totals[stage]
+        stage_totals[0] += wall - started_wall
+        stage_totals[1] += cpu - started_cpu
+        stage_totals[2] += call
+        if stack:
+            stack[-1][1] = wall
+            stack[-1][2] = cpu
+
+    @contextmanager
+    def stage(self, stage):
+        self.enter(stage)
         try:
-            # Initialize Firebase Admin (use existing service account)
-            if not firebase_admin._apps:
-                cred = credentials.Certificate("serviceAccountKey.json")
-                firebase_admin.initialize_app(cred)
-            
-            self.db = firestore.client()
-            logger.info("Firebase Admin initialized successfully")
-        except Exception as e:
-            logger.error(f"Failed to initialize Firebase Admin: {e}")
-            raise
+            yield
+        finally:
+            self.exit()
 
-    def get_date_range(self, interval_minutes=15):
-        """Get the date range for the current aggregation interval"""
-        now = datetime.now(IST)
-        
-        # Round down to the nearest interval
-        minutes_to_subtract = now.minute % interval_minutes
-        start_time = now.replace(minute=now.minute - minutes_to_subtract, second=0, microsecond=0)
-        end_time = start_time + timedelta(minutes=interval_minutes)
-        
-        return start_time, end_time
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def record_reads(self, documents, size):
+        with self.lock:
+            self.counters['documents_scanned'] += documents
+            self.counters['bytes_read'] += size
+
+    def absorb(self, stats):
+        """Add the `to_dict()` stats of work done elsewhere, e.g. in a worker process"""
+        totals = {stage: [values['wall_seconds'], values['cpu_seconds'], values['calls']]
+                  for stage, values in stats['stages'].items()}
+        with self.lock:
+            self.thread_totals.append(totals)
+            for counter in RUN_COUNTERS:
+                self.counters[counter] += stats[counter]
+
+    def snapshot(self):
+        """Detached copy of the current totals"""
+        copy = RunStats()
+        copy.thread_totals = [{stage: [totals['wall_seconds'], totals['cpu_seconds'], totals['calls']]
+                               for stage, totals in self.stages.items()}]
+        with self.lock:
+            copy.counters = dict(self.counters)
+        copy.backfill_lag_seconds = self.backfill_lag_seconds
+        return copy
 
-    def fetch_requests_data(self, start_time, end_time):
-        """Fetch requests data for the given time range"""
+    def since(self, earlier):
+        """Stats accumulated after the `earlier` snapshot was taken"""
+        delta = self.snapshot()
+        for stage, totals in delta.thread_totals[0].items():
+            for index, value in enumerate(earlier.thread_totals[0][stage]):
+                totals[index] -= value
+        for counter in delta.counters:
+            delta.counters[counter] -= earlier.counters[counter]
+        return delta
+
+    def to_dict(self):
+        return {
+            'stages': {stage: {key: round(value, 6) for key, value in totals.items()}
+                       for stage, totals in self.stages.items()},
+            **self.counters,
+            'backfill_lag_seconds': self.backfill_lag_seconds
+        }
+
+    def to_prometheus(self, prefix=PROMETHEUS_PREFIX):
+        """Render the stats in the Prometheus text exposition format"""
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            for labels, value in samples:
+                lines.append(f"{prefix}_{name}{labels} {value}")
+
+        for key, help_text in (('wall_seconds', 'Wall time spent in each pipeline stage'),
+                               ('cpu_seconds', 'CPU time spent in each pipeline stage'),
+                               ('calls', 'Calls into each pipeline stage')):
+            metric(f"stage_{key}", help_text,
+                   [(f'{{stage="{stage}"}}', totals[key]) for stage, totals in self.stages.items()])
+        for counter, value in self.counters.items():
+            metric(counter, f"{counter.replace('_', ' ').capitalize()} during the run", [('', value)])
+        if self.backfill_lag_seconds is not None:
+            metric('backfill_lag_seconds', 'Seconds between the end of the newest aggregated interval and now',
+                   [('', self.backfill_lag_seconds)])
+        return '\n'.join(lines) + '\n'
+
+def write_stats_file(stats, path):
+    """Atomically write stats as Prometheus text (for a `.prom` path, e.g. node_exporter's textfile collector) or JSON"""
+    contents = stats.to_prometheus() if path.endswith('.prom') else json.dumps(stats.to_dict(), indent=2) + '\n'
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(contents)
+    os.replace(temp_path, path)
+
+class RunResults(list):
+    """Per-interval results of a backfill, with the run's RunStats on `stats`"""
+
+    def __init__(self, results=(), stats=None):
+        super().__init__(results)
+        self.stats = stats
+
+class MetricsWriteError(Exception):
+    """Raised when buffered metrics documents could not be committed"""
+
+    def __init__(self, failed_documents):
+        self.failed_documents = set(failed_documents)
+        super().__init__(f"{len(self.failed_documents)} metrics documents failed to write")
+
+class MetricsSink:
+    """Buffers metrics and rollup documents and commits them to storage in batches.
+
+    Buffered documents are committed as one batch once `batch_size` are
+    queued or `flush_interval` seconds after the first one was buffered.
+    At most `max_in_flight` commits run concurrently; further writes block
+    until one finishes (backpressure). Failed commits are retried with
+    exponential backoff, and `drain` reports the documents that still failed.
+    """
+
+    def __init__(self, storage, batch_size=SINK_BATCH_SIZE, max_in_flight=SINK_MAX_IN_FLIGHT,
+                 flush_interval=SINK_FLUSH_INTERVAL, max_retries=SINK_MAX_RETRIES, run_stats=None):
+        self.storage = storage
+        self.run_stats = run_stats or RunStats()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='metrics-sink')
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.buffer = []
+        self.timer = None
+        self.flushing = 0  # flushes that took documents out of the buffer but have not submitted them all yet
+        self.pending = set()
+        self.failed = set()
+        self.stats = {'flushes': 0, 'documents': 0, 'retries': 0, 'failed_documents': 0, 'commit_seconds': 0.0}
+
+    def write(self, collection, doc_id, data):
+        """Queue a document set; flushes when the batch is full"""
+        with self.lock:
+            self.buffer.append((collection, doc_id, data))
+            full = len(self.buffer) >= self.batch_size
+            if not full and self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Submit everything buffered as one or more batch commits"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            documents, self.buffer = self.buffer, []
+            if not documents:
+                return
+            self.flushing += 1
         try:
-            requests_ref = self.db.collection('requests')
-            
-            # Query for requests created in the time range
-            requests = requests_ref \
-                .where('createdAt', '>=', start_time) \
-                .where('createdAt', '<', end_time) \
-                .stream()
-            
-            return list(requests)
+            for offset in range(0, len(documents), self.batch_size):
+                self.slots.acquire()
+                future = self.executor.submit(self._commit, documents[offset:offset + self.batch_size])
+                with self.lock:
+                    self.pending.add(future)
+                future.add_done_callback(self._release)
+        finally:
+            with self.lock:
+                self.flushing -= 1
+                self.idle.notify_all()
+
+    def _release(self, future):
+        with self.lock:
+            self.pending.discard(future)
+        self.slots.release()
+
+    def _commit(self, documents):
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.storage.write_documents(documents)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Giving up on batch of {len(documents)} metrics documents: {e}")
+                    with self.lock:
+                        self.failed.update((collection, doc_id) for collection, doc_id, _ in documents)
+                        self.stats['failed_documents'] += len(documents)
+                    self.run_stats.count('write_failures', len(documents))
+                    return
+                with self.lock:
+                    self.stats['retries'] += 1
+                self.run_stats.count('write_retries')
+                logger.warning(f"Batch commit failed (attempt {attempt + 1}), retrying: {e}")
+                time.sleep(0.5 * 2 ** attempt)
+
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.stats['flushes'] += 1
+            self.stats['documents'] += len(documents)
+            self.stats['commit_seconds'] += elapsed
+        self.run_stats.count('documents_written', len(documents))
+        logger.info(f"Committed {len(documents)} metrics documents in {elapsed:.3f}s "
+                    f"({len(documents) / elapsed if elapsed else 0:.0f} docs/s)")
+
+    def drain(self):
+        """Flush and wait for all commits; return the (collection, doc_id) pairs that failed since the last drain"""
+        self.flush()
+        with self.lock:
+            # A concurrent (e.g. timer) flush may still hold documents waiting for a commit slot
+            self.idle.wait_for(lambda: not self.flushing)
+            pending = list(self.pending)
+        wait(pending)
+        with self.lock:
+            failed, self.failed = self.failed, set()
+        return failed
+
+class ServiceMetricsAggregator:
+    def __init__(self, engine='columnar', db=None, storage=None, profile_compute=False, processes=1,
+                 resolutions=None, archive=None, classify=None, duplicate_index=None):
+        """Set up the storage backend: `storage` if given, Firestore on the `db` client if given,
+        otherwise the backend named by METRICS_STORAGE (Firestore by default).
+
+        With `profile_compute`, calculate_metrics runs under cProfile (see dump_profile).
+        With `processes` > 1, backfill scans and aggregate_window are sharded
+        across that many worker processes when the storage can be reopened
+        from another process (see MetricsStorage.spec).
+        `resolutions` are the extra series written by backfill scans
+        (parse_resolutions tuples, default AGGREGATION_RESOLUTIONS); they need
+        the columnar engine. With an `archive` (request_archive.RequestArchive),
+        backfill scans and aggregate_window read request columns from it
+        instead of querying requests in storage.
+        With `classify` (default CLASSIFY_COMPLAINTS), requestDetails is fetched
+        too and each request is assigned a complaint category, adding
+        requests_by_category and category_performance to the metrics.
+        With a `duplicate_index` (duplicate_index.DuplicateIndex, default
+        DUPLICATE_INDEX; False for none), requests repeating the
+        requestDetails of an earlier request by the same authorId are
+        flagged and the metrics add deduplicated counts.
+        """
+        if engine not in METRIC_ENGINES:
+            raise ValueError(f"Unknown metrics engine '{engine}', expected one of {METRIC_ENGINES}")
+        if archive is not None and engine != 'columnar':
+            raise ValueError("Reading from a request archive needs the columnar engine")
+        self.engine = engine
+        self.archive = archive
+        self.processes = processes
+        self.resolutions = get_resolutions_from_env() if resolutions is None else tuple(resolutions)
+        if self.resolutions and engine != 'columnar':
+            logger.info(f"The {engine} engine only writes the primary series; skipping extra resolutions")
+            self.resolutions = ()
+        classify = get_classify_from_env() if classify is None else classify
+        if classify and archive is not None:
+            logger.info("The request archive has no requestDetails; skipping complaint classification")
+            classify = False
+        # Shared by every interval so its text-hash cache carries across a whole backfill
+        self.classifier = ComplaintClassifier() if classify else None
+        if duplicate_index is None and archive is None:
+            duplicate_index = get_duplicate_index_from_env()
+        if duplicate_index and archive is not None:
+            logger.info("The request archive has no requestDetails; skipping duplicate detection")
+            duplicate_index = None
+        self.duplicate_index = duplicate_index or None
+        self.request_fields = REQUEST_FIELDS + [DETAILS_FIELD] if classify else REQUEST_FIELDS
+        if self.duplicate_index is not None:
+            self.request_fields = REQUEST_FIELDS + [DETAILS_FIELD, AUTHOR_FIELD]
+        # Interval start -> document ID saved since the rollups were last refreshed
+        self.dirty_intervals = {}
+        if storage is None:
+            storage = FirestoreStorage(db) if db is not None else create_storage()
+        self.storage = storage
+        # Cumulative stage timings and I/O counters; runs report the delta since they started
+        self.stats = RunStats()
+        self.sink = MetricsSink(self.storage, run_stats=self.stats)
+        self.profiler = cProfile.Profile() if profile_compute else None
+        # cProfile can only be active on one thread at a time; concurrent intervals skip profiling
+        self.profiler_lock = threading.Lock()
+
+    def get_date_range(self, interval_minutes=None):
+        """Get the UTC date range for the current aggregation interval"""
+        return get_current_interval(interval_minutes)
+
+    def fetch_requests_data(self, start_time, end_time, page_size=REQUESTS_PAGE_SIZE):
+        """Stream requests created in the given time range, ordered by createdAt.
+
+        Only REQUEST_FIELDS (plus requestDetails when classifying) are
+        requested and results are paged by the storage backend, so at most
+        one page is held in memory at a time. The bytes read are estimated
+        from every SIZE_SAMPLE_INTERVAL-th request.
+        """
+        scanned, sampled, size = 0, 0, 0
+        try:
+            stream = iter(self.storage.stream_requests(start_time, end_time, self.request_fields, page_size))
+            while True:
+                # Pull a page at a time so fetch is timed apart from the consumer (usually calculate_metrics)
+                with self.stats.stage('fetch'):
+                    page = list(itertools.islice(stream, page_size))
+                for doc in page[-scanned % SIZE_SAMPLE_INTERVAL::SIZE_SAMPLE_INTERVAL]:
+                    size += estimate_document_size(doc.id, doc.to_dict())
+                    sampled += 1
+                scanned += len(page)
+                yield from page
+                if len(page) < page_size:
+                    return
         except Exception as e:
             logger.error(f"Failed to fetch requests data: {e}")
-            return []
+            raise
+        finally:
+            self.stats.record_reads(scanned, round(size * scanned / sampled) if sampled else 0)
 
     def convert_timestamp(self, timestamp):
         """Convert Firestore timestamp to Python datetime"""
@@ -79,86 +888,292 @@ class ServiceMetricsAggregator:
             return timestamp
         return timestamp
 
-    def calculate_metrics(self, requests_data):
-        """Calculate comprehensive metrics from requests data"""
-        metrics = {
-            'total_requests': 0,
-            'requests_by_status': defaultdict(int),
-            'requests_by_technician': defaultdict(int),
-            'requests_by_hour': defaultdict(int),
-            'assign_times': [],
-            'resolution_times': [],
-            'technician_performance': defaultdict(lambda: {
-                'total_requests': 0,
-                'completed_requests': 0,
-                'avg_resolution_time': 0,
-                'total_resolution_time': 0
-            }),
-            'hourly_distribution': defaultdict(int),
-            'status_transitions': defaultdict(int)
-        }
+    def calculate_metrics(self, requests_data, fingerprint=None):
+        """Calculate comprehensive metrics from requests data using the configured engine.
+
+        With `fingerprint` (a hashlib object), everything the metrics are
+        computed from is hashed into it in the same pass over the requests.
+        """
+        with self.stats.stage('compute'), self.profiling():
+            if self.engine == 'python':
+                return self.calculate_metrics_python(requests_data, fingerprint)
+            columns = self.load_request_columns(requests_data)
+            if fingerprint is not None:
+                fingerprint_columns(columns, fingerprint)
+            return self.calculate_metrics_columnar(columns)
+
+    @contextmanager
+    def profiling(self):
+        """Run the block under the compute profiler when profiling is on and no other thread holds it.
+
+        Requests streamed lazily into the block are profiled too, under fetch_requests_data.
+        """
+        if self.profiler is None or not self.profiler_lock.acquire(blocking=False):
+            yield
+            return
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+            self.profiler_lock.release()
+
+    def dump_profile(self, path):
+        """Write the accumulated compute profile for `python -m pstats` or snakeviz"""
+        if self.profiler is not None:
+            with self.profiler_lock:
+                self.profiler.dump_stats(path)
+            logger.info(f"Compute profile written to {path}")
+
+    def calculate_metrics_python(self, requests_data, fingerprint=None):
+        """Calculate metrics with a per-document Python loop (percentiles come from the sketches)"""
+        accumulator = MetricsAccumulator()
+        fields = self.request_fields
+        if self.classifier is None and self.duplicate_index is None:
+            for doc in requests_data:
+                data = doc.to_dict()
+                if fingerprint is not None:
+                    fingerprint.update(repr([data.get(field) for field in fields]).encode())
+                accumulator.add(data)
+            return accumulator.to_metrics()
+        # Classify and deduplicate a page at a time so both still work on vectorized batches
+        requests_data = iter(requests_data)
+        while True:
+            docs = list(itertools.islice(requests_data, REQUESTS_PAGE_SIZE))
+            if not docs:
+                break
+            page = [doc.to_dict() for doc in docs]
+            texts = [data.get(DETAILS_FIELD) for data in page]
+            categories = self.classify_texts(texts) if self.classifier is not None else [None] * len(page)
+            if self.duplicate_index is not None:
+                created = [self.convert_timestamp(data.get('createdAt')) for data in page]
+                duplicates = self.find_duplicates([doc.id for doc in docs], texts,
+                                                  [timestamp.timestamp() if timestamp else np.nan
+                                                   for timestamp in created],
+                                                  [data.get(AUTHOR_FIELD) for data in page]).tolist()
+            else:
+                duplicates = [None] * len(page)
+            for data, category, duplicate in zip(page, categories, duplicates):
+                if fingerprint is not None:
+                    fingerprint.update(repr(([data.get(field) for field in fields], duplicate)).encode())
+                accumulator.add(data, category=category, duplicate=duplicate)
+        # Flagged even without requests, so empty intervals have the same fields as under the columnar engine
+        accumulator.categorized = self.classifier is not None
+        accumulator.deduplicated = self.duplicate_index is not None
+        return accumulator.to_metrics()
+
+    def classify_texts(self, texts):
+        """Complaint category of each requestDetails text"""
+        with self.stats.stage('classify'):
+            return self.classifier.classify(texts, self.stats)
+
+    def find_duplicates(self, ids, texts, created, authors):
+        """Bool array flagging requests whose requestDetails repeat an earlier request by the same author"""
+        with self.stats.stage('dedup'):
+            return self.duplicate_index.check(ids, texts, created, authors, self.stats)
+
+    def save_duplicate_index(self):
+        """Persist the duplicate index's new rows and flags, if it has any"""
+        if self.duplicate_index is not None:
+            with self.stats.stage('dedup'):
+                self.duplicate_index.save()
+
+    def load_request_columns(self, requests_data):
+        """Load a request stream into NumPy columns.
+
+        Timestamps become float64 epoch seconds (NaN when missing); status and
+        technician become int32 codes into the `status_labels` and
+        `technician_labels` lists (-1 when the request has no technicianId);
+        `local_hour` is the LOCAL_TIMEZONE hour of createdAt. When
+        classifying, `category` holds int32 codes into `category_labels`;
+        with a duplicate index, the bool `duplicate` flags near-duplicates.
+        """
+        created, accepted, closed = [], [], []
+        status_codes, technician_codes = [], []
+        status_index, technician_index = {}, {}
+        texts = [] if self.classifier is not None or self.duplicate_index is not None else None
+        ids = [] if self.duplicate_index is not None else None
+        authors = [] if self.duplicate_index is not None else None
+
+        def epoch(timestamp):
+            timestamp = self.convert_timestamp(timestamp)
+            return timestamp.timestamp() if timestamp else np.nan
 
         for doc in requests_data:
             data = doc.to_dict()
-            metrics['total_requests'] += 1
+            created.append(epoch(data.get('createdAt')))
+            accepted.append(epoch(data.get('acceptedAt')))
+            closed.append(epoch(data.get('closedAt')))
 
-            # Extract timestamps
-            created = self.convert_timestamp(data.get('createdAt'))
-            accepted = self.convert_timestamp(data.get('acceptedAt'))
-            closed = self.convert_timestamp(data.get('closedAt'))
-            
             status = data.get('status', 'unknown')
-            technician_id = data.get('technicianId')
-            technician_name = data.get('technicianName', 'Unknown')
-            author_name = data.get('authorName', 'Unknown')
-
-            # Status distribution
-            metrics['requests_by_status'][status] += 1
-
-            # Technician distribution
-            if technician_id:
-                metrics['requests_by_technician'][technician_name] += 1
-
-            # Hourly distribution
-            if created:
-                hour = created.hour
-                metrics['hourly_distribution'][hour] += 1
-
-            # Calculate time metrics
-            if created and accepted:
-                assign_time = (accepted - created).total_seconds()
-                metrics['assign_times'].append(assign_time)
-
-            if created and closed:
-                resolution_time = (closed - created).total_seconds()
-                metrics['resolution_times'].append(resolution_time)
-
-            # Technician performance metrics
-            if technician_id and technician_name:
-                tech_metrics = metrics['technician_performance'][technician_name]
-                tech_metrics['total_requests'] += 1
-                
-                if status == 'closed':
-                    tech_metrics['completed_requests'] += 1
-                
-                if created and closed:
-                    resolution_time = (closed - created).total_seconds()
-                    tech_metrics['total_resolution_time'] += resolution_time
-
-        # Calculate averages and finalize metrics
-        metrics['avg_assign_time'] = sum(metrics['assign_times']) / len(metrics['assign_times']) if metrics['assign_times'] else 0
-        metrics['avg_resolution_time'] = sum(metrics['resolution_times']) / len(metrics['resolution_times']) if metrics['resolution_times'] else 0
-        
-        # Calculate technician performance averages
-        for tech_name, tech_data in metrics['technician_performance'].items():
-            if tech_data['completed_requests'] > 0:
-                tech_data['avg_resolution_time'] = tech_data['total_resolution_time'] / tech_data['completed_requests']
-
-        # Convert defaultdict to regular dict for JSON serialization
-        metrics['requests_by_status'] = dict(metrics['requests_by_status'])
-        metrics['requests_by_technician'] = dict(metrics['requests_by_technician'])
-        metrics['hourly_distribution'] = dict(metrics['hourly_distribution'])
-        metrics['technician_performance'] = dict(metrics['technician_performance'])
+            status_codes.append(status_index.setdefault(status, len(status_index)))
+
+            if data.get('technicianId'):
+                technician_name = data.get('technicianName', 'Unknown')
+                technician_codes.append(technician_index.setdefault(technician_name, len(technician_index)))
+            else:
+                technician_codes.append(-1)
+
+            if texts is not None:
+                texts.append(data.get(DETAILS_FIELD))
+            if ids is not None:
+                ids.append(doc.id)
+                authors.append(data.get(AUTHOR_FIELD))
+
+        created = np.array(created, dtype=np.float64)
+        columns = {
+            'created': created,
+            'accepted': np.array(accepted, dtype=np.float64),
+            'closed': np.array(closed, dtype=np.float64),
+            'status': np.array(status_codes, dtype=np.int32),
+            'status_labels': list(status_index),
+            'technician': np.array(technician_codes, dtype=np.int32),
+            'technician_labels': list(technician_index),
+            'local_hour': local_hours(created)
+        }
+        if self.classifier is not None:
+            category_index = {}
+            columns['category'] = np.array([category_index.setdefault(category, len(category_index))
+                                            for category in self.classify_texts(texts)], dtype=np.int32)
+            columns['category_labels'] = list(category_index)
+        if ids is not None:
+            columns['duplicate'] = self.find_duplicates(ids, texts, created, authors)
+        return columns
+
+    def calculate_metrics_columnar(self, columns):
+        """Calculate metrics from `load_request_columns` output with vectorized operations.
+
+        Produces the same fields as `calculate_metrics_python`, with exact
+        rather than sketch-approximated p50/p90/p99 latencies.
+        """
+        created, accepted, closed = columns['created'], columns['accepted'], columns['closed']
+        status, technician = columns['status'], columns['technician']
+        status_labels, technician_labels = columns['status_labels'], columns['technician_labels']
+
+        def counts_by_label(codes, labels, weights=None):
+            counts = np.bincount(codes, weights=weights, minlength=len(labels))
+            return {label: counts[code].item() for code, label in enumerate(labels)}
+
+        metrics = {
+            'total_requests': int(created.size),
+            # Labels can outnumber the statuses present when `columns` is a slice of a larger scan
+            'requests_by_status': {label: count for label, count in counts_by_label(status, status_labels).items()
+                                   if count},
+            'requests_by_hour': {}
+        }
+
+        has_accepted = ~np.isnan(accepted)
+        has_closed = ~np.isnan(closed)
+        transitions = {
+            'pending_to_active': int(has_accepted.sum()),
+            'active_to_closed': int((has_closed & has_accepted).sum()),
+            'pending_to_closed': int((has_closed & ~has_accepted).sum())
+        }
+        metrics['status_transitions'] = {key: count for key, count in transitions.items() if count}
+
+        has_technician = technician >= 0
+        metrics['requests_by_technician'] = {
+            label: count for label, count in counts_by_label(technician[has_technician], technician_labels).items()
+            if count
+        }
+
+        # UTC hour straight from the epoch seconds; the local hour was bucketed when the columns were loaded
+        has_created = ~np.isnan(created)
+        hours = (np.floor(created[has_created] / 3600) % 24).astype(np.int64)
+        for field, hour_counts in (('hourly_distribution', np.bincount(hours, minlength=24)),
+                                   ('local_hourly_distribution', np.bincount(columns['local_hour'][has_created], minlength=24))):
+            metrics[field] = {hour: hour_counts[hour].item() for hour in np.flatnonzero(hour_counts).tolist()}
+
+        assign_times = (accepted - created)[has_created & ~np.isnan(accepted)]
+        resolution_delta = closed - created
+        resolved = has_created & ~np.isnan(closed)
+        resolution_times = resolution_delta[resolved]
+
+        for name, values in (('assign', assign_times), ('resolution', resolution_times)):
+            total = float(values.sum())
+            metrics[f'total_{name}_time'] = total
+            metrics[f'{name}_count'] = int(values.size)
+            metrics[f'avg_{name}_time'] = total / values.size if values.size else 0
+            percentiles = np.percentile(values, LATENCY_PERCENTILES) if values.size else [0] * len(LATENCY_PERCENTILES)
+            for percentile, value in zip(LATENCY_PERCENTILES, percentiles):
+                metrics[f'p{percentile}_{name}_time'] = float(value)
+            sketch = LatencySketch()
+            sketch.add_array(values)
+            metrics[f'{name}_time_sketch'] = sketch.to_dict()
+
+        # Technician performance only counts requests with a technician name;
+        # the trailing False makes code -1 (no technician) index to "unnamed"
+        named = np.array([bool(label) for label in technician_labels] + [False], dtype=bool)
+        performer = named[technician]
+        codes = technician[performer]
+        closed_code = status_labels.index('closed') if 'closed' in status_labels else -1
+        total_requests = np.bincount(codes, minlength=len(technician_labels))
+        completed = np.bincount(
+            codes, weights=(status[performer] == closed_code).astype(np.float64), minlength=len(technician_labels)
+        )
+        total_resolution = np.bincount(
+            codes, weights=np.where(resolved[performer], resolution_delta[performer], 0.0), minlength=len(technician_labels)
+        )
+
+        resolved_codes = technician[performer & resolved]
+        resolved_delta = resolution_delta[performer & resolved]
+
+        technician_performance = {}
+        for code in np.flatnonzero(total_requests).tolist():
+            completed_requests = int(completed[code])
+            total_resolution_time = float(total_resolution[code])
+            sketch = LatencySketch()
+            sketch.add_array(resolved_delta[resolved_codes == code])
+            technician_performance[technician_labels[code]] = {
+                'total_requests': int(total_requests[code]),
+                'completed_requests': completed_requests,
+                'avg_resolution_time': total_resolution_time / completed_requests if completed_requests else 0,
+                'total_resolution_time': total_resolution_time,
+                'resolved_requests': sketch.count,
+                'resolution_time_sketch': sketch.to_dict()
+            }
+        metrics['technician_performance'] = technician_performance
+
+        if 'category' in columns:
+            category, category_labels = columns['category'], columns['category_labels']
+            category_counts = np.bincount(category, minlength=len(category_labels))
+            # Resolution times sorted by (category, time) once, so every category's
+            # exact percentiles are linear interpolations into its own run of them
+            resolved_categories = category[resolved]
+            order = np.lexsort((resolution_times, resolved_categories))
+            sorted_times = resolution_times[order]
+            resolved_counts = np.bincount(resolved_categories, minlength=len(category_labels))
+            offsets = np.concatenate([[0], np.cumsum(resolved_counts)[:-1]])
+            positions = offsets[:, None] + np.outer(np.maximum(resolved_counts - 1, 0), LATENCY_PERCENTILES) / 100
+            lower = np.floor(positions).astype(np.int64)
+            upper = np.ceil(positions).astype(np.int64)
+            if sorted_times.size:
+                lower_times = sorted_times[np.minimum(lower, sorted_times.size - 1)]
+                upper_times = sorted_times[np.minimum(upper, sorted_times.size - 1)]
+                percentiles = np.where(resolved_counts[:, None] > 0,
+                                       lower_times + (upper_times - lower_times) * (positions - lower), 0.0)
+            else:
+                percentiles = np.zeros(positions.shape)
+            totals = np.bincount(resolved_categories, weights=resolution_times, minlength=len(category_labels))
+            sketches = LatencySketch.from_groups(resolution_times, resolved_categories, len(category_labels))
+
+            metrics['requests_by_category'] = {}
+            metrics['category_performance'] = {}
+            for code in np.flatnonzero(category_counts).tolist():
+                label = category_labels[code]
+                metrics['requests_by_category'][label] = int(category_counts[code])
+                metrics['category_performance'][label] = category_performance_entry(
+                    int(category_counts[code]), float(totals[code]), sketches[code], percentiles[code].tolist())
+
+        if 'duplicate' in columns:
+            duplicate = columns['duplicate']
+            metrics['duplicate_requests'] = int(duplicate.sum())
+            metrics['unique_requests'] = int(created.size) - metrics['duplicate_requests']
+            metrics['unique_requests_by_technician'] = {
+                label: count
+                for label, count in counts_by_label(technician[has_technician & ~duplicate], technician_labels).items()
+                if count
+            }
 
         return metrics
 
@@ -172,8 +1187,12 @@ class ServiceMetricsAggregator:
         else:
             return obj
 
-    def save_metrics(self, metrics, start_time, end_time, custom_id=None):
+    def save_metrics(self, metrics, start_time, end_time, custom_id=None, input_fingerprint=None):
         """Save aggregated metrics to Firestore"""
+        with self.stats.stage('save'):
+            return self._save_metrics(metrics, start_time, end_time, custom_id, input_fingerprint)
+
+    def _save_metrics(self, metrics, start_time, end_time, custom_id, input_fingerprint):
         try:
             # Create metrics document
             metrics = self.to_regular_dict(metrics)
@@ -183,6 +1202,8 @@ class ServiceMetricsAggregator:
                 'generated_at': datetime.now(IST).isoformat(),
                 'metrics': metrics
             }
+            if input_fingerprint:
+                metrics_doc['input_fingerprint'] = input_fingerprint
 
             # Save to metrics collection
             if custom_id:
@@ -204,9 +1225,8 @@ class ServiceMetricsAggregator:
             if not doc_id or len(doc_id) > 1500:  # Firestore limit
                 doc_id = f"metrics_{int(datetime.now(IST).timestamp())}"
             
-            logger.info(f"Saving metrics with document ID: {doc_id}")
-            logger.info(f"Document ID type: {type(doc_id)}, length: {len(doc_id)}")
-            logger.info(f"Collection path: service_metrics")
+            logger.debug(f"Saving metrics with document ID: {doc_id}")
+            logger.debug(f"Document ID type: {type(doc_id)}, length: {len(doc_id)}")
             
             # Validate document ID
             if not isinstance(doc_id, str):
@@ -218,36 +1238,49 @@ class ServiceMetricsAggregator:
             # Remove any invalid characters for Firestore document IDs
             doc_id = re.sub(r'[^a-zA-Z0-9_-]', '_', doc_id)
             
-            logger.info(f"Final document ID: {doc_id}")
-            self.db.collection('service_metrics').document(doc_id).set(metrics_doc)
+            logger.debug(f"Final document ID: {doc_id}")
+            self.sink.write('service_metrics', doc_id, metrics_doc)
+            if isinstance(start_time, datetime):
+                self.dirty_intervals[start_time] = doc_id
             
-            logger.info(f"Metrics saved successfully for interval {start_time} to {end_time}")
+            logger.debug(f"Metrics queued for interval {start_time} to {end_time}")
             return doc_id
         except Exception as e:
             logger.error(f"Failed to save metrics: {e}")
             raise
 
-    def run_aggregation(self, interval_minutes=15):
-        """Main method to run the complete aggregation pipeline"""
+    def run_aggregation(self, interval_minutes=None, start_time=None):
+        """Main method to run the complete aggregation pipeline.
+
+        Aggregates the interval beginning at `start_time` when given, otherwise
+        INTERVAL_START or the current interval.
+        """
+        started = self.stats.snapshot()
         try:
             logger.info("Starting aggregation pipeline...")
             
             # Get time range
-            start_time, end_time = get_interval_from_env(interval_minutes)
+            interval_minutes = interval_minutes or get_interval_minutes()
+            if start_time is not None:
+                end_time = start_time + timedelta(minutes=interval_minutes)
+            else:
+                start_time, end_time = get_interval_from_env(interval_minutes)
             logger.info(f"Aggregating data from {start_time} to {end_time}")
             
             # Fetch data
             requests_data = self.fetch_requests_data(start_time, end_time)
-            logger.info(f"Fetched {len(requests_data)} requests")
             
-            # Calculate metrics
+            # Calculate metrics while the requests stream in
             metrics = self.calculate_metrics(requests_data)
             logger.info(f"Calculated metrics for {metrics['total_requests']} requests")
             
             # Save metrics
             doc_id = self.save_metrics(metrics, start_time, end_time)
+            self.update_rollups()
             
             logger.info(f"Aggregation completed successfully. Document ID: {doc_id}")
+            stats = self.stats.since(started)
+            stats.backfill_lag_seconds = max(0.0, (datetime.now(timezone.utc) - end_time).total_seconds())
             return {
                 'success': True,
                 'document_id': doc_id,
@@ -255,34 +1288,41 @@ class ServiceMetricsAggregator:
                     'total_requests': metrics['total_requests'],
                     'avg_assign_time': metrics['avg_assign_time'],
                     'avg_resolution_time': metrics['avg_resolution_time']
-                }
+                },
+                'stats': stats.to_dict()
             }
             
         except Exception as e:
             logger.error(f"Aggregation failed: {e}")
             return {
                 'success': False,
-                'error': str(e)
+                'error': str(e),
+                'stats': self.stats.since(started).to_dict()
             }
 
-    def run_aggregation_custom(self, start_time, end_time):
+    def custom_doc_id(self, start_time, end_time):
+        """Build the document ID used for custom/backfilled intervals"""
+        start_str = start_time.strftime('%Y%m%d_%H%M')
+        end_str = end_time.strftime('%H%M')
+        return f"custom_{start_str}_{end_str}".replace(':', '').replace(' ', '').replace('.', '')
+
+    def run_aggregation_custom(self, start_time, end_time, refresh_rollups=True):
         """Run aggregation for custom time range (for testing)"""
         try:
             logger.info(f"Running custom aggregation from {start_time} to {end_time}")
             
             # Fetch data
             requests_data = self.fetch_requests_data(start_time, end_time)
-            logger.info(f"Fetched {len(requests_data)} requests")
             
-            # Calculate metrics
+            # Calculate metrics while the requests stream in
             metrics = self.calculate_metrics(requests_data)
             logger.info(f"Calculated metrics for {metrics['total_requests']} requests")
             
             # Save metrics with custom ID
-            start_str = start_time.strftime('%Y%m%d_%H%M')
-            end_str = end_time.strftime('%H%M')
-            doc_id = f"custom_{start_str}_{end_str}".replace(':', '').replace(' ', '').replace('.', '')
+            doc_id = self.custom_doc_id(start_time, end_time)
             self.save_metrics(metrics, start_time, end_time, custom_id=doc_id)
+            if refresh_rollups:
+                self.update_rollups()
             
             logger.info(f"Custom aggregation completed successfully. Document ID: {doc_id}")
             return {
@@ -302,10 +1342,908 @@ class ServiceMetricsAggregator:
                 'error': str(e)
             }
 
-def get_last_aggregated_interval(db, interval_minutes=15):
+    def group_requests_by_interval(self, requests_data, intervals):
+        """Yield (interval, requests) pairs from a createdAt-ordered request stream.
+
+        `intervals` must be contiguous and of equal length, as produced by
+        `get_missed_intervals`. Each group is a lazy iterator that must be
+        consumed before the next pair is requested; intervals without
+        requests get an empty group and requests outside the range are dropped.
+        """
+        if not intervals:
+            return
+
+        range_start = intervals[0][0]
+        interval_seconds = (intervals[0][1] - intervals[0][0]).total_seconds()
+
+        def interval_index(doc):
+            created = self.convert_timestamp(doc.get('createdAt'))
+            if not created:
+                return None
+            index = int((created - range_start).total_seconds() // interval_seconds)
+            return index if 0 <= index < len(intervals) else None
+
+        groups = itertools.groupby(requests_data, key=interval_index)
+        pending = next(groups, None)
+        for index, interval in enumerate(intervals):
+            while pending is not None and (pending[0] is None or pending[0] < index):
+                pending = next(groups, None)
+            if pending is not None and pending[0] == index:
+                yield interval, pending[1]
+                pending = next(groups, None)
+            else:
+                yield interval, iter(())
+
+    def load_interval_fingerprints(self, start_time, end_time, collection='service_metrics'):
+        """Map interval_start -> input_fingerprint of the newest saved doc for each interval in the range"""
+        with self.stats.stage('fetch'):
+            docs = self.storage.query_documents(collection, 'interval_start', start_time.isoformat(),
+                                                end_time.isoformat(), ['interval_start', 'generated_at', 'input_fingerprint'])
+            latest = {}
+            for doc in docs:
+                data = doc.to_dict()
+                current = latest.get(data['interval_start'])
+                if current is None or data.get('generated_at', '') > current.get('generated_at', ''):
+                    latest[data['interval_start']] = data
+        return {interval_start: data.get('input_fingerprint') for interval_start, data in latest.items()}
+
+    def load_watermark(self):
+        """Return the persisted updatedAt watermark of the last incremental run, or None"""
+        watermark = (self.storage.get_state('aggregation') or {}).get('watermark')
+        if watermark:
+            return datetime.fromisoformat(watermark).astimezone(timezone.utc)
+        return None
+
+    def save_watermark(self, watermark):
+        self.storage.set_state('aggregation', {
+            'watermark': watermark.isoformat(),
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        })
+
+    def find_dirty_intervals(self, watermark, interval_minutes=None):
+        """Find intervals holding requests updated after the watermark.
+
+        Returns the sorted interval starts (bucketed by createdAt) and the
+        newest updatedAt seen, or None when nothing changed.
+        """
+        interval_minutes = interval_minutes or get_interval_minutes()
+        try:
+            with self.stats.stage('fetch'):
+                docs = self.storage.stream_updated_requests(watermark - WATERMARK_OVERLAP, ['createdAt', 'updatedAt'])
+                dirty, newest, scanned, size = set(), None, 0, 0
+                for doc in docs:
+                    data = doc.to_dict()
+                    scanned += 1
+                    size += estimate_document_size(doc.id, data)
+                    created = self.convert_timestamp(data.get('createdAt'))
+                    updated = self.convert_timestamp(data.get('updatedAt'))
+                    if created:
+                        dirty.add(get_interval_start(created, interval_minutes))
+                    if updated and (newest is None or updated > newest):
+                        newest = updated
+                self.stats.record_reads(scanned, size)
+            return sorted(dirty), newest
+        except Exception as e:
+            logger.error(f"Failed to find updated requests: {e}")
+            raise
+
+    def run_backfill_scan(self, intervals, skip_unchanged=True):
+        """Aggregate contiguous intervals from one range query instead of one query per interval.
+
+        With `skip_unchanged`, an interval or series bucket whose input
+        fingerprint matches the one stored on its latest doc is not rewritten.
+        """
+        if not intervals:
+            return []
+
+        range_start, range_end = intervals[0][0], intervals[-1][1]
+        logger.info(f"Backfilling {len(intervals)} intervals from {range_start} to {range_end} in a single scan")
+        saved_fingerprints = self.load_interval_fingerprints(range_start, range_end) if skip_unchanged else {}
+        # Series name -> its saved fingerprints, loaded when its first bucket arrives
+        saved_series_fingerprints = {}
+
+        results = []
+        for series, start_time, end_time, computed in self.compute_intervals(intervals):
+            try:
+                if isinstance(computed, Exception):
+                    raise computed
+                metrics, fingerprint = computed
+                if series is not None:
+                    if skip_unchanged and fingerprint is not None:
+                        if series not in saved_series_fingerprints:
+                            # The bucket holding range_start begins before it, by up to two buckets on DST days
+                            saved_series_fingerprints[series] = self.load_interval_fingerprints(
+                                range_start - timedelta(minutes=2 * series[1]), range_end, series_collection(series[0]))
+                        if saved_series_fingerprints[series].get(start_time.isoformat()) == fingerprint:
+                            continue
+                    self.save_series(series, metrics, start_time, end_time, input_fingerprint=fingerprint)
+                    continue
+                doc_id = self.custom_doc_id(start_time, end_time)
+                if fingerprint is not None and saved_fingerprints.get(start_time.isoformat()) == fingerprint:
+                    logger.debug(f"Skipping unchanged interval {start_time} to {end_time}")
+                    results.append({'success': True, 'document_id': doc_id, 'skipped': True})
+                    continue
+                self.save_metrics(metrics, start_time, end_time, custom_id=doc_id, input_fingerprint=fingerprint)
+                results.append({
+                    'success': True,
+                    'document_id': doc_id,
+                    'metrics_summary': {
+                        'total_requests': metrics['total_requests'],
+                        'avg_assign_time': metrics['avg_assign_time'],
+                        'avg_resolution_time': metrics['avg_resolution_time']
+                    }
+                })
+            except Exception as e:
+                logger.error(f"Backfill failed for {f'{series[0]} bucket' if series else 'interval'} "
+                             f"{start_time} to {end_time}: {e}")
+                result = {'success': False, 'error': str(e)}
+                if series is not None:
+                    result['series'] = series_collection(series[0])
+                results.append(result)
+
+        self.commit_results(results)
+        return results
+
+    def compute_intervals(self, intervals, run_start=None):
+        """Yield (series, start, end, computed) for contiguous intervals read with one scan.
+
+        Primary intervals come first, with series None and computed
+        (metrics, input fingerprint); then the buckets of each extra
+        resolution, with series its (name, minutes, zone) tuple and computed
+        the bucket's (metrics, input fingerprint). Anything whose computation failed yields its
+        exception instead. `run_start` is where the whole run begins when
+        `intervals` is one shard of it. Sharded across worker processes when
+        that is enabled and possible.
+        """
+        if self.sharding_enabled() and len(intervals) > 1:
+            yield from self.compute_intervals_sharded(intervals)
+            return
+        if self.resolutions or self.archive is not None:
+            yield from self.compute_columnar_scan(intervals, run_start or intervals[0][0])
+            return
+
+        requests_data = self.fetch_requests_data(intervals[0][0], intervals[-1][1])
+        for (start_time, end_time), group in self.group_requests_by_interval(requests_data, intervals):
+            try:
+                fingerprint = hashlib.sha1()
+                metrics = self.calculate_metrics(group, fingerprint)
+                yield None, start_time, end_time, (metrics, fingerprint.hexdigest())
+            except Exception as e:
+                yield None, start_time, end_time, e
+
+    def compute_columnar_scan(self, intervals, run_start):
+        """compute_intervals for the columnar engine, with the extra resolutions bucketed from the same scan.
+
+        The scan is widened to whole buckets of every resolution, and the
+        request columns of all of it are kept (or read from the archive) so
+        each interval and bucket is a searchsorted slice of them. Of the
+        buckets overlapping the run, this scan emits those whose start
+        (clamped to `run_start`) falls within `intervals`, so every shard of
+        a run owns distinct buckets. A bucket's input fingerprint hashes those
+        of the scanned intervals it overlaps. Archived intervals and buckets
+        carry no input fingerprint and are always rewritten.
+        """
+        own_start, own_end = intervals[0][0], intervals[-1][1]
+        boundaries = {resolution: bucket_boundaries(resolution[1], resolution[2], own_start, own_end)
+                      for resolution in self.resolutions}
+        scan_start = min([own_start] + [datetime.fromtimestamp(edges[0], timezone.utc) for edges in boundaries.values()])
+        scan_end = max([own_end] + [datetime.fromtimestamp(edges[-1], timezone.utc) for edges in boundaries.values()])
+
+        columns, error, scan_starts, scan_fingerprints = None, None, None, None
+        if self.archive is not None:
+            covered = self.archive.covered_range()
+            if covered is None or own_start < covered[0] or own_end > covered[1]:
+                error = ValueError(f"{own_start} to {own_end} is not covered by the request archive")
+            else:
+                # Buckets reaching past the archive are left to a run that has them covered
+                scan_start, scan_end = max(scan_start, covered[0]), min(scan_end, covered[1])
+                try:
+                    with self.stats.stage('fetch'):
+                        columns = self.archive.load_columns(scan_start, scan_end)
+                except Exception as e:
+                    error = e
+            edges = [(start_time.timestamp(), end_time.timestamp()) for start_time, end_time in intervals]
+            slices = slice_request_columns(columns, edges) if error is None else itertools.repeat(None)
+            for (start_time, end_time), part in zip(intervals, slices):
+                metrics = self.compute_bucket(part, error)
+                yield None, start_time, end_time, metrics if isinstance(metrics, Exception) else (metrics, None)
+        else:
+            interval = intervals[0][1] - intervals[0][0]
+            before, after = math.ceil((own_start - scan_start) / interval), math.ceil((scan_end - own_end) / interval)
+            scan = ([(own_start - interval * n, own_start - interval * (n - 1)) for n in range(before, 0, -1)]
+                    + list(intervals) + [(own_end + interval * n, own_end + interval * (n + 1)) for n in range(after)])
+            targets = set(intervals)
+
+            parts, scan_fingerprints = [], []
+            scan_starts = [start_time.timestamp() for start_time, _ in scan]
+            requests_data = self.fetch_requests_data(scan[0][0], scan[-1][1])
+            for (start_time, end_time), group in self.group_requests_by_interval(requests_data, scan):
+                target = (start_time, end_time) in targets
+                try:
+                    fingerprint = hashlib.sha1()
+                    with self.stats.stage('compute'), self.profiling():
+                        part = self.load_request_columns(group)
+                        fingerprint_columns(part, fingerprint)
+                        metrics = self.calculate_metrics_columnar(part) if target else None
+                    parts.append(part)
+                    computed = (metrics, fingerprint.hexdigest())
+                    scan_fingerprints.append(computed[1])
+                except Exception as e:
+                    error = computed = e
+                if target:
+                    yield None, start_time, end_time, computed
+            columns = merge_request_columns(parts) if error is None else None
+
+        run_start, own_start, own_end = run_start.timestamp(), own_start.timestamp(), own_end.timestamp()
+        scan_start, scan_end = scan_start.timestamp(), scan_end.timestamp()
+        for resolution, edges in boundaries.items():
+            edges = edges.tolist()
+            buckets = [(start, end) for start, end in zip(edges, edges[1:])
+                       if end > run_start and own_start <= max(start, run_start) < own_end
+                       and scan_start <= start and end <= scan_end]
+            slices = slice_request_columns(columns, buckets) if error is None else itertools.repeat(None)
+            for (start, end), part in zip(buckets, slices):
+                metrics = self.compute_bucket(part, error)
+                if not isinstance(metrics, Exception):
+                    fingerprint = None
+                    if scan_fingerprints is not None:
+                        first = max(bisect.bisect_right(scan_starts, start) - 1, 0)
+                        overlapped = scan_fingerprints[first:bisect.bisect_left(scan_starts, end)]
+                        fingerprint = hashlib.sha1(repr((resolution, overlapped)).encode()).hexdigest()
+                    metrics = (metrics, fingerprint)
+                yield (resolution, datetime.fromtimestamp(start, timezone.utc), datetime.fromtimestamp(end, timezone.utc),
+                       metrics)
+
+    def compute_bucket(self, columns, error=None):
+        """calculate_metrics_columnar over one slice of a scan, or the exception that prevented it"""
+        try:
+            if error is not None:
+                raise error
+            with self.stats.stage('compute'), self.profiling():
+                return self.calculate_metrics_columnar(columns)
+        except Exception as e:
+            return e
+
+    def save_series(self, resolution, metrics, start_time, end_time, input_fingerprint=None):
+        """Queue one bucket of an extra resolution in its own collection, keyed by its wall-clock start"""
+        name, minutes, tz_name = resolution
+        with self.stats.stage('save'):
+            try:
+                local_start = start_time.astimezone(ZoneInfo(tz_name))
+                doc_id = local_start.strftime('%Y%m%d_%H%M')
+                series_doc = {
+                    'resolution': name,
+                    'interval_minutes': minutes,
+                    'timezone': tz_name,
+                    'interval_start': start_time.isoformat(),
+                    'interval_end': end_time.isoformat(),
+                    'local_start': local_start.isoformat(),
+                    'generated_at': datetime.now(IST).isoformat(),
+                    'metrics': self.to_regular_dict(metrics)
+                }
+                if input_fingerprint:
+                    series_doc['input_fingerprint'] = input_fingerprint
+                self.sink.write(series_collection(name), doc_id, series_doc)
+                return doc_id
+            except Exception as e:
+                logger.error(f"Failed to save {name} metrics for {start_time}: {e}")
+                raise
+
+    def sharding_enabled(self):
+        if self.processes <= 1:
+            return False
+        if self.storage.spec is None:
+            logger.warning(f"{type(self.storage).__name__} cannot be opened from worker processes; running serially")
+            return False
+        if self.duplicate_index is not None:
+            # Requests are checked against every earlier one, so shards cannot flag them independently
+            logger.warning("Duplicate detection needs requests in createdAt order; running serially")
+            return False
+        return True
+
+    def process_pool(self):
+        """Worker processes that each open the storage from its spec (spawned: gRPC clients are not fork-safe)"""
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_shard_worker,
+                                   initargs=(self.storage.spec, self.engine, self.resolutions,
+                                             self.archive.root if self.archive is not None else None,
+                                             self.classifier is not None))
+
+    def compute_intervals_sharded(self, intervals):
+        """compute_intervals over contiguous shards of `intervals` mapped across the process pool.
+
+        Shards come back in order, so the output matches the serial path
+        exactly; results are yielded (and can be saved) as each shard finishes.
+        """
+        shards = split_contiguous(intervals, self.processes * SHARDS_PER_PROCESS)
+        logger.info(f"Computing {len(intervals)} intervals in {len(shards)} shards on {self.processes} processes")
+        with self.process_pool() as executor:
+            futures = [executor.submit(_compute_shard_intervals, shard, intervals[0][0]) for shard in shards]
+            for shard, future in zip(shards, futures):
+                try:
+                    computed, stats = future.result()
+                except Exception as e:
+                    logger.error(f"Shard {shard[0][0]} to {shard[-1][1]} failed: {e}")
+                    for start_time, end_time in shard:
+                        yield None, start_time, end_time, e
+                    continue
+                self.stats.absorb(stats)
+                yield from computed
+
+    def aggregate_window(self, start_time, end_time):
+        """Calculate one metrics dict over an arbitrarily large window, e.g. a month for an audit.
+
+        With sharding, each worker process loads the request columns of one
+        time slice (the map), and the slices are concatenated in order and
+        computed once with the columnar engine (the merge), so the result is
+        identical to `calculate_metrics` over the whole window. With an
+        archive the window is read from it directly.
+        """
+        if self.archive is not None:
+            with self.stats.stage('fetch'):
+                columns = self.archive.load_columns(start_time, end_time)
+            with self.stats.stage('compute'):
+                return self.calculate_metrics_columnar(columns)
+        if not self.sharding_enabled():
+            return self.calculate_metrics(self.fetch_requests_data(start_time, end_time))
+
+        boundaries = [start_time + (end_time - start_time) * shard / (self.processes * SHARDS_PER_PROCESS)
+                      for shard in range(self.processes * SHARDS_PER_PROCESS + 1)]
+        logger.info(f"Aggregating {start_time} to {end_time} in {len(boundaries) - 1} shards on {self.processes} processes")
+        with self.process_pool() as executor:
+            parts = []
+            for columns, stats in executor.map(_load_shard_columns, boundaries[:-1], boundaries[1:]):
+                self.stats.absorb(stats)
+                parts.append(columns)
+        with self.stats.stage('compute'):
+            return self.calculate_metrics_columnar(merge_request_columns(parts))
+
+    def run_aggregation_concurrent(self, intervals, max_workers=8):
+        """Aggregate independent intervals on a bounded thread pool.
+
+        Each interval is fetched, computed and queued for writing by its own
+        worker. Results come back in interval order, a failing interval is
+        reported in its own result without stopping the others, and rollups
+        are refreshed once after every interval has finished. With a
+        duplicate index the intervals run one at a time, in order.
+        """
+        if self.duplicate_index is not None and max_workers > 1:
+            # Like sharding_enabled: flags depend on requests being checked in createdAt order
+            logger.warning("Duplicate detection needs intervals in createdAt order; running serially")
+            max_workers = 1
+        logger.info(f"Aggregating {len(intervals)} intervals with up to {max_workers} workers")
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='interval') as executor:
+            results = list(executor.map(
+                lambda interval: self.run_aggregation_custom(*interval, refresh_rollups=False), intervals
+            ))
+        self.commit_results(results)
+        return results
+
+    def commit_results(self, results):
+        """Commit the buffered intervals behind `results` and refresh each affected hour, day and week once.
+
+        Results whose document failed to write, or whose rollups could not be
+        refreshed, are marked unsuccessful so the watermark holds, and a
+        failed result is added for each extra-resolution bucket that did not write.
+        """
+        try:
+            self.update_rollups()
+        except MetricsWriteError as e:
+            logger.error(f"Failed to write aggregation results: {e}")
+            stale = set(self.dirty_intervals.values())
+            for result in results:
+                doc_id = result.get('document_id')
+                if ('service_metrics', doc_id) in e.failed_documents or doc_id in stale:
+                    result.update(success=False, error=str(e))
+            series = {series_collection(name) for name, _, _ in self.resolutions}
+            for collection, doc_id in sorted(e.failed_documents):
+                if collection in series:
+                    results.append({'success': False, 'document_id': doc_id, 'series': collection, 'error': str(e)})
+        except Exception as e:
+            logger.error(f"Failed to update rollups: {e}")
+            stale = set(self.dirty_intervals.values())
+            for result in results:
+                if result.get('document_id') in stale:
+                    result.update(success=False, error=f"Rollups not refreshed: {e}")
+
+    def save_rollup(self, granularity, period_start):
+        """Recompute one rollup document by merging the documents one level below it"""
+        collection, source = next((c, s) for g, c, s in ROLLUP_LEVELS if g == granularity)
+        period_start, period_end = get_rollup_period(granularity, period_start)
+        try:
+            children = self.storage.query_documents(source, 'interval_start', period_start.isoformat(),
+                                                    period_end.isoformat())
+
+            # An interval may have been saved under more than one ID; keep its newest version
+            latest = {}
+            for doc in children:
+                data = doc.to_dict()
+                current = latest.get(data['interval_start'])
+                if current is None or data.get('generated_at', '') > current.get('generated_at', ''):
+                    latest[data['interval_start']] = data
+
+            metrics = merge_metrics(latest.values())
+            metrics['top_technicians'] = get_top_technicians(metrics['requests_by_technician'])
+            rollup_doc = {
+                'granularity': granularity,
+                'interval_start': period_start.isoformat(),
+                'interval_end': period_end.isoformat(),
+                'generated_at': datetime.now(IST).isoformat(),
+                'source_documents': len(latest),
+                'metrics': self.to_regular_dict(metrics)
+            }
+            doc_id = get_rollup_doc_id(granularity, period_start)
+            self.sink.write(collection, doc_id, rollup_doc)
+            logger.debug(f"Queued {granularity} rollup {doc_id} from {len(latest)} documents")
+            return doc_id
+        except Exception as e:
+            logger.error(f"Failed to save {granularity} rollup for {period_start}: {e}")
+            raise
+
+    def update_rollups(self):
+        """Refresh the hourly, daily and weekly rollups above every interval saved since the last call.
+
+        Each rollup is rebuilt from the level below, so reprocessing an
+        interval replaces its old contribution instead of adding to it.
+        Buffered writes are drained before each level reads the one below;
+        rollups are still refreshed for the intervals that did commit, then
+        MetricsWriteError reports every document that failed. Intervals
+        under a rollup that failed stay in `dirty_intervals`, so the next
+        call rebuilds it. The duplicate index, if any, is persisted here
+        too, once per run.
+        """
+        with self.stats.stage('rollup'):
+            dirty, self.dirty_intervals = self.dirty_intervals, {}
+            retry = set()
+            try:
+                failed = self.sink.drain()
+                dirty = {start_time: doc_id for start_time, doc_id in dirty.items()
+                         if ('service_metrics', doc_id) not in failed}
+                saved = []
+                for granularity, collection, _ in ROLLUP_LEVELS:
+                    periods = defaultdict(list)
+                    for start_time in dirty:
+                        periods[get_rollup_period(granularity, start_time)[0]].append(start_time)
+                    queued = {}
+                    for period_start, start_times in sorted(periods.items()):
+                        try:
+                            doc_id = self.save_rollup(granularity, period_start)
+                        except Exception:
+                            failed.add((collection, get_rollup_doc_id(granularity, period_start)))
+                            retry.update(start_times)
+                            continue
+                        saved.append(doc_id)
+                        queued[doc_id] = start_times
+                    level_failed = self.sink.drain()
+                    failed |= level_failed
+                    for doc_id, start_times in queued.items():
+                        if (collection, doc_id) in level_failed:
+                            retry.update(start_times)
+            except Exception:
+                retry.update(dirty)
+                raise
+            finally:
+                for start_time in retry:
+                    self.dirty_intervals.setdefault(start_time, dirty[start_time])
+        self.save_duplicate_index()
+        if failed:
+            raise MetricsWriteError(failed)
+        return saved
+
+def merge_metrics(metrics_list):
+    """Combine any number of interval metrics into one metrics dict.
+
+    Accepts either bare metrics dicts or full service_metrics documents.
+    Counts, sums and averages are exact; percentiles are approximated from
+    the merged latency sketches. Documents written before sums and sketches
+    were stored fall back to their raw `assign_times`/`resolution_times`
+    lists when present.
+    """
+    merged = {
+        'total_requests': 0,
+        'requests_by_status': defaultdict(int),
+        'requests_by_technician': defaultdict(int),
+        'requests_by_hour': defaultdict(int),
+        'hourly_distribution': defaultdict(int),
+        'local_hourly_distribution': defaultdict(int),
+        'status_transitions': defaultdict(int),
+        'technician_performance': {}
+    }
+    sketches = {name: LatencySketch() for name in LATENCY_METRICS}
+    for name in LATENCY_METRICS:
+        merged[f'total_{name}_time'] = 0
+        merged[f'{name}_count'] = 0
+    # Category fields are only merged in when some input was classified, deduplicated counts when some was deduplicated
+    categorized = False
+    requests_by_category = defaultdict(int)
+    category_performance = {}
+    deduplicated = False
+    duplicate_requests = 0
+    unique_requests_by_technician = defaultdict(int)
+
+    for metrics in metrics_list:
+        metrics = metrics.get('metrics', metrics)
+        merged['total_requests'] += metrics.get('total_requests', 0)
+        for field in ('requests_by_status', 'requests_by_technician', 'requests_by_hour',
+                      'hourly_distribution', 'local_hourly_distribution', 'status_transitions'):
+            for key, count in (metrics.get(field) or {}).items():
+                merged[field][str(key)] += count
+
+        for name in LATENCY_METRICS:
+            if f'{name}_count' in metrics:
+                merged[f'total_{name}_time'] += metrics.get(f'total_{name}_time', 0)
+                merged[f'{name}_count'] += metrics[f'{name}_count']
+                sketch = metrics.get(f'{name}_time_sketch')
+                if sketch:
+                    sketches[name].merge(LatencySketch.from_dict(sketch))
+            else:
+                values = metrics.get(f'{name}_times') or []
+                merged[f'total_{name}_time'] += sum(values)
+                merged[f'{name}_count'] += len(values)
+                for value in values:
+                    sketches[name].add(value)
+
+        for tech_name, tech_data in (metrics.get('technician_performance') or {}).items():
+            tech_metrics = merged['technician_performance'].setdefault(tech_name, {
+                'total_requests': 0,
+                'completed_requests': 0,
+                'avg_resolution_time': 0,
+                'total_resolution_time': 0,
+                'resolved_requests': 0,
+                'resolution_time_sketch': LatencySketch()
+            })
+            tech_metrics['total_requests'] += tech_data.get('total_requests', 0)
+            tech_metrics['completed_requests'] += tech_data.get('completed_requests', 0)
+            tech_metrics['total_resolution_time'] += tech_data.get('total_resolution_time', 0)
+            tech_metrics['resolved_requests'] += tech_data.get('resolved_requests', 0)
+            sketch = tech_data.get('resolution_time_sketch')
+            if sketch:
+                tech_metrics['resolution_time_sketch'].merge(LatencySketch.from_dict(sketch))
+
+        if 'requests_by_category' in metrics:
+            categorized = True
+            for category, count in metrics['requests_by_category'].items():
+                requests_by_category[category] += count
+        for category, category_data in (metrics.get('category_performance') or {}).items():
+            category_metrics = category_performance.setdefault(category, [0, 0, LatencySketch()])
+            category_metrics[0] += category_data.get('total_requests', 0)
+            category_metrics[1] += category_data.get('total_resolution_time', 0)
+            sketch = category_data.get('resolution_time_sketch')
+            if sketch:
+                category_metrics[2].merge(LatencySketch.from_dict(sketch))
+
+        if 'duplicate_requests' in metrics:
+            deduplicated = True
+            duplicate_requests += metrics['duplicate_requests']
+            for tech_name, count in (metrics.get('unique_requests_by_technician') or {}).items():
+                unique_requests_by_technician[tech_name] += count
+
+    for name in LATENCY_METRICS:
+        count = merged[f'{name}_count']
+        merged[f'avg_{name}_time'] = merged[f'total_{name}_time'] / count if count else 0
+        for percentile in LATENCY_PERCENTILES:
+            merged[f'p{percentile}_{name}_time'] = sketches[name].quantile(percentile / 100)
+        merged[f'{name}_time_sketch'] = sketches[name].to_dict()
+
+    for tech_metrics in merged['technician_performance'].values():
+        if tech_metrics['completed_requests'] > 0:
+            tech_metrics['avg_resolution_time'] = tech_metrics['total_resolution_time'] / tech_metrics['completed_requests']
+        tech_metrics['resolution_time_sketch'] = tech_metrics['resolution_time_sketch'].to_dict()
+
+    for field in ('requests_by_status', 'requests_by_technician', 'requests_by_hour',
+                  'hourly_distribution', 'local_hourly_distribution', 'status_transitions'):
+        merged[field] = dict(merged[field])
+    if categorized:
+        merged['requests_by_category'] = dict(requests_by_category)
+        merged['category_performance'] = {category: category_performance_entry(*category_metrics)
+                                          for category, category_metrics in category_performance.items()}
+    if deduplicated:
+        merged['duplicate_requests'] = duplicate_requests
+        merged['unique_requests'] = merged['total_requests'] - duplicate_requests
+        merged['unique_requests_by_technician'] = dict(unique_requests_by_technician)
+    return merged
+
+def fingerprint_columns(columns, fingerprint):
+    """Hash the `load_request_columns` arrays and labels the columnar metrics are computed from"""
+    for key in REQUEST_COLUMNS:
+        if key in columns:
+            fingerprint.update(np.ascontiguousarray(columns[key]).tobytes())
+    fingerprint.update(repr([columns.get(key) for key in ('status_labels', 'technician_labels',
+                                                          'category_labels')]).encode())
+
+def split_contiguous(items, shards):
+    """Split a list into at most `shards` contiguous, nearly equal, non-empty chunks"""
+    shards = max(1, min(shards, len(items)))
+    size, extra = divmod(len(items), shards)
+    chunks, offset = [], 0
+    for shard in range(shards):
+        end = offset + size + (shard < extra)
+        chunks.append(items[offset:end])
+        offset = end
+    return chunks
+
+def merge_request_columns(parts):
+    """Concatenate `load_request_columns` outputs in order, remapping status, technician and category codes.
+
+    Labels keep their first-seen order, so the result equals loading the
+    concatenated request stream in one pass.
+    """
+    status_index, technician_index = {}, {}
+    status_codes, technician_codes = [], []
+    for part in parts:
+        status_map = np.array([status_index.setdefault(label, len(status_index)) for label in part['status_labels']],
+                              dtype=np.int32)
+        status_codes.append(status_map[part['status']])
+        # A trailing -1 keeps code -1 (no technician) mapped to -1
+        technician_map = np.array([technician_index.setdefault(label, len(technician_index))
+                                   for label in part['technician_labels']] + [-1], dtype=np.int32)
+        technician_codes.append(technician_map[part['technician']])
+
+    def concatenate(arrays, dtype):
+        return np.concatenate(arrays) if arrays else np.array([], dtype=dtype)
+
+    merged = {
+        'created': concatenate([part['created'] for part in parts], np.float64),
+        'accepted': concatenate([part['accepted'] for part in parts], np.float64),
+        'closed': concatenate([part['closed'] for part in parts], np.float64),
+        'status': concatenate(status_codes, np.int32),
+        'status_labels': list(status_index),
+        'technician': concatenate(technician_codes, np.int32),
+        'technician_labels': list(technician_index),
+        'local_hour': concatenate([part['local_hour'] for part in parts], np.int8)
+    }
+    if parts and all('category' in part for part in parts):
+        category_index = {}
+        merged['category'] = concatenate([
+            np.array([category_index.setdefault(label, len(category_index)) for label in part['category_labels']],
+                     dtype=np.int32)[part['category']]
+            for part in parts
+        ], np.int32)
+        merged['category_labels'] = list(category_index)
+    if parts and all('duplicate' in part for part in parts):
+        merged['duplicate'] = concatenate([part['duplicate'] for part in parts], bool)
+    return merged
+
+def slice_request_columns(columns, buckets):
+    """Yield the rows of createdAt-ordered `load_request_columns` output falling in each [start, end) bucket.
+
+    Bucket edges are epoch seconds; the slices are views sharing the label lists.
+    """
+    starts, ends = (np.searchsorted(columns['created'], [bucket[edge] for bucket in buckets], side='left')
+                    for edge in (0, 1))
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        yield dict(columns, **{key: columns[key][start:end] for key in REQUEST_COLUMNS if key in columns})
+
+# Aggregator of a sharded-mode worker process, created by _init_shard_worker
+_shard_aggregator = None
+
+def _init_shard_worker(storage_spec, engine, resolutions, archive_root, classify):
+    global _shard_aggregator
+    archive = None
+    if archive_root is not None:
+        from request_archive import RequestArchive
+        archive = RequestArchive(archive_root)
+    _shard_aggregator = ServiceMetricsAggregator(engine=engine, storage=create_storage(storage_spec),
+                                                 resolutions=resolutions, archive=archive, classify=classify,
+                                                 duplicate_index=False)
+
+def _compute_shard_intervals(intervals, run_start):
+    """Worker: compute contiguous intervals of a run starting at `run_start` with one scan; returns (computed, stats dict)"""
+    started = _shard_aggregator.stats.snapshot()
+    computed = list(_shard_aggregator.compute_intervals(intervals, run_start))
+    return computed, _shard_aggregator.stats.since(started).to_dict()
+
+def _load_shard_columns(start_time, end_time):
+    """Worker: load the request columns of one time slice; returns (columns, stats dict)"""
+    started = _shard_aggregator.stats.snapshot()
+    with _shard_aggregator.stats.stage('compute'):
+        columns = _shard_aggregator.load_request_columns(_shard_aggregator.fetch_requests_data(start_time, end_time))
+    return columns, _shard_aggregator.stats.since(started).to_dict()
+
+def get_rollup_period(granularity, timestamp):
+    """Return the UTC (start, end) of the hourly, daily or weekly (Monday-based) period containing timestamp"""
+    timestamp = timestamp.astimezone(timezone.utc)
+    if granularity == 'hourly':
+        start_time = timestamp.replace(minute=0, second=0, microsecond=0)
+        return start_time, start_time + timedelta(hours=1)
+    day_start = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == 'daily':
+        return day_start, day_start + timedelta(days=1)
+    if granularity == 'weekly':
+        start_time = day_start - timedelta(days=day_start.weekday())
+        return start_time, start_time + timedelta(days=7)
+    raise ValueError(f"Unknown rollup granularity '{granularity}'")
+
+def get_rollup_doc_id(granularity, period_start):
+    """Document ID of a rollup: YYYYMMDD_HH for hourly, YYYYMMDD of the (week) start otherwise"""
+    if granularity == 'hourly':
+        return period_start.strftime('%Y%m%d_%H')
+    return period_start.strftime('%Y%m%d')
+
+def get_top_technicians(requests_by_technician, limit=TOP_TECHNICIANS_LIMIT):
+    """Top technicians by request count, ties broken by name"""
+    ranked = sorted(requests_by_technician.items(), key=lambda item: (-item[1], item[0]))
+    return [{'name': name, 'count': count} for name, count in ranked[:limit]]
+
+class RealtimeAggregator:
+    """Long-running incremental aggregation driven by an on_snapshot listener on `requests`.
+
+    Every document change is applied to in-memory per-interval accumulators
+    as a remove-old/add-new delta. Intervals touched since the last flush
+    are written to service_metrics once changes have been quiet for
+    `debounce_seconds` (and at least every `max_delay_seconds`). The
+    listener starts at the checkpointed `resume_from`, so after a restart
+    its initial snapshot rebuilds every interval that was still open.
+    Intervals older than `retention_minutes` are evicted from memory and
+    left to batch re-aggregation, and the listener is re-attached at the
+    new horizon every WATCH_RESUBSCRIBE_AFTER.
+
+    `handle_snapshot` and `flush` can be driven directly by an in-process
+    fake; setting FIRESTORE_EMULATOR_HOST points `start` at the emulator.
+    """
+
+    def __init__(self, aggregator, interval_minutes=None, debounce_seconds=5,
+                 max_delay_seconds=60, retention_minutes=24 * 60):
+        self.aggregator = aggregator
+        self.interval = timedelta(minutes=interval_minutes or get_interval_minutes())
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.retention = timedelta(minutes=retention_minutes)
+        self.accumulators = {}   # interval start -> MetricsAccumulator
+        self.contributions = {}  # request id -> (interval start, data applied)
+        self.dirty = set()
+        self.horizon = None
+        self.first_dirty_at = None
+        self.last_change_at = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.watch = None
+        self.watch_from = None
+
+    def interval_start(self, timestamp):
+        return get_interval_start(timestamp, int(self.interval.total_seconds() // 60))
+
+    def apply_change(self, doc_id, data):
+        """Replace a request's contribution; `data` of None means the request was removed"""
+        with self.lock:
+            previous = self.contributions.get(doc_id)
+            if previous is not None and previous[1] == data:
+                # Re-delivered unchanged, e.g. in the initial snapshot of a re-attached listener
+                return
+            self.contributions.pop(doc_id, None)
+            if previous is not None:
+                start_time, old_data = previous
+                self.accumulators[start_time].add(old_data, -1)
+                self._mark_dirty(start_time)
+
+            created = data.get('createdAt') if data else None
+            if not created:
+                return
+            start_time = self.interval_start(created)
+            if self.horizon is not None and start_time < self.horizon:
+                return
+            self.accumulators.setdefault(start_time, MetricsAccumulator()).add(data)
+            self.contributions[doc_id] = (start_time, data)
+            self._mark_dirty(start_time)
+
+    def _mark_dirty(self, start_time):
+        now = time.monotonic()
+        if not self.dirty:
+            self.first_dirty_at = now
+        self.last_change_at = now
+        self.dirty.add(start_time)
+
+    def handle_snapshot(self, docs, changes, read_time):
+        """on_snapshot callback: apply each ADDED/MODIFIED/REMOVED change as a delta"""
+        for change in changes:
+            data = None
+            if change.type.name != 'REMOVED':
+                document = change.document.to_dict()
+                data = {field: document[field] for field in REQUEST_FIELDS if field in document}
+            self.apply_change(change.document.id, data)
+
+    def flush(self, force=False):
+        """Write dirty intervals once the debounce has elapsed (immediately with force)"""
+        with self.lock:
+            if not self.dirty:
+                return []
+            now = time.monotonic()
+            quiet = now - self.last_change_at >= self.debounce_seconds
+            overdue = now - self.first_dirty_at >= self.max_delay_seconds
+            if not (force or quiet or overdue):
+                return []
+            dirty, self.dirty = sorted(self.dirty), set()
+            pending = [(start_time, self.accumulators[start_time].to_metrics()) for start_time in dirty]
+
+        saved = []
+        try:
+            for start_time, metrics in pending:
+                end_time = start_time + self.interval
+                doc_id = self.aggregator.custom_doc_id(start_time, end_time)
+                self.aggregator.save_metrics(metrics, start_time, end_time, custom_id=doc_id)
+                saved.append(doc_id)
+            self.aggregator.update_rollups()
+        except Exception as e:
+            logger.error(f"Real-time flush failed, will retry: {e}")
+            with self.lock:
+                for start_time, _ in pending:
+                    self._mark_dirty(start_time)
+            return saved
+
+        logger.info(f"Real-time flush wrote {len(saved)} intervals")
+        self.evict()
+        self.save_checkpoint()
+        return saved
+
+    def evict(self):
+        """Drop clean intervals that fell out of the retention window"""
+        horizon = self.interval_start(datetime.now(timezone.utc) - self.retention)
+        with self.lock:
+            if self.horizon is not None and horizon <= self.horizon:
+                return
+            horizon = min([horizon] + list(self.dirty))
+            self.horizon = horizon
+            for start_time in [start for start in self.accumulators if start < horizon]:
+                del self.accumulators[start_time]
+            for doc_id in [doc_id for doc_id, (start, _) in self.contributions.items() if start < horizon]:
+                del self.contributions[doc_id]
+        if self.watch is not None and horizon - self.watch_from >= WATCH_RESUBSCRIBE_AFTER:
+            self.resubscribe()
+
+    def load_checkpoint(self):
+        """Return the checkpointed resume_from, or the current interval start on first run"""
+        resume_from = (self.aggregator.storage.get_state('realtime') or {}).get('resume_from')
+        if resume_from:
+            return datetime.fromisoformat(resume_from).astimezone(timezone.utc)
+        return self.interval_start(datetime.now(timezone.utc))
+
+    def save_checkpoint(self):
+        with self.lock:
+            resume_from = self.horizon if self.horizon is not None else self.interval_start(datetime.now(timezone.utc))
+        self.aggregator.storage.set_state('realtime', {
+            'resume_from': resume_from.isoformat(),
+            'interval_minutes': int(self.interval.total_seconds() // 60),
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        })
+
+    def start(self):
+        """Attach the listener from the checkpoint"""
+        self.horizon = self.load_checkpoint()
+        logger.info(f"Starting real-time aggregation from {self.horizon}")
+        self.watch_from = self.horizon
+        self.watch = self.aggregator.storage.watch_requests(self.horizon, self.handle_snapshot)
+
+    def resubscribe(self):
+        """Re-attach the listener at the current horizon, dropping the evicted requests from its query.
+
+        The new listener is attached before the old one is detached, so no
+        change is missed; requests delivered by both are applied once.
+        """
+        with self.lock:
+            horizon = self.horizon
+        logger.info(f"Re-attaching the real-time listener from {horizon} (was {self.watch_from})")
+        previous, self.watch_from = self.watch, horizon
+        self.watch = self.aggregator.storage.watch_requests(horizon, self.handle_snapshot)
+        previous.unsubscribe()
+
+    def run(self, poll_seconds=1):
+        """Listen and flush until stop() is called or the process is interrupted"""
+        self.start()
+        try:
+            while not self.stop_event.wait(poll_seconds):
+                self.flush()
+        finally:
+            if self.watch is not None:
+                self.watch.unsubscribe()
+            self.flush(force=True)
+
+    def stop(self):
+        self.stop_event.set()
+
+def get_last_aggregated_interval(storage, interval_minutes=None):
     """Get the end time of the last aggregated interval from service_metrics collection (UTC)."""
-    docs = db.collection('service_metrics').order_by('interval_end', direction=firestore.Query.DESCENDING).limit(1).stream()
-    for doc in docs:
+    doc = storage.latest_document('service_metrics', 'interval_end')
+    if doc is not None:
         data = doc.to_dict()
         interval_end = data.get('interval_end')
         if interval_end:
@@ -313,36 +2251,161 @@ def get_last_aggregated_interval(db, interval_minutes=15):
             return datetime.fromisoformat(interval_end.replace('Z', '+00:00')).astimezone(timezone.utc)
     return None
 
-def run_backfill(interval_minutes=15):
-    aggregator = ServiceMetricsAggregator()
-    now = datetime.now(timezone.utc)
-    # Round down to nearest interval
-    minutes_to_subtract = now.minute % interval_minutes
-    current_interval_start = now.replace(minute=now.minute - minutes_to_subtract, second=0, microsecond=0)
-    current_interval_end = current_interval_start + timedelta(minutes=interval_minutes)
+def group_contiguous_intervals(interval_starts, interval_minutes=None):
+    """Split interval starts into runs of contiguous (start, end) intervals, one scan per run"""
+    interval_minutes = interval_minutes or get_interval_minutes()
+    interval = timedelta(minutes=interval_minutes)
+    runs = []
+    for start_time in sorted(set(interval_starts)):
+        if runs and runs[-1][-1][1] == start_time:
+            runs[-1].append((start_time, start_time + interval))
+        else:
+            runs.append([(start_time, start_time + interval)])
+    return runs
 
-    last_end = get_last_aggregated_interval(aggregator.db, interval_minutes)
-    if not last_end:
-        # If no previous doc, start from midnight UTC
-        last_end = now.replace(hour=0, minute=0, second=0, microsecond=0)
+def get_missed_intervals(last_end, current_interval_start, interval_minutes=None):
+    """List the contiguous intervals from last_end up to (but excluding) the current interval"""
+    interval_minutes = interval_minutes or get_interval_minutes()
     intervals = []
     while last_end < current_interval_start:
         start_time = last_end
         end_time = start_time + timedelta(minutes=interval_minutes)
         intervals.append((start_time, end_time))
         last_end = end_time
+    return intervals
+
+def run_backfill(interval_minutes=None, single_scan=True, max_workers=1, storage=None, aggregator=None, processes=1):
+    """Backfill missed intervals and re-aggregate intervals that changed since the last run.
+
+    With `single_scan` missed and changed intervals are read with one query
+    per contiguous run and unchanged intervals (including the current one)
+    are skipped; otherwise each missed interval and the current interval
+    issue their own query and are always rewritten, on up to `max_workers`
+    concurrent workers. `storage` defaults to the METRICS_STORAGE backend;
+    pass `aggregator` to reuse one across runs. `processes` > 1 shards the
+    single-scan computation across worker processes.
+
+    `interval_minutes` defaults to AGGREGATION_INTERVAL_MINUTES (15).
+
+    Returns RunResults: the per-interval results, with the run's stage
+    timings, I/O counters and backfill lag on `.stats`.
+    """
+    interval_minutes = interval_minutes or get_interval_minutes()
+    aggregator = aggregator or ServiceMetricsAggregator(storage=storage, processes=processes)
+    started = aggregator.stats.snapshot()
+    results = RunResults(_run_backfill(aggregator, interval_minutes, single_scan, max_workers))
+    results.stats = aggregator.stats.since(started)
+    last_end = get_last_aggregated_interval(aggregator.storage, interval_minutes)
+    if last_end:
+        results.stats.backfill_lag_seconds = max(0.0, (datetime.now(timezone.utc) - last_end).total_seconds())
+    logger.info(f"Backfill stats: {json.dumps(results.stats.to_dict())}")
+    return results
+
+def _run_backfill(aggregator, interval_minutes, single_scan, max_workers):
+    """Body of run_backfill, run on the given aggregator"""
+    now = datetime.now(timezone.utc)
+    current_interval_start, current_interval_end = get_current_interval(interval_minutes)
+
+    last_end = get_last_aggregated_interval(aggregator.storage, interval_minutes)
+    if not last_end:
+        # If no previous doc, start from midnight UTC
+        last_end = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    intervals = get_missed_intervals(last_end, current_interval_start, interval_minutes)
     if not intervals:
         logger.info("No missed intervals to backfill.")
+    if single_scan:
+        return run_incremental(aggregator, intervals, last_end, current_interval_end, interval_minutes)
+    if max_workers > 1:
+        return aggregator.run_aggregation_concurrent(intervals + [(current_interval_start, current_interval_end)], max_workers)
+    results = []
     for start_time, end_time in intervals:
         logger.info(f"Backfilling interval: {start_time} to {end_time}")
-        aggregator.run_aggregation_custom(start_time, end_time)
+        results.append(aggregator.run_aggregation_custom(start_time, end_time))
     # Always run the current interval as well
     logger.info(f"Running aggregation for current interval: {current_interval_start} to {current_interval_end}")
-    aggregator.run_aggregation_custom(current_interval_start, current_interval_end)
+    results.append(aggregator.run_aggregation_custom(current_interval_start, current_interval_end))
+    return results
+
+def run_replay(archive, start_time, end_time, interval_minutes=None, storage=None, aggregator=None, processes=1):
+    """Recompute the whole intervals from start_time to end_time, their extra series and rollups from a request archive.
+
+    Nothing is read from the requests collection: the range is one archive
+    read, and every interval is rewritten (e.g. after a metrics schema
+    change). Metrics are written to `storage` (default METRICS_STORAGE) or
+    the given aggregator's storage. Returns RunResults.
+    """
+    interval_minutes = interval_minutes or get_interval_minutes()
+    aggregator = aggregator or ServiceMetricsAggregator(storage=storage, processes=processes, archive=archive)
+    started = aggregator.stats.snapshot()
+    intervals = get_missed_intervals(get_interval_start(start_time, interval_minutes),
+                                     get_interval_start(end_time, interval_minutes), interval_minutes)
+    logger.info(f"Replaying {len(intervals)} intervals from {start_time} to {end_time} out of the request archive")
+    results = RunResults(aggregator.run_backfill_scan(intervals, skip_unchanged=False))
+    results.stats = aggregator.stats.since(started)
+    logger.info(f"Replay stats: {json.dumps(results.stats.to_dict())}")
+    return results
+
+def run_incremental(aggregator, missed_intervals, last_end, range_end, interval_minutes=None):
+    """Recompute missed intervals plus only those whose requests changed since the watermark.
+
+    Changed intervals are found through `updatedAt` > the watermark stored
+    in pipeline_state/aggregation (the first run uses `last_end`). Each
+    contiguous run of target intervals is read with one scan, unchanged
+    inputs are skipped without a write, and the watermark only advances
+    when every interval succeeded.
+    """
+    interval_minutes = interval_minutes or get_interval_minutes()
+    run_started = datetime.now(timezone.utc)
+    watermark = aggregator.load_watermark() or last_end
+    dirty, newest = aggregator.find_dirty_intervals(watermark, interval_minutes)
+    dirty = [start_time for start_time in dirty if start_time < range_end]
+    logger.info(f"{len(dirty)} intervals changed since {watermark}, {len(missed_intervals)} missed")
+
+    targets = [start_time for start_time, _ in missed_intervals] + dirty
+    results = []
+    for run in group_contiguous_intervals(targets, interval_minutes):
+        results.extend(aggregator.run_backfill_scan(run))
+
+    if all(result['success'] for result in results):
+        aggregator.save_watermark(max(newest, watermark) if newest else max(watermark, run_started - WATERMARK_OVERLAP))
+    else:
+        logger.warning("Some intervals failed; keeping the previous watermark so they are retried")
+    return results
+
+def run_realtime(interval_minutes=None, debounce_seconds=5, storage=None):
+    """Run the long-running real-time aggregation mode"""
+    # Changes are applied as deltas without requestDetails, so the real-time mode neither classifies nor deduplicates
+    realtime = RealtimeAggregator(ServiceMetricsAggregator(storage=storage, duplicate_index=False), interval_minutes,
+                                  debounce_seconds)
+    try:
+        realtime.run()
+    except KeyboardInterrupt:
+        logger.info("Real-time aggregation stopped")
 
 def main():
-    """Main function to run the aggregation with backfill"""
-    run_backfill(interval_minutes=15)
+    """Main function to run the aggregation with backfill, or the real-time listener with AGGREGATION_MODE=realtime.
+
+    PIPELINE_STATS_FILE writes the backfill's RunStats (Prometheus text for a
+    `.prom` path, JSON otherwise); PROFILE_COMPUTE writes a cProfile of the
+    compute stage to the given path; AGGREGATION_PROCESSES shards the
+    backfill computation across that many processes. AGGREGATION_INTERVAL_MINUTES
+    sets the primary interval and AGGREGATION_RESOLUTIONS the extra series;
+    CLASSIFY_COMPLAINTS adds complaint categories and DUPLICATE_INDEX
+    deduplicated counts.
+    """
+    interval_minutes = get_interval_minutes()
+    if os.environ.get('AGGREGATION_MODE') == 'realtime':
+        run_realtime(interval_minutes=interval_minutes)
+        return
+    profile_path = os.environ.get('PROFILE_COMPUTE')
+    aggregator = ServiceMetricsAggregator(profile_compute=bool(profile_path),
+                                          processes=int(os.environ.get('AGGREGATION_PROCESSES', 1)))
+    results = run_backfill(interval_minutes=interval_minutes, aggregator=aggregator)
+    stats_path = os.environ.get('PIPELINE_STATS_FILE')
+    if stats_path:
+        write_stats_file(results.stats, stats_path)
+    if profile_path:
+        aggregator.dump_profile(profile_path)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,279 @@
+"""Benchmark the aggregation pipeline stages on synthetic workloads of increasing size.
+
+Each workload size runs in a fresh process so its peak RSS is measured in
+isolation. For every size the requests are generated with
+WorkloadGenerator, loaded into the chosen storage backend, and then timed
+through a full `run_backfill` followed by the individual stages:
+`fetch_requests_data`, `calculate_metrics` (per interval) and `save_metrics`
+(flushed through the sink). Results are printed as JSON so runs from
+different versions can be diffed or charted.
+
+    python benchmark_pipeline.py --sizes 10000,100000,1000000 --output bench.json
+    python benchmark_pipeline.py --sizes 100000 --storage sqlite --technician-skew 1.5
+    python benchmark_pipeline.py --sizes 100000 --dedup --repeat-share 0.1
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from multiprocessing import get_context
+
+import numpy as np
+
+from aggregation_pipeline import (ServiceMetricsAggregator, get_interval_start, get_missed_intervals,
+                                  run_backfill)
+from duplicate_index import DuplicateIndex
+from metrics_storage import InMemoryStorage, SQLiteStorage
+from workload_generator import WorkloadGenerator, parse_delay, parse_status_mix
+
+# Keep the pipeline's per-interval INFO logging out of the timings
+logging.getLogger('aggregation_pipeline').setLevel(logging.WARNING)
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+def peak_rss_bytes():
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class StageTimer:
+    """Accumulates wall and CPU time for one stage, plus per-call latencies"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.calls = []
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        self.seconds += elapsed
+        self.cpu_seconds += time.process_time() - self.cpu_started
+        self.calls.append(elapsed)
+
+    def report(self, documents):
+        calls_ms = np.array(self.calls) * 1000
+        return {
+            'seconds': round(self.seconds, 6),
+            'cpu_seconds': round(self.cpu_seconds, 6),
+            'documents': documents,
+            'throughput_per_second': round(documents / self.seconds, 1) if self.seconds else None,
+            'calls': len(self.calls),
+            'latency_ms': {
+                'p50': round(float(np.percentile(calls_ms, 50)), 3),
+                'p99': round(float(np.percentile(calls_ms, 99)), 3),
+                'max': round(float(calls_ms.max()), 3)
+            } if len(self.calls) else None
+        }
+
+def create_benchmark_storage(kind, directory, latency):
+    if kind == 'sqlite':
+        return SQLiteStorage(os.path.join(directory, 'benchmark.db'))
+    return InMemoryStorage(latency=latency)
+
+def create_duplicate_index(options, directory, name):
+    """A fresh DuplicateIndex under `directory` with --dedup, else False (no deduplication)"""
+    if not options['dedup']:
+        return False
+    return DuplicateIndex(os.path.join(directory, name), window_hours=options['dedup_window_hours'])
+
+def benchmark_size(count, options):
+    """Generate `count` requests and time each pipeline stage against them; runs in a worker process"""
+    interval_minutes = options['interval_minutes']
+    interval = timedelta(minutes=interval_minutes)
+    rate = options['rate'] or count / (options['days'] * 24 * 60)
+    generator = WorkloadGenerator(
+        arrival_rate=rate,
+        status_mix=options['status_mix'],
+        technician_count=options['technicians'],
+        technician_skew=options['technician_skew'],
+        accept_delay=options['accept_delay'],
+        close_delay=options['close_delay'],
+        seed=options['seed'],
+        details_pool=options['details_pool'],
+        customer_count=options['customers'],
+        repeat_share=options['repeat_share']
+    )
+    now = datetime.now(timezone.utc)
+    range_end = get_interval_start(now, interval_minutes) + interval
+    # Start on an hour boundary so the marker below never shares an hourly rollup with real intervals
+    range_start = get_interval_start(now - generator.span(count), 60)
+    intervals = get_missed_intervals(range_start, range_end, interval_minutes)
+
+    stages = {}
+    with tempfile.TemporaryDirectory() as directory:
+        storage = create_benchmark_storage(options['storage'], directory, options['latency_ms'] / 1000)
+
+        generate = StageTimer()
+        with generate:
+            requests = generator.generate(count, now)
+        stages['generate'] = generate.report(count)
+
+        load = StageTimer()
+        with load:
+            storage.put_requests(requests)
+        stages['load'] = load.report(count)
+        del requests
+
+        # run_backfill resumes from the newest interval_end, so mark the workload start as already aggregated
+        storage.write_documents([('service_metrics', 'benchmark_start', {
+            'interval_start': (range_start - interval).isoformat(),
+            'interval_end': range_start.isoformat()
+        })])
+        backfill = StageTimer()
+        with backfill:
+            results = run_backfill(interval_minutes, aggregator=ServiceMetricsAggregator(
+                storage=storage, processes=options['processes'], classify=options['classify'],
+                duplicate_index=create_duplicate_index(options, directory, 'backfill_duplicates')))
+        stages['run_backfill'] = backfill.report(count)
+        stages['run_backfill']['intervals'] = len(results)
+        stages['run_backfill']['failed_intervals'] = sum(not result['success'] for result in results)
+        stages['run_backfill']['pipeline_stats'] = results.stats.to_dict()
+
+        aggregator = ServiceMetricsAggregator(engine=options['engine'], storage=storage, classify=options['classify'],
+                                              duplicate_index=create_duplicate_index(options, directory, 'duplicates'))
+        fetch = StageTimer()
+        with fetch:
+            docs = list(aggregator.fetch_requests_data(range_start, range_end))
+        stages['fetch_requests_data'] = fetch.report(len(docs))
+
+        calculate = StageTimer()
+        interval_metrics = []
+        for (start_time, end_time), group in aggregator.group_requests_by_interval(docs, intervals):
+            group = list(group)
+            with calculate:
+                metrics = aggregator.calculate_metrics(group)
+            interval_metrics.append((start_time, end_time, metrics))
+        stages['calculate_metrics'] = calculate.report(len(docs))
+        del docs
+
+        save = StageTimer()
+        for start_time, end_time, metrics in interval_metrics:
+            with save:
+                aggregator.save_metrics(metrics, start_time, end_time,
+                                        custom_id=aggregator.custom_doc_id(start_time, end_time))
+        with save:
+            aggregator.sink.drain()
+        stages['save_metrics'] = save.report(len(interval_metrics))
+
+    return {
+        'requests': count,
+        'intervals': len(intervals),
+        'arrival_rate_per_minute': round(rate, 3),
+        'peak_rss_bytes': peak_rss_bytes(),
+        'stages': stages
+    }
+
+def run_benchmarks(sizes, options, in_process=False):
+    """Benchmark each size, in its own spawned process unless `in_process` (e.g. under a profiler)"""
+    runs = []
+    for count in sizes:
+        if in_process:
+            runs.append(benchmark_size(count, options))
+            continue
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            runs.append(executor.submit(benchmark_size, count, options).result())
+    return runs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma-separated request counts to benchmark')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='arrivals per minute (default: spread each workload over --days)')
+    parser.add_argument('--days', type=float, default=1.0, help='history covered when --rate is not given')
+    parser.add_argument('--status-mix', default='pending=0.2,active=0.3,closed=0.5',
+                        help='status weights, e.g. pending=0.1,active=0.2,closed=0.7')
+    parser.add_argument('--technicians', type=int, default=10, help='number of technicians')
+    parser.add_argument('--technician-skew', type=float, default=1.0,
+                        help='Zipf exponent of technician popularity (0 = uniform)')
+    parser.add_argument('--accept-delay', default='exponential:300',
+                        help='accept delay distribution: exponential|lognormal|fixed:<mean seconds>[:<sigma>]')
+    parser.add_argument('--close-delay', default='lognormal:3600:1.0',
+                        help='close delay (after accept) distribution, same format as --accept-delay')
+    parser.add_argument('--interval', type=int, default=15, help='aggregation interval in minutes')
+    parser.add_argument('--engine', default='columnar', help='metrics engine for the calculate stage')
+    parser.add_argument('--storage', choices=('memory', 'sqlite'), default='memory', help='storage backend')
+    parser.add_argument('--latency-ms', type=float, default=0, help='simulated round trip for memory storage')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='shard run_backfill across worker processes (needs --storage sqlite)')
+    parser.add_argument('--classify', action='store_true', help='classify complaints from requestDetails')
+    parser.add_argument('--dedup', action='store_true', help='flag near-duplicate requestDetails with a fresh index')
+    parser.add_argument('--dedup-window', type=float, default=24, help='duplicate window in hours')
+    parser.add_argument('--details-pool', type=int, default=None,
+                        help='distinct requestDetails descriptions (default: nearly every request unique)')
+    parser.add_argument('--customers', type=int, default=10000, help='distinct request authors')
+    parser.add_argument('--repeat-share', type=float, default=0.0,
+                        help='share of requests resubmitting a recent request by the same author')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--in-process', action='store_true',
+                        help='run every size in this process (peak RSS is then cumulative)')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    options = {
+        'rate': args.rate,
+        'days': args.days,
+        'status_mix': parse_status_mix(args.status_mix),
+        'technicians': args.technicians,
+        'technician_skew': args.technician_skew,
+        'accept_delay': parse_delay(args.accept_delay),
+        'close_delay': parse_delay(args.close_delay),
+        'interval_minutes': args.interval,
+        'engine': args.engine,
+        'storage': args.storage,
+        'latency_ms': args.latency_ms,
+        'processes': args.processes,
+        'classify': args.classify,
+        'dedup': args.dedup,
+        'dedup_window_hours': args.dedup_window,
+        'details_pool': args.details_pool,
+        'customers': args.customers,
+        'repeat_share': args.repeat_share,
+        'seed': args.seed
+    }
+    report = {
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'options': options,
+        'runs': run_benchmarks(sizes, options, args.in_process)
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        for run in report['runs']:
+            stages = run['stages']
+            print(f"{run['requests']:>9} requests: backfill {stages['run_backfill']['seconds']:8.2f}s, "
+                  f"fetch {stages['fetch_requests_data']['seconds']:7.2f}s, "
+                  f"calculate {stages['calculate_metrics']['seconds']:7.2f}s, "
+                  f"save {stages['save_metrics']['seconds']:6.2f}s, "
+                  f"peak RSS {run['peak_rss_bytes'] / 2 ** 20:7.0f} MiB")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
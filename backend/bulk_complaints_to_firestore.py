@@ -1,6 +1,9 @@
 import firebase_admin
 from firebase_admin import credentials, firestore
+import argparse
 import csv
+import itertools
+import json
 import random
 import time
 from datetime import datetime, timezone
@@ -38,45 +41,183 @@ db = firestore.client()
 BATCH_SIZE = 5
 SLEEP_SECONDS = 120  # 2 minutes
 
+# Streaming ingest defaults: documents per WriteBatch (Firestore max 500), target docs/sec
+STREAM_BATCH_SIZE = 500
+STREAM_RATE = 500
+CHECKPOINT_PATH = os.path.join("Data", "bulk_ingest_checkpoint.json")
+
+# Formats tried, in order, when reading historical timestamps from the CSV
+TIMESTAMP_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%d-%m-%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%Y-%m-%d", "%d-%m-%Y"]
+
+def positive_rate(value):
+    """argparse type for --rate: docs/sec must be a positive number"""
+    rate = float(value)
+    if not rate > 0:
+        raise argparse.ArgumentTypeError(f"rate must be positive, got {value}")
+    return rate
+
 def random_id(prefix, length=8):
     return f"{prefix}_{random.randint(10000000, 99999999)}"
 
-def main():
+def author_id(author_name):
+    """Stable ID per author, so a customer's repeated complaints share one authorId"""
+    return f"test_user_{10000000 + AUTHOR_NAMES.index(author_name)}"
+
+def read_rows(start_row=0):
+    """Lazily yield (row_number, row) from the CSV, skipping rows before start_row"""
     with open(CSV_PATH, newline='', encoding='utf-8') as csvfile:
         reader = csv.DictReader(csvfile)
-        rows = list(reader)
+        yield from itertools.islice(enumerate(reader), start_row, None)
+
+def parse_timestamp(value):
+    """Parse a CSV timestamp; naive values are taken as UTC. Empty values return None."""
+    value = (value or '').strip()
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        for fmt in TIMESTAMP_FORMATS:
+            try:
+                parsed = datetime.strptime(value, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError(f"Unrecognised timestamp: {value!r}")
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def build_request(row, timestamp_columns=None):
+    """Build a request document from a CSV row.
+
+    With `timestamp_columns` (created, accepted, closed column names) the
+    timestamps come from the row and the status follows from them;
+    otherwise every timestamp is now and the status is random.
+    """
+    author_name = random.choice(AUTHOR_NAMES)
+    technician_name = random.choice(TECHNICIAN_NAMES)
+    if timestamp_columns:
+        created_col, accepted_col, closed_col = timestamp_columns
+        created = parse_timestamp(row.get(created_col))
+        accepted = parse_timestamp(row.get(accepted_col)) if accepted_col else None
+        closed = parse_timestamp(row.get(closed_col)) if closed_col else None
+        if created is None:
+            raise ValueError(f"Missing {created_col}")
+        status = "closed" if closed else "active" if accepted else "pending"
+    else:
+        now = datetime.now(timezone.utc)
+        status = random.choice(["active", "closed"])
+        created = now
+        accepted = now if status in ["active", "closed"] else None
+        closed = now if status == "closed" else None
+    assigned = status != "pending"
+    return {
+        "acceptedAt": accepted,
+        "authorId": author_id(author_name),
+        "authorName": author_name,
+        "closedAt": closed,
+        "createdAt": created,
+        "updatedAt": firestore.SERVER_TIMESTAMP,
+        "requestDetails": row["Description"],
+        "status": status,
+        "technicianId": random_id("tech") if assigned else None,
+        "technicianName": technician_name if assigned else None
+    }
 
-    total = len(rows)
-    print(f"Total rows in CSV: {total}")
-    i = 0
+def load_checkpoint(path):
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f).get("rows_committed", 0)
+    return 0
+
+def save_checkpoint(path, rows_committed):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"rows_committed": rows_committed, "updated_at": datetime.now(timezone.utc).isoformat()}, f)
+    os.replace(tmp_path, path)
+
+def run_trickle():
+    """Original demo mode: write BATCH_SIZE rows, then sleep SLEEP_SECONDS, with all timestamps set to now"""
+    rows = read_rows()
     batch_num = 1
-    while i < total:
-        batch = rows[i:i+BATCH_SIZE]
-        print(f"\nBatch {batch_num}: Writing rows {i+1} to {min(i+BATCH_SIZE, total)}...")
-        for row in batch:
-            now = datetime.now(timezone.utc)
-            status = random.choice(["active", "closed"])
-            author_name = random.choice(AUTHOR_NAMES)
-            technician_name = random.choice(TECHNICIAN_NAMES)
-            doc = {
-                "acceptedAt": now if status in ["active", "closed"] else None,
-                "authorId": random_id("test_user"),
-                "authorName": author_name,
-                "closedAt": now if status == "closed" else None,
-                "createdAt": now,
-                "requestDetails": row["Description"],
-                "status": status,
-                "technicianId": random_id("tech"),
-                "technicianName": technician_name
-            }
+    while True:
+        batch = list(itertools.islice(rows, BATCH_SIZE))
+        if not batch:
+            break
+        print(f"\nBatch {batch_num}: Writing rows {batch[0][0]+1} to {batch[-1][0]+1}...")
+        for _, row in batch:
+            doc = build_request(row)
             db.collection("requests").add(doc)
-            print(f"  Added request for {author_name} ({status}) with technician {technician_name}")
-        i += BATCH_SIZE
+            print(f"  Added request for {doc['authorName']} ({doc['status']}) with technician {doc['technicianName']}")
         batch_num += 1
-        if i < total:
+        if len(batch) == BATCH_SIZE:
             print(f"Sleeping for {SLEEP_SECONDS} seconds before next batch...")
             time.sleep(SLEEP_SECONDS)
     print("\nAll rows written to Firestore.")
 
+def run_stream(rate=STREAM_RATE, batch_size=STREAM_BATCH_SIZE, checkpoint_path=CHECKPOINT_PATH,
+               timestamp_columns=None):
+    """Stream the CSV into Firestore in WriteBatches paced to `rate` docs/sec.
+
+    The committed row offset is checkpointed after every batch, so a rerun
+    resumes where a crash left off. Document IDs derive from the row number,
+    which makes replaying a batch that committed before its checkpoint was
+    saved overwrite the same documents instead of duplicating them.
+    """
+    start_row = load_checkpoint(checkpoint_path)
+    if start_row:
+        print(f"Resuming from row {start_row + 1}")
+    rows = read_rows(start_row)
+    committed = start_row
+    written = 0
+    started = time.monotonic()
+    while True:
+        chunk = list(itertools.islice(rows, batch_size))
+        if not chunk:
+            break
+        batch = db.batch()
+        for row_number, row in chunk:
+            try:
+                doc = build_request(row, timestamp_columns)
+            except ValueError as e:
+                print(f"  Skipping row {row_number + 1}: {e}")
+                continue
+            batch.set(db.collection("requests").document(f"complaint_{row_number:08d}"), doc)
+            written += 1
+        # A chunk of only skipped rows leaves nothing to write, but its offset is still checkpointed
+        if len(batch):
+            batch.commit()
+        committed = chunk[-1][0] + 1
+        save_checkpoint(checkpoint_path, committed)
+
+        # Pace to the target rate: sleep until the elapsed time catches up with what was written
+        elapsed = time.monotonic() - started
+        ahead = written / rate - elapsed
+        if ahead > 0:
+            time.sleep(ahead)
+        elapsed = max(time.monotonic() - started, 1e-9)
+        print(f"Committed rows up to {committed} ({written} docs, {written / elapsed:.0f} docs/sec)")
+    print(f"\nAll rows written to Firestore ({written} docs this run).")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load complaint descriptions from CSV into the requests collection")
+    parser.add_argument("--mode", choices=["trickle", "stream"], default="trickle",
+                        help="trickle: 5 rows every 2 minutes (demo); stream: batched, rate-limited bulk ingest")
+    parser.add_argument("--rate", type=positive_rate, default=STREAM_RATE, help="target docs/sec in stream mode")
+    parser.add_argument("--batch-size", type=int, default=STREAM_BATCH_SIZE, help="documents per batch commit (max 500)")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="file recording the committed row offset")
+    parser.add_argument("--created-column", help="CSV column with the historical createdAt")
+    parser.add_argument("--accepted-column", help="CSV column with the historical acceptedAt")
+    parser.add_argument("--closed-column", help="CSV column with the historical closedAt")
+    args = parser.parse_args()
+
+    if args.mode == "trickle":
+        run_trickle()
+        return
+    timestamp_columns = None
+    if args.created_column:
+        timestamp_columns = (args.created_column, args.accepted_column, args.closed_column)
+    run_stream(args.rate, min(args.batch_size, 500), args.checkpoint, timestamp_columns)
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
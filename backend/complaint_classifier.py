@@ -0,0 +1,209 @@
+"""Local complaint categorization of request descriptions (requestDetails).
+
+A small TF-IDF model over hand-picked keywords and phrases per category.
+Each category's keywords form one prototype document. Descriptions become
+unigram + bigram TF-IDF vectors over that vocabulary, and a whole batch is
+scored against every prototype with one matrix product, so no network
+calls or training data are needed. Extend CATEGORY_KEYWORDS to tune it.
+
+Results are cached by a hash of the text in a bounded LRU, so
+re-aggregating an interval never reclassifies a description already seen.
+
+    classifier = ComplaintClassifier()
+    classifier.classify(['Brakes squeal when stopping', 'AC not cooling'])  # ['brakes', 'air_conditioning']
+"""
+import functools
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Keywords and short phrases per category; matching is on lowercased, suffix-stripped words.
+# A phrase only matches as a whole, so 'pulls right' adds nothing for a lone 'right'
+CATEGORY_KEYWORDS = {
+    'engine': [
+        'engine', 'motor', 'misfire', 'knocking', 'overheating', 'overheat', 'coolant', 'radiator', 'smoke',
+        'exhaust', 'oil leak', 'oil consumption', 'stalling', 'stall', 'idle', 'rpm', 'pickup', 'power loss',
+        'turbo', 'check engine', 'spark plug', 'timing belt', 'head gasket', 'piston', 'cylinder'
+    ],
+    'brakes': [
+        'brake', 'braking', 'brake pad', 'brake pedal', 'brake fluid', 'disc', 'rotor', 'caliper', 'abs',
+        'squeal', 'squeaking', 'handbrake', 'parking brake', 'stopping distance', 'spongy pedal'
+    ],
+    'electrical': [
+        'battery', 'batteries', 'alternator', 'starter', 'wiring', 'fuse', 'short circuit', 'headlight',
+        'headlamp', 'tail light', 'indicator', 'horn', 'power window', 'central locking', 'sensor',
+        'warning light', 'dashboard light', 'electrical', 'self start', 'not starting', 'dead battery', 'ecu'
+    ],
+    'transmission': [
+        'gear', 'gearbox', 'clutch', 'transmission', 'shifting', 'gear shift', 'gear slipping', 'automatic',
+        'manual', 'amt', 'cvt', 'clutch plate', 'jerk', 'jerking', 'reverse gear', 'neutral'
+    ],
+    'suspension_steering': [
+        'suspension', 'shock absorber', 'strut', 'steering', 'steering wheel', 'power steering', 'alignment',
+        'wheel alignment', 'pulls to', 'pulls left', 'pulls right', 'vibration', 'wobble', 'bush', 'bushing',
+        'ball joint', 'tie rod', 'clunk', 'bumpy ride'
+    ],
+    'air_conditioning': [
+        'ac', 'air conditioning', 'air conditioner', 'cooling', 'not cooling', 'blower', 'heater', 'hvac',
+        'compressor', 'refrigerant', 'gas refill', 'climate control', 'defogger', 'vent'
+    ],
+    'tyres_wheels': [
+        'tyre', 'tyres', 'tire', 'tires', 'puncture', 'flat tyre', 'wheel', 'rim', 'tread', 'tyre pressure',
+        'wheel balancing', 'alloy', 'spare wheel', 'tpms'
+    ],
+    'fuel_system': [
+        'fuel', 'mileage', 'fuel efficiency', 'fuel pump', 'fuel injector', 'injector', 'fuel tank',
+        'fuel gauge', 'petrol', 'diesel', 'cng', 'fuel leak', 'filter', 'fuel filter', 'average'
+    ],
+    'body_interior': [
+        'body', 'paint', 'rust', 'dent', 'scratch', 'door', 'window', 'windshield', 'wiper', 'mirror',
+        'seat', 'seat belt', 'upholstery', 'interior', 'rattle', 'rattling', 'water leak', 'leakage', 'boot',
+        'bonnet', 'bumper', 'sunroof', 'lock'
+    ],
+    'infotainment': [
+        'infotainment', 'touchscreen', 'touch screen', 'music system', 'speaker', 'bluetooth', 'android auto',
+        'apple carplay', 'navigation', 'gps', 'usb', 'radio', 'display', 'camera', 'reverse camera', 'app',
+        'connectivity', 'software update'
+    ],
+    'service_experience': [
+        'service', 'dealer', 'dealership', 'service center', 'workshop', 'delay', 'delayed', 'waiting',
+        'appointment', 'overcharged', 'billing', 'invoice', 'cost', 'warranty', 'refund', 'spare parts',
+        'parts not available', 'staff', 'rude', 'response', 'customer care', 'follow up'
+    ],
+}
+
+# Category for requests without a description, and for descriptions matching no keyword well enough
+UNKNOWN_CATEGORY = 'unknown'
+OTHER_CATEGORY = 'other'
+
+# Lowest cosine similarity to a prototype that still assigns its category
+MIN_SCORE = 0.05
+
+# Descriptions kept in the LRU cache, and texts vectorized per matrix product
+CACHE_SIZE = int(os.environ.get('CLASSIFIER_CACHE_SIZE', 100000))
+BATCH_SIZE = 2048
+
+# Words may contain digits ('4x4') but bare numbers such as odometer readings are skipped
+TOKEN_PATTERN = re.compile(r'[a-z][a-z0-9]*')
+
+# Words too common to count on their own; they still take part in bigrams like 'not cooling'
+STOP_WORDS = frozenset(('a', 'an', 'and', 'at', 'for', 'from', 'in', 'is', 'it', 'my', 'not', 'of', 'on', 'the', 'to',
+                        'up', 'when', 'with'))
+
+@functools.lru_cache(maxsize=65536)
+def normalize_token(token):
+    """Crude suffix stripping so 'brake', 'brakes', 'braking' and 'braked' share a term"""
+    for suffix in ('ing', 'ed', 'es', 'e', 's'):
+        if len(token) > len(suffix) + 2 and token.endswith(suffix):
+            return token[:-len(suffix)]
+    return token
+
+def text_terms(text):
+    """Unigram (minus STOP_WORDS) and bigram terms of a text"""
+    tokens = [normalize_token(token) for token in TOKEN_PATTERN.findall(text.lower())]
+    return ([token for token in tokens if token not in STOP_WORDS]
+            + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])])
+
+class ComplaintClassifier:
+    """Batched TF-IDF keyword classifier with a thread-safe LRU cache keyed by text hash"""
+
+    def __init__(self, categories=None, cache_size=CACHE_SIZE, min_score=MIN_SCORE):
+        categories = categories or CATEGORY_KEYWORDS
+        self.labels = list(categories)
+        self.vocabulary = {}
+        prototype_terms = []
+        for keywords in categories.values():
+            terms = [term for keyword in keywords for term in text_terms(keyword)
+                     if ' ' in term or ' ' not in keyword.strip()]
+            for term in terms:
+                self.vocabulary.setdefault(term, len(self.vocabulary))
+            prototype_terms.append(terms)
+
+        # Terms shared by several categories discriminate less, so they get a lower IDF
+        present = np.zeros((len(self.labels), len(self.vocabulary)), dtype=bool)
+        for row, terms in enumerate(prototype_terms):
+            present[row, [self.vocabulary[term] for term in terms]] = True
+        self.idf = np.log((1 + len(self.labels)) / (1 + present.sum(axis=0))) + 1
+        prototypes = present * self.idf
+        self.prototypes = prototypes / np.linalg.norm(prototypes, axis=1, keepdims=True)
+
+        # First words of the vocabulary's bigrams; no other bigram can match, so none are built
+        self.bigram_heads = frozenset(term.split(' ')[0] for term in self.vocabulary if ' ' in term)
+
+        self.min_score = min_score
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def score(self, texts):
+        """Cosine similarity of each text's TF-IDF vector to each category prototype (texts x categories)"""
+        vocabulary, heads = self.vocabulary, self.bigram_heads
+        rows, columns = [], []
+        for row, text in enumerate(texts):
+            tokens = [normalize_token(token) for token in TOKEN_PATTERN.findall(text.lower())]
+            # Same terms as text_terms, skipping bigrams that cannot be in the vocabulary
+            terms = [token for token in tokens if token not in STOP_WORDS]
+            terms += [f"{first} {second}" for first, second in zip(tokens, tokens[1:]) if first in heads]
+            matched = [vocabulary[term] for term in terms if term in vocabulary]
+            columns += matched
+            rows += [row] * len(matched)
+        size = len(self.vocabulary)
+        counts = np.bincount(np.array(rows, dtype=np.int64) * size + np.array(columns, dtype=np.int64),
+                             minlength=len(texts) * size).reshape(len(texts), size)
+        weights = np.log1p(counts) * self.idf
+        norms = np.linalg.norm(weights, axis=1, keepdims=True)
+        weights /= np.where(norms > 0, norms, 1)
+        return weights @ self.prototypes.T
+
+    def predict(self, texts):
+        """Uncached categories of non-empty texts, vectorized BATCH_SIZE at a time"""
+        categories = []
+        for start in range(0, len(texts), BATCH_SIZE):
+            scores = self.score(texts[start:start + BATCH_SIZE])
+            best = scores.argmax(axis=1)
+            confident = scores[np.arange(best.size), best] >= self.min_score
+            categories.extend(self.labels[code] if ok else OTHER_CATEGORY
+                              for code, ok in zip(best.tolist(), confident.tolist()))
+        return categories
+
+    def classify(self, texts, run_stats=None):
+        """Category of each text; missing or blank texts are UNKNOWN_CATEGORY.
+
+        Cached texts are answered from the LRU and the distinct rest are
+        scored in one batch. With `run_stats` (a RunStats), cache hits and
+        newly classified texts are counted.
+        """
+        results = [UNKNOWN_CATEGORY] * len(texts)
+        misses = {}
+        hits = 0
+        with self.lock:
+            for index, text in enumerate(texts):
+                if not isinstance(text, str) or not text.strip():
+                    continue
+                key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+                category = self.cache.get(key)
+                if category is None:
+                    misses.setdefault(key, (text, []))[1].append(index)
+                else:
+                    self.cache.move_to_end(key)
+                    results[index] = category
+                    hits += 1
+
+        if misses:
+            categories = self.predict([text for text, _ in misses.values()])
+            with self.lock:
+                for (key, (_, indexes)), category in zip(misses.items(), categories):
+                    self.cache[key] = category
+                    for index in indexes:
+                        results[index] = category
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        if run_stats is not None:
+            run_stats.count('classifier_cache_hits', hits + sum(len(indexes) - 1 for _, indexes in misses.values()))
+            run_stats.count('texts_classified', len(misses))
+        return results
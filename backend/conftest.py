@@ -0,0 +1,46 @@
+"""Shared pytest fixtures: a clean pipeline environment and a synthetic workload in InMemoryStorage"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from aggregation_pipeline import ServiceMetricsAggregator, get_interval_start, get_missed_intervals
+from metrics_storage import InMemoryStorage
+from workload_generator import WorkloadGenerator
+
+# Settings read from the environment that would change what the pipeline under test does
+PIPELINE_ENV = ('AGGREGATION_INTERVAL_MINUTES', 'AGGREGATION_MODE', 'AGGREGATION_PROCESSES', 'AGGREGATION_RESOLUTIONS',
+                'CLASSIFY_COMPLAINTS', 'DUPLICATE_AUTHOR_SCOPED', 'DUPLICATE_INDEX', 'DUPLICATE_WINDOW_HOURS',
+                'INTERVAL_START', 'METRICS_STORAGE', 'PIPELINE_STATS_FILE', 'PROFILE_COMPUTE')
+
+WORKLOAD_SIZE = 2000
+
+def make_aggregator(storage, **options):
+    """An aggregator that ignores the environment: no extra series, classification or duplicate index"""
+    return ServiceMetricsAggregator(storage=storage, **{'resolutions': (), 'classify': False,
+                                                       'duplicate_index': False, **options})
+
+@pytest.fixture(autouse=True)
+def clean_env(monkeypatch):
+    for name in PIPELINE_ENV:
+        monkeypatch.delenv(name, raising=False)
+
+@pytest.fixture
+def now():
+    return datetime.now(timezone.utc)
+
+@pytest.fixture
+def workload(now):
+    """{doc_id: request} arriving 10 a minute over the hours before now, 10% of them resubmitted"""
+    return WorkloadGenerator(arrival_rate=10, seed=11, customer_count=500, repeat_share=0.1).generate(WORKLOAD_SIZE, now)
+
+@pytest.fixture
+def storage(workload):
+    storage = InMemoryStorage()
+    storage.put_requests(workload)
+    return storage
+
+@pytest.fixture
+def intervals(workload, now):
+    """The whole 15-minute intervals covering the workload, up to the one holding now"""
+    first = get_interval_start(min(data['createdAt'] for data in workload.values()), 15)
+    return get_missed_intervals(first, get_interval_start(now, 15) + timedelta(minutes=15), 15)
@@ -39,6 +39,7 @@ def create_test_request():
             'requestDetails': 'Manual test request for aggregation testing (IST timezone)',
             'status': 'pending',
             'createdAt': request_time,
+            'updatedAt': firestore.SERVER_TIMESTAMP,
             'acceptedAt': None,
             'closedAt': None,
             'technicianId': None,
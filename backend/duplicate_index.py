@@ -0,0 +1,426 @@
+"""Incremental near-duplicate detection over request descriptions (requestDetails).
+
+Each description is reduced to a MinHash signature over its word unigrams
+and bigrams, so two signatures agree in about the Jaccard similarity of the
+two word sets. When requests carry an author and the index is
+`author_scoped` (the default), the author is mixed into every shingle, so
+only requests from the same author can match. The signature is cut into LSH bands. Requests whose band
+values collide with an earlier request are candidates, and a candidate
+counts as a near-duplicate when at least SIMILARITY_THRESHOLD of the two
+signatures agree. No two texts are ever compared directly.
+
+The bands of every indexed request are kept sorted in two levels of NumPy
+arrays: a large `base` and a small `recent` log that is merged into it once
+it grows past a fraction of the base. A new request is looked up with one
+binary search per band in the base and its predecessor in the recent log,
+so each lookup checks at most two candidates per band however large the
+index gets. Whole batches are hashed and looked up with vectorized
+operations.
+
+A request is flagged when it is similar to an earlier request created at
+most `window_hours` before it. Each request is checked once, the first time
+the index sees it, and its flag is sticky. Requests older than the window
+behind the newest indexed request can no longer be checked and count as
+unique. Indexed and flagged requests leaving the window are dropped when
+the index is saved, so the index stays about one window in size.
+
+The index lives in a local directory:
+
+    <root>/index.json                  parameters, row count, generation, newest createdAt
+    <root>/signatures.3.npy            uint32 MinHash signatures, one row per indexed request
+    <root>/created.3.npy               float64 createdAt epoch seconds
+    <root>/ids.3.npy                   request IDs
+    <root>/duplicates.3.json           flagged request ID -> [ID of the request it repeats, createdAt]
+
+    index = DuplicateIndex('/data/duplicates', window_hours=24)
+    index.check(['req_1', 'req_2'], ['AC not cooling', 'AC not cooling!'], [t0, t0 + 60],
+                authors=['user_1', 'user_1'])  # [False, True]
+    index.save()
+"""
+import json
+import os
+import threading
+import zlib
+
+import numpy as np
+
+from metrics_storage import write_json
+
+# MinHash signature length, split into LSH_BANDS bands of NUM_PERM // LSH_BANDS rows.
+# With 16 bands of 4 rows, a pair at 0.7 similarity becomes a candidate 99% of the time
+NUM_PERM = 64
+LSH_BANDS = 16
+BAND_ROWS = NUM_PERM // LSH_BANDS
+
+# Share of agreeing signature values (estimated Jaccard similarity) that makes a candidate a near-duplicate
+SIMILARITY_THRESHOLD = 0.7
+
+# How far back a request can find the one it repeats
+DEFAULT_WINDOW_HOURS = 24
+
+# Seeds the hash functions; signatures persisted under another seed cannot be compared
+MINHASH_SEED = 1729
+
+# Descriptions hashed per vectorized chunk, which bounds the temporary (NUM_PERM x shingles) matrix
+HASH_CHUNK_SIZE = 2048
+
+# The recent log is merged into the base once it holds this share of the base (or RECENT_MIN_ROWS);
+# each batch rewrites the log and each merge the base, so a small share keeps both cheap
+RECENT_MERGE_FRACTION = 1 / 32
+RECENT_MIN_ROWS = 2048
+
+INDEX_STATE_FILE = 'index.json'
+
+# Words are runs of ASCII letters and digits or of non-ASCII (UTF-8) bytes, matched after ASCII lowercasing
+WORD_BYTES = np.zeros(256, dtype=bool)
+WORD_BYTES[[*range(ord('a'), ord('z') + 1), *range(ord('0'), ord('9') + 1), *range(128, 256)]] = True
+
+# Odd base of the polynomial word hash, so its powers have inverses modulo 2^64
+WORD_HASH_BASE = 0x100000001B3
+
+class DuplicateIndex:
+    """MinHash/LSH index of recent request descriptions, persisted under `root`"""
+
+    def __init__(self, root, window_hours=DEFAULT_WINDOW_HOURS, threshold=SIMILARITY_THRESHOLD, author_scoped=True):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.window_seconds = window_hours * 3600
+        self.threshold = threshold
+        self.author_scoped = author_scoped
+        self.lock = threading.Lock()
+
+        # Multiply-shift hash functions: the top 32 bits of (a * x + b) mod 2^64 with odd a
+        rng = np.random.default_rng(MINHASH_SEED)
+        self.multipliers = rng.integers(0, 2 ** 64, NUM_PERM, dtype=np.uint64) | np.uint64(1)
+        self.increments = rng.integers(0, 2 ** 64, NUM_PERM, dtype=np.uint64)
+        self.band_multipliers = rng.integers(0, 2 ** 64, BAND_ROWS, dtype=np.uint64) | np.uint64(1)
+
+        self.size = 0
+        self.signatures = np.empty((0, NUM_PERM), dtype=np.uint32)
+        self.created = np.empty(0, dtype=np.float64)
+        self.ids = []
+        self.slots = {}       # indexed request ID -> row
+        self.duplicates = {}  # flagged request ID -> ID of the first request it repeats
+        self.flagged_at = {}  # flagged request ID -> createdAt epoch seconds
+        self.newest = -np.inf
+        self.base_keys, self.base_slots = self._empty_level()
+        self.recent_keys, self.recent_slots = self._empty_level()
+        self.generation = 0
+        self.dirty = False
+        self.powers = self.inverse_powers = np.ones(0, dtype=np.uint64)
+        self.load()
+
+    @staticmethod
+    def _empty_level():
+        return np.empty((LSH_BANDS, 0), dtype=np.uint64), np.empty((LSH_BANDS, 0), dtype=np.int64)
+
+    @staticmethod
+    def _merge_sorted(keys, slots, new_keys, new_slots):
+        """Merge sorted new keys after equal ones in sorted `keys`; returns merged keys, slots and new positions"""
+        positions = np.searchsorted(keys, new_keys, side='right') + np.arange(new_keys.size)
+        is_new = np.zeros(keys.size + new_keys.size, dtype=bool)
+        is_new[positions] = True
+        merged_keys = np.empty(is_new.size, dtype=np.uint64)
+        merged_slots = np.empty(is_new.size, dtype=np.int64)
+        merged_keys[positions], merged_keys[~is_new] = new_keys, keys
+        merged_slots[positions], merged_slots[~is_new] = new_slots, slots
+        return merged_keys, merged_slots, positions
+
+    def hash_powers(self, size):
+        """WORD_HASH_BASE to the powers 0..size-1 and their inverses modulo 2^64, grown on demand"""
+        if self.powers.size < size:
+            size = max(size, 2 * self.powers.size)
+            self.powers, self.inverse_powers = (
+                np.concatenate([[np.uint64(1)], np.cumprod(np.full(size - 1, base, dtype=np.uint64))])
+                for base in (WORD_HASH_BASE, pow(WORD_HASH_BASE, -1, 2 ** 64)))
+        return self.powers, self.inverse_powers
+
+    def word_hashes(self, texts):
+        """64-bit hashes of the words of `texts` in order, and the index of the text each belongs to"""
+        encoded = [text.encode() for text in texts]
+        data = np.frombuffer(b'\n'.join(encoded).lower(), dtype=np.uint8)
+        text_starts = np.cumsum([0] + [len(text) + 1 for text in encoded[:-1]])
+        edges = np.diff(np.concatenate([[False], WORD_BYTES[data], [False]]).astype(np.int8))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        owners = np.searchsorted(text_starts, starts, side='right') - 1
+        # sum(c_j * base^(end-1-j)) for each word, from one prefix sum of c_j * base^-j
+        powers, inverse_powers = self.hash_powers(data.size)
+        prefix = np.concatenate([[np.uint64(0)], np.cumsum(data * inverse_powers[:data.size], dtype=np.uint64)])
+        words = (prefix[ends] - prefix[starts]) * powers[ends - 1]
+        # splitmix64 finalizer, so similar words get unrelated hashes
+        words ^= words >> np.uint64(30)
+        words *= np.uint64(0xBF58476D1CE4E5B9)
+        words ^= words >> np.uint64(27)
+        words *= np.uint64(0x94D049BB133111EB)
+        words ^= words >> np.uint64(31)
+        return words, owners
+
+    def signatures_of(self, texts, authors=None):
+        """MinHash signatures (len(texts) x NUM_PERM uint32) over word unigrams and bigrams.
+
+        With `authors`, each text's shingles are salted with its author, so
+        texts of different authors share none. Texts without words get a
+        signature of all 0xFFFFFFFF.
+        """
+        signatures = np.full((len(texts), NUM_PERM), np.iinfo(np.uint32).max, dtype=np.uint32)
+        for chunk_start in range(0, len(texts), HASH_CHUNK_SIZE):
+            chunk = slice(chunk_start, chunk_start + HASH_CHUNK_SIZE)
+            tokens, owners = self.word_hashes(texts[chunk])
+            if not tokens.size:
+                continue
+            # A bigram joins two consecutive tokens of the same text
+            same_text = owners[:-1] == owners[1:]
+            bigrams = (tokens[:-1][same_text] * np.uint64(0x9E3779B1) + tokens[1:][same_text]) ^ np.uint64(1 << 40)
+            shingles = np.concatenate([tokens, bigrams])
+            shingle_owners = np.concatenate([owners, owners[:-1][same_text]])
+            if authors is not None:
+                salts = np.array([zlib.crc32(str(author).encode()) if author else 0 for author in authors[chunk]],
+                                 dtype=np.uint64)
+                shingles ^= salts[shingle_owners] * np.uint64(0x9E3779B97F4A7C15)
+            order = np.argsort(shingle_owners, kind='stable')
+            shingles, shingle_owners = shingles[order], shingle_owners[order]
+            hashed = (self.multipliers[:, None] * shingles[None, :] + self.increments[:, None]) >> np.uint64(32)
+            starts = np.flatnonzero(np.concatenate([[True], shingle_owners[1:] != shingle_owners[:-1]]))
+            signatures[chunk_start + shingle_owners[starts]] = np.minimum.reduceat(hashed, starts, axis=1).T
+        return signatures
+
+    def band_keys(self, signatures):
+        """One uint64 key per LSH band of each signature (rows x LSH_BANDS)"""
+        bands = signatures.reshape(len(signatures), LSH_BANDS, BAND_ROWS).astype(np.uint64)
+        return (bands * self.band_multipliers).sum(axis=2, dtype=np.uint64)
+
+    def check(self, ids, texts, created, authors=None, run_stats=None):
+        """Flag which of the given requests repeat an earlier one; returns a bool array in input order.
+
+        `created` holds createdAt epoch seconds (NaN when missing) and the
+        optional `authors` who sent each request (None when unknown; ignored
+        unless the index is `author_scoped`). Requests the index has seen before keep their flag. New requests with a
+        description are indexed in createdAt order, so a batch can contain
+        both a request and its repeat. With `run_stats` (a RunStats), new
+        duplicates and verified candidates are counted.
+        """
+        created = np.asarray(created, dtype=np.float64)
+        flags = np.zeros(len(ids), dtype=bool)
+        with self.lock:
+            # NaN compares False, so requests without createdAt are never indexed
+            checkable = (created >= self.newest - self.window_seconds).tolist()
+            new = []
+            for position in np.argsort(created, kind='stable').tolist():
+                request_id = ids[position]
+                if request_id in self.duplicates:
+                    flags[position] = True
+                elif checkable[position] and request_id not in self.slots and isinstance(texts[position], str):
+                    new.append(position)
+            if not new:
+                return flags
+
+            scoped = self.author_scoped and authors is not None
+            signatures = self.signatures_of([texts[position] for position in new],
+                                            [authors[position] for position in new] if scoped else None)
+            has_words = signatures[:, 0] != np.iinfo(np.uint32).max
+            new = [position for position, keep in zip(new, has_words.tolist()) if keep]
+            signatures = signatures[has_words]
+            if not new:
+                return flags
+            first_slot = self.append(new, ids, created, signatures)
+            keys = self.band_keys(signatures)
+            candidates = self.find_candidates(keys, first_slot)
+
+            # Each distinct earlier row within the window is verified once per new row
+            candidates.sort(axis=1)
+            candidates[:, 1:][candidates[:, 1:] == candidates[:, :-1]] = -1
+            rows, columns = np.nonzero(candidates >= 0)
+            pairs = candidates[rows, columns]
+            own_created, candidate_created = self.created[first_slot + rows], self.created[pairs]
+            in_window = (candidate_created <= own_created) & (candidate_created >= own_created - self.window_seconds)
+            rows, pairs = rows[in_window], pairs[in_window]
+            agreement = np.empty(rows.size, dtype=np.int64)
+            for chunk_start in range(0, rows.size, HASH_CHUNK_SIZE):
+                chunk = slice(chunk_start, chunk_start + HASH_CHUNK_SIZE)
+                agreement[chunk] = (self.signatures[pairs[chunk]]
+                                    == self.signatures[first_slot + rows[chunk]]).sum(axis=1)
+            similar = agreement >= self.threshold * NUM_PERM
+            rows, pairs, agreement = rows[similar], pairs[similar], agreement[similar]
+            # The most similar candidate of each row (the oldest on ties), rows in createdAt order
+            # so an earlier duplicate in the batch is resolved first
+            order = np.lexsort((pairs, -agreement, rows))
+            rows, pairs = rows[order], pairs[order]
+            first = np.concatenate([[True], rows[1:] != rows[:-1]]) if rows.size else rows.astype(bool)
+            for row, slot in zip(rows[first].tolist(), pairs[first].tolist()):
+                original = self.ids[slot]
+                self.duplicates[ids[new[row]]] = self.duplicates.get(original, original)
+                self.flagged_at[ids[new[row]]] = float(created[new[row]])
+                flags[new[row]] = True
+            found, checked = int(first.sum()), int(in_window.sum())
+
+            self.newest = max(self.newest, float(created[new].max()))
+            self.dirty = True
+            if self.recent_keys.shape[1] > max(RECENT_MIN_ROWS, RECENT_MERGE_FRACTION * self.base_keys.shape[1]):
+                self.merge_recent()
+        if run_stats is not None:
+            run_stats.count('duplicates_found', found)
+            run_stats.count('dedup_candidates', checked)
+        return flags
+
+    def append(self, positions, ids, created, signatures):
+        """Store new rows (growing the arrays geometrically); returns the first new row"""
+        first_slot, count = self.size, len(positions)
+        if first_slot + count > len(self.created):
+            capacity = max(first_slot + count, 2 * len(self.created), 1024)
+            self.signatures = np.resize(self.signatures, (capacity, NUM_PERM))
+            self.created = np.resize(self.created, capacity)
+        self.signatures[first_slot:first_slot + count] = signatures
+        self.created[first_slot:first_slot + count] = created[positions]
+        for slot, position in enumerate(positions, first_slot):
+            self.ids.append(ids[position])
+            self.slots[ids[position]] = slot
+        self.size += count
+        return first_slot
+
+    def find_candidates(self, keys, first_slot):
+        """Earlier rows sharing a band with each new row (rows x 2 * LSH_BANDS, -1 where none).
+
+        Per band: the newest base row with the same key, found by binary
+        search, and the row before it in the (key, row)-sorted recent log
+        after the new rows are added to it.
+        """
+        count = len(keys)
+        new_slots = np.arange(first_slot, first_slot + count)
+        candidates = np.full((count, 2 * LSH_BANDS), -1, dtype=np.int64)
+        recent_keys = np.empty((LSH_BANDS, self.recent_keys.shape[1] + count), dtype=np.uint64)
+        recent_slots = np.empty(recent_keys.shape, dtype=np.int64)
+        for band in range(LSH_BANDS):
+            band_keys = keys[:, band]
+            key_order = np.argsort(band_keys, kind='stable')
+            sorted_keys = band_keys[key_order]
+            base_keys = self.base_keys[band]
+            if base_keys.size:
+                # Sorted needles let each binary search start where the previous one ended
+                found = np.empty(count, dtype=np.int64)
+                found[key_order] = np.searchsorted(base_keys, sorted_keys, side='right') - 1
+                clipped = np.maximum(found, 0)
+                match = (found >= 0) & (base_keys[clipped] == band_keys)
+                candidates[:, band] = np.where(match, self.base_slots[band][clipped], -1)
+
+            # The new rows come after every logged row, so merging keeps the log sorted by (key, row)
+            merged_keys, merged_slots, sorted_positions = self._merge_sorted(
+                self.recent_keys[band], self.recent_slots[band], sorted_keys, new_slots[key_order])
+            recent_keys[band], recent_slots[band] = merged_keys, merged_slots
+
+            positions = np.empty(count, dtype=np.int64)
+            positions[key_order] = sorted_positions
+            before = np.maximum(positions - 1, 0)
+            match = (positions > 0) & (merged_keys[before] == band_keys)
+            candidates[:, LSH_BANDS + band] = np.where(match, merged_slots[before], -1)
+        self.recent_keys, self.recent_slots = recent_keys, recent_slots
+        return candidates
+
+    def merge_recent(self):
+        """Fold the recent log into the base, first dropping rows that left the window when they are most of it"""
+        expired = self.created[:self.size] < self.newest - self.window_seconds
+        if expired.sum() * 2 > self.size:
+            self.compact(~expired)
+            return
+        base_keys = np.empty((LSH_BANDS, self.base_keys.shape[1] + self.recent_keys.shape[1]), dtype=np.uint64)
+        base_slots = np.empty(base_keys.shape, dtype=np.int64)
+        for band in range(LSH_BANDS):
+            base_keys[band], base_slots[band], _ = self._merge_sorted(
+                self.base_keys[band], self.base_slots[band], self.recent_keys[band], self.recent_slots[band])
+        self.base_keys, self.base_slots = base_keys, base_slots
+        self.recent_keys, self.recent_slots = self._empty_level()
+
+    def compact(self, keep):
+        """Keep only the rows in `keep` and rebuild the base from their signatures"""
+        kept = np.flatnonzero(keep)
+        self.signatures = self.signatures[kept]
+        self.created = self.created[kept]
+        self.ids = [self.ids[slot] for slot in kept.tolist()]
+        self.slots = {request_id: slot for slot, request_id in enumerate(self.ids)}
+        self.size = kept.size
+        self.rebuild()
+
+    def rebuild(self):
+        """Sort every row's band keys into the base and empty the recent log"""
+        keys = self.band_keys(self.signatures[:self.size]).T
+        order = np.argsort(keys, axis=1, kind='stable')
+        self.base_keys = np.take_along_axis(keys, order, axis=1)
+        self.base_slots = order
+        self.recent_keys, self.recent_slots = self._empty_level()
+
+    def duplicate_of(self, request_id):
+        """ID of the request `request_id` repeats, or None"""
+        return self.duplicates.get(request_id)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def load(self):
+        """Read the persisted index, if any"""
+        try:
+            with open(self.path(INDEX_STATE_FILE)) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        if (state['num_perm'], state['bands'], state['seed']) != (NUM_PERM, LSH_BANDS, MINHASH_SEED):
+            raise ValueError(f"Duplicate index at {self.root} uses other MinHash parameters; remove it to rebuild")
+        if state.get('author_scoped', True) != self.author_scoped:
+            raise ValueError(f"Duplicate index at {self.root} was built with author_scoped={not self.author_scoped}; "
+                             f"remove it to rebuild")
+        generation = self.generation = state['generation']
+        self.signatures = np.load(self.path(f"signatures.{generation}.npy"))
+        self.created = np.load(self.path(f"created.{generation}.npy"))
+        self.ids = [request_id.decode() for request_id in np.load(self.path(f"ids.{generation}.npy")).tolist()]
+        with open(self.path(f"duplicates.{generation}.json")) as f:
+            flagged = json.load(f)
+        self.newest = state['newest'] if state['newest'] is not None else -np.inf
+        # Indexes saved before flags were pruned stored only the original's ID; they expire with the newest request
+        self.duplicates = {request_id: value if isinstance(value, str) else value[0]
+                           for request_id, value in flagged.items()}
+        self.flagged_at = {request_id: self.newest if isinstance(value, str) else value[1]
+                           for request_id, value in flagged.items()}
+        self.slots = {request_id: slot for slot, request_id in enumerate(self.ids)}
+        self.size = len(self.ids)
+        self.rebuild()
+
+    def save(self):
+        """Persist the index as a new generation, dropping rows and flags that left the window first"""
+        with self.lock:
+            if not self.dirty:
+                return
+            oldest = self.newest - self.window_seconds
+            expired = self.created[:self.size] < oldest
+            if expired.any():
+                self.compact(~expired)
+            for request_id in [request_id for request_id, created in self.flagged_at.items() if created < oldest]:
+                del self.duplicates[request_id], self.flagged_at[request_id]
+            generation = self.generation + 1
+            np.save(self.path(f"signatures.{generation}.npy"), self.signatures[:self.size])
+            np.save(self.path(f"created.{generation}.npy"), self.created[:self.size])
+            np.save(self.path(f"ids.{generation}.npy"),
+                    np.array([request_id.encode() for request_id in self.ids], dtype=bytes)
+                    if self.ids else np.array([], dtype='S1'))
+            write_json(self.path(f"duplicates.{generation}.json"),
+                       {request_id: [original, self.flagged_at[request_id]]
+                        for request_id, original in self.duplicates.items()})
+            write_json(self.path(INDEX_STATE_FILE), {
+                'num_perm': NUM_PERM,
+                'bands': LSH_BANDS,
+                'seed': MINHASH_SEED,
+                'author_scoped': self.author_scoped,
+                'window_hours': self.window_seconds / 3600,
+                'rows': self.size,
+                'duplicates': len(self.duplicates),
+                'generation': generation,
+                'newest': self.newest if np.isfinite(self.newest) else None
+            })
+            for name in ('signatures', 'created', 'ids'):
+                try:
+                    os.remove(self.path(f"{name}.{self.generation}.npy"))
+                except FileNotFoundError:
+                    pass
+            try:
+                os.remove(self.path(f"duplicates.{self.generation}.json"))
+            except FileNotFoundError:
+                pass
+            self.generation = generation
+            self.dirty = False
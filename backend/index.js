@@ -271,6 +271,7 @@ app.put('/requests/:id/assign', verifyToken, verifyManager, async (req, res) =>
       technicianId: technicianId,
       technicianName: technicianName,
       acceptedAt: new Date(),
+      updatedAt: admin.firestore.FieldValue.serverTimestamp(),
     });
 
     res.json({ message: 'Request assigned successfully.' });
@@ -315,45 +316,123 @@ app.get('/metrics', verifyToken, verifyManager, async (req, res) => {
 // Get real-time dashboard metrics (manager only)
 app.get('/metrics/dashboard', verifyToken, verifyManager, async (req, res) => {
   try {
-    // Calculate UTC midnight for today and tomorrow
     const now = new Date();
-    const todayUTC = new Date(Date.UTC(now.getUTCFullYear(), now.getUTCMonth(), now.getUTCDate(), 0, 0, 0, 0));
-    const tomorrowUTC = new Date(Date.UTC(now.getUTCFullYear(), now.getUTCMonth(), now.getUTCDate() + 1, 0, 0, 0, 0));
 
+    // Prefer the materialized rollup maintained by the aggregation pipeline (one document read)
+    const { period = 'day' } = req.query;
+    const rollup = ROLLUP_COLLECTIONS[period];
+    if (!rollup) {
+      return res.status(400).json({ error: `Unknown period '${period}'.` });
+    }
+    const rollupDoc = await admin.firestore()
+      .collection(rollup.collection)
+      .doc(rollup.docId(now))
+      .get();
+    if (rollupDoc.exists) {
+      const metrics = rollupDoc.data().metrics || {};
+      return res.json(withTodayAliases(period, {
+        period,
+        total_requests: metrics.total_requests || 0,
+        unique_requests: metrics.unique_requests ?? metrics.total_requests ?? 0,
+        avg_assign_time: metrics.avg_assign_time || 0,
+        avg_resolution_time: metrics.avg_resolution_time || 0,
+        requests_by_status: metrics.requests_by_status || {},
+        top_technicians: metrics.top_technicians || [],
+        hourly_distribution: metrics.hourly_distribution || {},
+        local_hourly_distribution: metrics.local_hourly_distribution || {},
+        requests_by_category: metrics.requests_by_category || {},
+        unique_requests_by_technician: metrics.unique_requests_by_technician || metrics.requests_by_technician || {}
+      }));
+    }
+
+    // No rollup yet: merge the period's interval docs
+    const periodStart = rollup.start(now);
     const snapshot = await admin.firestore()
       .collection('service_metrics')
-      .where('interval_start', '>=', todayUTC.toISOString())
-      .where('interval_start', '<', tomorrowUTC.toISOString())
+      .where('interval_start', '>=', periodStart.toISOString())
+      .where('interval_start', '<', rollup.end(periodStart).toISOString())
       .orderBy('interval_start', 'desc')
       .get();
 
-    const todayMetrics = snapshot.docs.map(doc => doc.data().metrics);
+    const periodMetrics = snapshot.docs.map(doc => doc.data().metrics);
 
-    // Aggregate today's data
     const dashboardMetrics = {
-      total_requests_today: sum(todayMetrics, 'total_requests'),
-      avg_assign_time_today: average(todayMetrics, 'avg_assign_time'),
-      avg_resolution_time_today: average(todayMetrics, 'avg_resolution_time'),
-      requests_by_status: aggregateStatusCounts(todayMetrics),
-      top_technicians: getTopTechnicians(todayMetrics),
-      hourly_distribution: aggregateHourlyDistribution(todayMetrics)
+      period,
+      total_requests: sum(periodMetrics, 'total_requests'),
+      unique_requests: periodMetrics.reduce((total, m) => total + (m.unique_requests ?? m.total_requests ?? 0), 0),
+      avg_assign_time: weightedAverage(periodMetrics, 'assign'),
+      avg_resolution_time: weightedAverage(periodMetrics, 'resolution'),
+      requests_by_status: aggregateStatusCounts(periodMetrics),
+      top_technicians: getTopTechnicians(periodMetrics),
+      hourly_distribution: aggregateHourlyDistribution(periodMetrics),
+      local_hourly_distribution: aggregateHourlyDistribution(periodMetrics, 'local_hourly_distribution'),
+      requests_by_category: aggregateCounts(periodMetrics, 'requests_by_category'),
+      unique_requests_by_technician: aggregateCounts(
+        periodMetrics.map(m => ({ counts: m.unique_requests_by_technician || m.requests_by_technician })), 'counts')
     };
 
-    res.json(dashboardMetrics);
+    res.json(withTodayAliases(period, dashboardMetrics));
   } catch (error) {
     console.error(error);
     res.status(500).json({ error: 'Failed to fetch dashboard metrics.' });
   }
 });
 
+// Rollup collections written by aggregation_pipeline.py, keyed by dashboard period (UTC, weeks start Monday),
+// with the [start, end) range the interval fallback reads
+const pad = n => String(n).padStart(2, '0');
+const dayId = d => `${d.getUTCFullYear()}${pad(d.getUTCMonth() + 1)}${pad(d.getUTCDate())}`;
+const utcDay = (d, offset = 0) => new Date(Date.UTC(d.getUTCFullYear(), d.getUTCMonth(), d.getUTCDate() + offset));
+const weekStart = d => utcDay(d, -((d.getUTCDay() + 6) % 7));
+const HOUR_MS = 60 * 60 * 1000;
+const ROLLUP_COLLECTIONS = {
+  hour: {
+    collection: 'service_metrics_hourly',
+    docId: d => `${dayId(d)}_${pad(d.getUTCHours())}`,
+    start: d => new Date(Math.floor(d.getTime() / HOUR_MS) * HOUR_MS),
+    end: start => new Date(start.getTime() + HOUR_MS)
+  },
+  day: { collection: 'service_metrics_daily', docId: dayId, start: d => utcDay(d), end: start => utcDay(start, 1) },
+  week: {
+    collection: 'service_metrics_weekly',
+    docId: d => dayId(weekStart(d)),
+    start: weekStart,
+    end: start => utcDay(start, 7)
+  }
+};
+
+// period=day responses keep the original *_today keys for existing dashboard clients
+function withTodayAliases(period, metrics) {
+  if (period !== 'day') return metrics;
+  return {
+    ...metrics,
+    total_requests_today: metrics.total_requests,
+    unique_requests_today: metrics.unique_requests,
+    avg_assign_time_today: metrics.avg_assign_time,
+    avg_resolution_time_today: metrics.avg_resolution_time
+  };
+}
+
 // Helper functions for aggregation
 function sum(metrics, field) {
   return metrics.reduce((sum, metric) => sum + (metric[field] || 0), 0);
 }
 
-function average(metrics, field) {
-  const values = metrics.filter(m => m[field] && m[field] > 0);
-  return values.length > 0 ? values.reduce((sum, m) => sum + m[field], 0) / values.length : 0;
+// Exact mean from the per-interval sums and counts; older docs without them are weighted by
+// total_requests, taking avg_*_time x total_requests as their sum
+function weightedAverage(metrics, name) {
+  let total = 0;
+  let count = 0;
+  metrics.forEach(m => {
+    if (m[`${name}_count`] !== undefined) {
+      total += m[`total_${name}_time`] || 0;
+      count += m[`${name}_count`];
+    } else if (m[`avg_${name}_time`] > 0 && m.total_requests > 0) {
+      total += m[`avg_${name}_time`] * m.total_requests;
+      count += m.total_requests;
+    }
+  });
+  return count > 0 ? total / count : 0;
 }
 
 function aggregateStatusCounts(metrics) {
@@ -380,10 +459,23 @@ function getTopTechnicians(metrics) {
     .slice(0, 5);
 }
 
-function aggregateHourlyDistribution(metrics) {
+// Sum a count map field (such as requests_by_category, only present when the pipeline classifies complaints)
+// across interval docs
+function aggregateCounts(metrics, field) {
+  const counts = {};
+  metrics.forEach(metric => {
+    Object.entries(metric[field] || {}).forEach(([key, count]) => {
+      counts[key] = (counts[key] || 0) + count;
+    });
+  });
+  return counts;
+}
+
+// hourly_distribution is keyed by UTC hour, local_hourly_distribution by the pipeline's LOCAL_TIMEZONE hour
+function aggregateHourlyDistribution(metrics, field = 'hourly_distribution') {
   const hourlyCounts = {};
   metrics.forEach(metric => {
-    Object.entries(metric.hourly_distribution || {}).forEach(([hour, count]) => {
+    Object.entries(metric[field] || {}).forEach(([hour, count]) => {
       hourlyCounts[hour] = (hourlyCounts[hour] || 0) + count;
     });
   });
@@ -502,6 +594,7 @@ app.post('/requests', verifyToken, async (req, res) => {
             vehicleType: vehicle.vehicleType || '',
             status: 'pending',
             createdAt: new Date(),
+            updatedAt: admin.firestore.FieldValue.serverTimestamp(),
             technicianId: null,
             technicianName: null,
             acceptedAt: null,
@@ -616,6 +709,7 @@ app.put('/requests/:id/accept', verifyToken, async (req, res) => {
       technicianId,
       technicianName,
       acceptedAt: new Date(),
+      updatedAt: admin.firestore.FieldValue.serverTimestamp(),
     });
 
     res.json({ message: 'Request accepted successfully.' });
@@ -647,6 +741,7 @@ app.put('/requests/:id/close', verifyToken, async (req, res) => {
         await requestRef.update({
             status: 'closed',
             closedAt: new Date(),
+            updatedAt: admin.firestore.FieldValue.serverTimestamp(),
         });
 
         res.json({ message: 'Request closed successfully.' });
@@ -753,6 +848,7 @@ app.put('/requests/:id/assign-ai', verifyToken, verifyManager, async (req, res)
         technicianId: selectedTech.id,
         technicianName: `${selectedTech.firstName} ${selectedTech.lastName}`,
         acceptedAt: new Date(),
+        updatedAt: admin.firestore.FieldValue.serverTimestamp(),
       });
     } catch (err) {
       console.error(`[AI ASSIGN] Firestore update failed for request ${id}:`, err);
@@ -874,6 +970,7 @@ app.put('/requests/assign-ai-bulk', verifyToken, verifyManager, async (req, res)
         technicianId: selectedTech.id,
         technicianName: `${selectedTech.firstName} ${selectedTech.lastName}`,
         acceptedAt: new Date(),
+        updatedAt: admin.firestore.FieldValue.serverTimestamp(),
       });
       assignments.push({ requestId: req.id, technicianId: selectedTech.id, technicianName: `${selectedTech.firstName} ${selectedTech.lastName}`, fallback: usedFallback });
     }
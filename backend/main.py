@@ -0,0 +1,141 @@
+"""Cloud Functions entry points for the service metrics aggregation pipeline.
+
+`aggregate_http` serves the HTTP trigger (manual runs) and `aggregate_pubsub`
+the Pub/Sub topic fed by Cloud Scheduler every 15 minutes. The pipeline
+module (NumPy, Firebase Admin) is only imported on the first invocation of an
+instance, and the Firestore client and aggregator built then are reused by
+every warm invocation after it. The aggregator (and its MetricsSink and
+run statistics) is not safe to share between concurrent runs, so
+invocations on one instance run one at a time. Each response reports
+whether the invocation was a cold start and how long it waited,
+initialization and the run took.
+
+Request parameters (JSON body, query string or Pub/Sub message data/attributes):
+    interval_minutes  interval length (default AGGREGATION_INTERVAL_MINUTES or 15)
+    interval_start    ISO timestamp; aggregate exactly that interval
+    mode              'backfill' (default) or 'interval' for only the current interval
+"""
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
+import base64
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+
+import functions_framework
+
+logger = logging.getLogger(__name__)
+
+INVOCATION_MODES = ('backfill', 'interval')
+
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+_instance_started = time.monotonic()
+_aggregator = None
+_aggregator_lock = threading.Lock()
+# Held for a whole run: concurrent requests on one instance queue instead of sharing the aggregator
+_run_lock = threading.Lock()
+_invocations = 0
+
+def get_aggregator():
+    """Return this instance's aggregator, importing the pipeline and connecting to storage on first use"""
+    global _aggregator
+    with _aggregator_lock:
+        if _aggregator is None:
+            from aggregation_pipeline import ServiceMetricsAggregator
+            _aggregator = ServiceMetricsAggregator()
+        return _aggregator
+
+def parse_params(params):
+    """Validate request parameters; returns (interval_minutes, interval_start or None, mode)"""
+    interval_minutes = int(params.get('interval_minutes') or os.environ.get('AGGREGATION_INTERVAL_MINUTES', 15))
+    if interval_minutes <= 0 or (24 * 60) % interval_minutes:
+        raise ValueError(f"interval_minutes must divide a day evenly, got {interval_minutes}")
+
+    interval_start = params.get('interval_start')
+    if interval_start:
+        interval_start = datetime.fromisoformat(interval_start.replace('Z', '+00:00'))
+        if interval_start.tzinfo is None:
+            interval_start = interval_start.replace(tzinfo=timezone.utc)
+
+    mode = params.get('mode', 'backfill')
+    if mode not in INVOCATION_MODES:
+        raise ValueError(f"Unknown mode '{mode}', expected one of {INVOCATION_MODES}")
+    return interval_minutes, interval_start or None, mode
+
+def run_invocation(params):
+    """Run one aggregation request and return a JSON-serializable response with cold/warm timings"""
+    global _invocations
+    interval_minutes, interval_start, mode = parse_params(params)
+
+    queued = time.perf_counter()
+    with _run_lock:
+        started = time.perf_counter()
+        wait_seconds = started - queued
+        cold_start = _aggregator is None
+        aggregator = get_aggregator()
+        init_seconds = time.perf_counter() - started
+
+        from aggregation_pipeline import run_backfill
+        if interval_start is not None or mode == 'interval':
+            result = aggregator.run_aggregation(interval_minutes, start_time=interval_start)
+            response = {'success': result['success'], 'results': [result], 'stats': result.get('stats')}
+        else:
+            results = run_backfill(interval_minutes, aggregator=aggregator)
+            response = {
+                'success': all(result['success'] for result in results),
+                'results': list(results),
+                'stats': results.stats.to_dict()
+            }
+        run_seconds = time.perf_counter() - started - init_seconds
+
+    with _aggregator_lock:
+        _invocations += 1
+        invocation = _invocations
+    response['timing'] = {
+        'cold_start': cold_start,
+        'invocation': invocation,
+        'instance_age_seconds': round(time.monotonic() - _instance_started, 3),
+        'module_import_seconds': round(_IMPORT_SECONDS, 6) if cold_start else 0.0,
+        'wait_seconds': round(wait_seconds, 6),
+        'init_seconds': round(init_seconds, 6),
+        'run_seconds': round(run_seconds, 6),
+        'total_seconds': round(init_seconds + run_seconds, 6)
+    }
+    response.update(mode='interval' if interval_start is not None else mode, interval_minutes=interval_minutes)
+    logger.info(f"{'Cold' if cold_start else 'Warm'} invocation {invocation}: {json.dumps(response['timing'])}")
+    return response
+
+@functions_framework.http
+def aggregate_http(request):
+    """HTTP trigger: parameters come from the query string and/or a JSON body"""
+    params = dict(request.args)
+    params.update(request.get_json(silent=True) or {})
+    try:
+        response = run_invocation(params)
+    except ValueError as e:
+        return {'success': False, 'error': str(e)}, 400
+    except Exception as e:
+        logger.error(f"Aggregation invocation failed: {e}")
+        return {'success': False, 'error': str(e)}, 500
+    return response, 200 if response['success'] else 500
+
+@functions_framework.cloud_event
+def aggregate_pubsub(cloud_event):
+    """Pub/Sub trigger: parameters come from the message's JSON data and attributes"""
+    message = (cloud_event.data or {}).get('message', {})
+    payload = base64.b64decode(message['data']).decode('utf-8') if message.get('data') else ''
+    params = json.loads(payload) if payload.strip() else {}
+    params.update(message.get('attributes') or {})
+    try:
+        response = run_invocation(params)
+    except ValueError as e:
+        # A malformed message will never succeed, so acknowledge it instead of retrying
+        logger.error(f"Ignoring invalid aggregation message: {e}")
+        return
+    if not response['success']:
+        # Failed intervals keep the watermark back and are picked up by the next tick
+        logger.error(f"Aggregation finished with failures: {json.dumps(response['results'])}")
@@ -0,0 +1,505 @@
+"""Storage backends for the service metrics aggregation pipeline.
+
+`ServiceMetricsAggregator` only talks to a `MetricsStorage`: range scans over
+`requests`, batched writes and range/ordered reads on the metrics
+collections, and small checkpoint documents in `pipeline_state`.
+`FirestoreStorage` is the production backend; `InMemoryStorage` and
+`SQLiteStorage` run the same pipeline offline for profiling, load tests and
+CI benchmarks. Pick one with `create_storage()` or METRICS_STORAGE
+(`firestore`, `memory` or `sqlite:<path>`).
+"""
+import bisect
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_STATE_COLLECTION = 'pipeline_state'
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# How often SQLiteStorage.watch_requests polls for requests whose updatedAt advanced
+SQLITE_WATCH_POLL_SECONDS = 1.0
+
+def write_json(path, data):
+    """Write JSON to a local file atomically (temporary file + rename)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def to_epoch_us(timestamp):
+    """Datetime -> integer microseconds since the epoch (None stays None)"""
+    if timestamp is None:
+        return None
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+def from_epoch_us(value):
+    """Integer microseconds since the epoch -> UTC datetime (None stays None)"""
+    if value is None:
+        return None
+    return EPOCH + timedelta(microseconds=value)
+
+class StoredDocument:
+    """Document snapshot returned by the local backends (same surface as a Firestore DocumentSnapshot)"""
+
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data[field]
+
+class _ChangeType:
+    def __init__(self, name):
+        self.name = name
+
+class StoredChange:
+    """Document change delivered to watch_requests callbacks (mirrors Firestore's DocumentChange)"""
+
+    def __init__(self, change_type, document):
+        self.type = _ChangeType(change_type)
+        self.document = document
+
+class MetricsStorage:
+    """Interface the aggregation pipeline needs from a storage backend"""
+
+    # create_storage() spec that opens the same data from another process, or None when the data is process-local
+    spec = None
+
+    def stream_requests(self, start_time, end_time, fields, page_size=500):
+        """Yield requests with start_time <= createdAt < end_time, ordered by createdAt then ID"""
+        raise NotImplementedError
+
+    def stream_updated_requests(self, since, fields):
+        """Yield requests whose updatedAt is after `since`"""
+        raise NotImplementedError
+
+    def watch_requests(self, since, callback):
+        """Call callback(docs, changes, read_time) for requests created at or after `since`; return a handle with unsubscribe()"""
+        raise NotImplementedError
+
+    def write_documents(self, documents):
+        """Set a list of (collection, doc_id, data) as one batch"""
+        raise NotImplementedError
+
+    def query_documents(self, collection, field, start_value, end_value, fields=None):
+        """Yield documents in `collection` with start_value <= field < end_value"""
+        raise NotImplementedError
+
+    def latest_document(self, collection, field):
+        """Return the document with the greatest `field`, or None"""
+        raise NotImplementedError
+
+    def get_state(self, name):
+        """Return the checkpoint document `name` as a dict, or None"""
+        raise NotImplementedError
+
+    def set_state(self, name, data):
+        """Replace the checkpoint document `name`"""
+        raise NotImplementedError
+
+class FirestoreStorage(MetricsStorage):
+    """Production backend on the Firebase Admin Firestore client"""
+
+    spec = 'firestore'
+
+    def __init__(self, db=None):
+        if db is None:
+            import firebase_admin
+            from firebase_admin import credentials, firestore
+            try:
+                # Initialize Firebase Admin (use existing service account)
+                if not firebase_admin._apps:
+                    cred = credentials.Certificate("serviceAccountKey.json")
+                    firebase_admin.initialize_app(cred)
+                db = firestore.client()
+                logger.info("Firebase Admin initialized successfully")
+            except Exception as e:
+                logger.error(f"Failed to initialize Firebase Admin: {e}")
+                raise
+        self.db = db
+
+    def stream_requests(self, start_time, end_time, fields, page_size=500):
+        # Project only the requested fields and page with cursors so one page is in memory at a time
+        query = self.db.collection('requests') \
+            .where('createdAt', '>=', start_time) \
+            .where('createdAt', '<', end_time) \
+            .order_by('createdAt') \
+            .select(fields) \
+            .limit(page_size)
+
+        last_doc = None
+        while True:
+            page = query.start_after(last_doc) if last_doc is not None else query
+            fetched = 0
+            for doc in page.stream():
+                fetched += 1
+                last_doc = doc
+                yield doc
+            if fetched < page_size:
+                return
+
+    def stream_updated_requests(self, since, fields):
+        return self.db.collection('requests') \
+            .where('updatedAt', '>', since) \
+            .select(fields) \
+            .stream()
+
+    def watch_requests(self, since, callback):
+        # Listeners cannot use select(), so full documents are delivered
+        return self.db.collection('requests').where('createdAt', '>=', since).on_snapshot(callback)
+
+    def write_documents(self, documents):
+        batch = self.db.batch()
+        for collection, doc_id, data in documents:
+            batch.set(self.db.collection(collection).document(doc_id), data)
+        batch.commit()
+
+    def query_documents(self, collection, field, start_value, end_value, fields=None):
+        query = self.db.collection(collection) \
+            .where(field, '>=', start_value) \
+            .where(field, '<', end_value)
+        if fields:
+            query = query.select(fields)
+        return query.stream()
+
+    def latest_document(self, collection, field):
+        from firebase_admin import firestore
+        docs = self.db.collection(collection).order_by(field, direction=firestore.Query.DESCENDING).limit(1).stream()
+        return next(iter(docs), None)
+
+    def get_state(self, name):
+        snapshot = self.db.collection(PIPELINE_STATE_COLLECTION).document(name).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def set_state(self, name, data):
+        self.db.collection(PIPELINE_STATE_COLLECTION).document(name).set(data)
+
+class InMemoryStorage(MetricsStorage):
+    """Process-local backend with a sorted createdAt index.
+
+    `latency` (seconds) is slept once per simulated round trip (query page,
+    batch commit, state read/write) to model a remote store in benchmarks.
+    Requests are loaded with `put_request`/`put_requests`; changes made with
+    `put_request`/`delete_request` are delivered to watch_requests callbacks.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = {}
+        self.created_index = []  # sorted (createdAt in µs, doc ID)
+        self.index_dirty = False
+        self.collections = {}
+        self.watchers = []
+        self.lock = threading.RLock()
+
+    def _round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _ensure_index(self):
+        if self.index_dirty:
+            self.created_index = sorted(
+                (to_epoch_us(data['createdAt']), doc_id)
+                for doc_id, data in self.requests.items() if data.get('createdAt') is not None
+            )
+            self.index_dirty = False
+
+    def put_requests(self, documents):
+        """Bulk load {doc_id: data}; watchers are not notified"""
+        with self.lock:
+            self.requests.update(documents)
+            self.index_dirty = True
+
+    def put_request(self, doc_id, data):
+        """Create or replace one request and notify watchers"""
+        with self.lock:
+            change_type = 'MODIFIED' if doc_id in self.requests else 'ADDED'
+            self.requests[doc_id] = dict(data)
+            self.index_dirty = True
+            watchers = list(self.watchers)
+        self._notify(watchers, change_type, doc_id, data)
+
+    def delete_request(self, doc_id):
+        with self.lock:
+            data = self.requests.pop(doc_id, None)
+            self.index_dirty = True
+            watchers = list(self.watchers)
+        if data is not None:
+            self._notify(watchers, 'REMOVED', doc_id, data)
+
+    def _notify(self, watchers, change_type, doc_id, data):
+        created = data.get('createdAt')
+        for since, callback in watchers:
+            if created is not None and created >= since:
+                callback(None, [StoredChange(change_type, StoredDocument(doc_id, dict(data)))], datetime.now(timezone.utc))
+
+    def stream_requests(self, start_time, end_time, fields, page_size=500):
+        with self.lock:
+            self._ensure_index()
+            index = self.created_index
+            low = bisect.bisect_left(index, (to_epoch_us(start_time), ''))
+            high = bisect.bisect_left(index, (to_epoch_us(end_time), ''))
+            doc_ids = [doc_id for _, doc_id in index[low:high]]
+        for offset, doc_id in enumerate(doc_ids):
+            if offset % page_size == 0:
+                self._round_trip()
+            data = self.requests.get(doc_id)
+            if data is not None:
+                yield StoredDocument(doc_id, {field: data[field] for field in fields if field in data})
+
+    def stream_updated_requests(self, since, fields):
+        self._round_trip()
+        with self.lock:
+            matches = [(doc_id, data) for doc_id, data in self.requests.items()
+                       if data.get('updatedAt') is not None and data['updatedAt'] > since]
+        for doc_id, data in matches:
+            yield StoredDocument(doc_id, {field: data[field] for field in fields if field in data})
+
+    def watch_requests(self, since, callback):
+        watcher = (since, callback)
+        with self.lock:
+            initial = [StoredChange('ADDED', StoredDocument(doc_id, dict(data)))
+                       for doc_id, data in self.requests.items()
+                       if data.get('createdAt') is not None and data['createdAt'] >= since]
+            self.watchers.append(watcher)
+        callback(None, initial, datetime.now(timezone.utc))
+
+        storage = self
+
+        class Handle:
+            def unsubscribe(self):
+                with storage.lock:
+                    if watcher in storage.watchers:
+                        storage.watchers.remove(watcher)
+        return Handle()
+
+    def write_documents(self, documents):
+        self._round_trip()
+        with self.lock:
+            for collection, doc_id, data in documents:
+                self.collections.setdefault(collection, {})[doc_id] = json.loads(json.dumps(data))
+
+    def query_documents(self, collection, field, start_value, end_value, fields=None):
+        self._round_trip()
+        with self.lock:
+            matches = [(doc_id, data) for doc_id, data in self.collections.get(collection, {}).items()
+                       if data.get(field) is not None and start_value <= data[field] < end_value]
+        for doc_id, data in matches:
+            yield StoredDocument(doc_id, {f: data[f] for f in fields if f in data} if fields else data)
+
+    def latest_document(self, collection, field):
+        self._round_trip()
+        with self.lock:
+            docs = [(data[field], doc_id, data) for doc_id, data in self.collections.get(collection, {}).items()
+                    if data.get(field) is not None]
+        if not docs:
+            return None
+        _, doc_id, data = max(docs)
+        return StoredDocument(doc_id, data)
+
+    def get_state(self, name):
+        self._round_trip()
+        with self.lock:
+            data = self.collections.get(PIPELINE_STATE_COLLECTION, {}).get(name)
+        return dict(data) if data is not None else None
+
+    def set_state(self, name, data):
+        self.write_documents([(PIPELINE_STATE_COLLECTION, name, data)])
+
+class SQLiteStorage(MetricsStorage):
+    """Single-file backend: requests in a table indexed on createdAt/updatedAt, other collections as JSON rows"""
+
+    REQUEST_COLUMNS = {
+        'createdAt': 'created_at',
+        'acceptedAt': 'accepted_at',
+        'closedAt': 'closed_at',
+        'updatedAt': 'updated_at',
+        'status': 'status',
+        'technicianId': 'technician_id',
+        'technicianName': 'technician_name',
+        'requestDetails': 'request_details',
+        'authorId': 'author_id',
+    }
+    TIMESTAMP_FIELDS = ('createdAt', 'acceptedAt', 'closedAt', 'updatedAt')
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.spec = f"sqlite:{path}" if path != ':memory:' else None
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS requests (
+                id TEXT PRIMARY KEY,
+                created_at INTEGER,
+                accepted_at INTEGER,
+                closed_at INTEGER,
+                updated_at INTEGER,
+                status TEXT,
+                technician_id TEXT,
+                technician_name TEXT,
+                request_details TEXT,
+                author_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS requests_created_at ON requests (created_at, id);
+            CREATE INDEX IF NOT EXISTS requests_updated_at ON requests (updated_at);
+            CREATE TABLE IF NOT EXISTS documents (
+                collection TEXT NOT NULL,
+                doc_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (collection, doc_id)
+            );
+            CREATE INDEX IF NOT EXISTS documents_interval_start
+                ON documents (collection, json_extract(data, '$.interval_start'));
+        """)
+        # Files created before author_id existed get it appended, which keeps REQUEST_COLUMNS in table order
+        if 'author_id' not in {row[1] for row in self.conn.execute("PRAGMA table_info(requests)")}:
+            with self.conn:
+                self.conn.execute("ALTER TABLE requests ADD COLUMN author_id TEXT")
+
+    def put_requests(self, documents):
+        """Bulk load {doc_id: data} in one transaction"""
+        rows = []
+        for doc_id, data in documents.items():
+            row = [doc_id]
+            for field in self.REQUEST_COLUMNS:
+                value = data.get(field)
+                row.append(to_epoch_us(value) if field in self.TIMESTAMP_FIELDS else value)
+            rows.append(row)
+        placeholders = ', '.join('?' * (len(self.REQUEST_COLUMNS) + 1))
+        with self.lock, self.conn:
+            self.conn.executemany(f"INSERT OR REPLACE INTO requests VALUES ({placeholders})", rows)
+
+    def _request_documents(self, sql, params, fields):
+        """Run a requests query selecting `fields`; return [(created_at µs, StoredDocument)]"""
+        columns = ', '.join(['id', 'created_at'] + [self.REQUEST_COLUMNS[field] for field in fields])
+        with self.lock:
+            rows = self.conn.execute(sql.format(columns=columns), params).fetchall()
+        documents = []
+        for row in rows:
+            data = {}
+            for field, value in zip(fields, row[2:]):
+                if value is not None:
+                    data[field] = from_epoch_us(value) if field in self.TIMESTAMP_FIELDS else value
+            documents.append((row[1], StoredDocument(row[0], data)))
+        return documents
+
+    def stream_requests(self, start_time, end_time, fields, page_size=500):
+        # Keyset pagination on (created_at, id) keeps each page an index range scan
+        start_us, end_us = to_epoch_us(start_time), to_epoch_us(end_time)
+        last_key = None
+        while True:
+            if last_key is None:
+                page = self._request_documents(
+                    "SELECT {columns} FROM requests WHERE created_at >= ? AND created_at < ? "
+                    "ORDER BY created_at, id LIMIT ?", (start_us, end_us, page_size), fields)
+            else:
+                page = self._request_documents(
+                    "SELECT {columns} FROM requests WHERE (created_at, id) > (?, ?) AND created_at < ? "
+                    "ORDER BY created_at, id LIMIT ?", (*last_key, end_us, page_size), fields)
+            for _, document in page:
+                yield document
+            if len(page) < page_size:
+                return
+            last_key = (page[-1][0], page[-1][1].id)
+
+    def stream_updated_requests(self, since, fields):
+        for _, document in self._request_documents(
+                "SELECT {columns} FROM requests WHERE updated_at > ?", (to_epoch_us(since),), fields):
+            yield document
+
+    def watch_requests(self, since, callback, poll_seconds=SQLITE_WATCH_POLL_SECONDS):
+        """Poll the updated_at index for changed requests created at or after `since`.
+
+        Writers must advance updatedAt on every change. Deleted rows are not
+        reported, so a removed request keeps counting until the next batch run.
+        """
+        fields = list(self.REQUEST_COLUMNS)
+        since_us = to_epoch_us(since)
+
+        def newest_update():
+            with self.lock:
+                newest = self.conn.execute("SELECT MAX(updated_at) FROM requests").fetchone()[0]
+            return newest if newest is not None else -2 ** 63
+
+        # Read the high-water mark first: rows updated during the initial query are delivered again, not lost
+        seen = newest_update()
+        initial = self._request_documents("SELECT {columns} FROM requests WHERE created_at >= ?", (since_us,), fields)
+        callback(None, [StoredChange('ADDED', document) for _, document in initial], datetime.now(timezone.utc))
+        stopped = threading.Event()
+
+        def poll():
+            nonlocal seen
+            while not stopped.wait(poll_seconds):
+                try:
+                    newest = newest_update()
+                    if newest <= seen:
+                        continue
+                    changed = self._request_documents(
+                        "SELECT {columns} FROM requests WHERE updated_at > ? AND updated_at <= ? AND created_at >= ?",
+                        (seen, newest, since_us), fields)
+                    seen = newest
+                    if changed and not stopped.is_set():
+                        callback(None, [StoredChange('MODIFIED', document) for _, document in changed],
+                                 datetime.now(timezone.utc))
+                except Exception as e:
+                    logger.error(f"Polling {self.path} for request changes failed, retrying: {e}")
+
+        threading.Thread(target=poll, name='sqlite-watch', daemon=True).start()
+
+        class Handle:
+            def unsubscribe(self):
+                stopped.set()
+        return Handle()
+
+    def write_documents(self, documents):
+        rows = [(collection, doc_id, json.dumps(data)) for collection, doc_id, data in documents]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?, ?)", rows)
+
+    def query_documents(self, collection, field, start_value, end_value, fields=None):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT doc_id, data FROM documents WHERE collection = ? "
+                f"AND json_extract(data, '$.{field}') >= ? AND json_extract(data, '$.{field}') < ?",
+                (collection, start_value, end_value)).fetchall()
+        for doc_id, data in rows:
+            data = json.loads(data)
+            yield StoredDocument(doc_id, {f: data[f] for f in fields if f in data} if fields else data)
+
+    def latest_document(self, collection, field):
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT doc_id, data FROM documents WHERE collection = ? "
+                f"ORDER BY json_extract(data, '$.{field}') DESC LIMIT 1", (collection,)).fetchone()
+        return StoredDocument(row[0], json.loads(row[1])) if row else None
+
+    def get_state(self, name):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM documents WHERE collection = ? AND doc_id = ?",
+                                    (PIPELINE_STATE_COLLECTION, name)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_state(self, name, data):
+        self.write_documents([(PIPELINE_STATE_COLLECTION, name, data)])
+
+def create_storage(spec=None):
+    """Build a backend from a spec: 'firestore' (default), 'memory' or 'sqlite:<path>'; defaults to METRICS_STORAGE"""
+    spec = spec or os.environ.get('METRICS_STORAGE', 'firestore')
+    if spec == 'firestore':
+        return FirestoreStorage()
+    if spec == 'memory':
+        return InMemoryStorage()
+    if spec.startswith('sqlite:'):
+        return SQLiteStorage(spec[len('sqlite:'):] or ':memory:')
+    raise ValueError(f"Unknown storage backend '{spec}'")
@@ -0,0 +1,276 @@
+"""Local columnar archive of the request fields the aggregation pipeline reads.
+
+Requests are partitioned by the UTC day of `createdAt`. Each partition is a
+directory of NumPy arrays sorted by createdAt, one file per column, plus a
+manifest naming the current generation of those files:
+
+    <root>/archive.json                   archived range and the updatedAt watermark of the last sync
+    <root>/2026-10-17/partition.json      row count, generation, status and technician labels
+    <root>/2026-10-17/created.3.npy       float64 epoch seconds (also accepted, closed; NaN when missing)
+    <root>/2026-10-17/status.3.npy        int32 codes into the labels (also technician, -1 for none)
+    <root>/2026-10-17/id.3.npy            document IDs
+
+`export` (re)writes whole days from storage and `sync` folds in only the
+requests updated since the watermark. A partition is replaced by writing a
+new generation and then swapping the manifest, so readers never see a
+half-written day. `load_columns` returns `load_request_columns`-shaped
+columns for any range, read with np.load(mmap_mode='r'), so a range within
+one day is a zero-copy view of the page cache. Backfills, series and rollups
+rebuild from it with `run_replay` without touching the requests collection.
+
+    python request_archive.py export --archive /data/requests --start 2026-07-01
+    python request_archive.py sync --archive /data/requests
+    python request_archive.py replay --archive /data/requests --start 2026-07-01 --end 2026-10-01
+"""
+import argparse
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+
+from aggregation_pipeline import (REQUEST_FIELDS, WATERMARK_OVERLAP, ServiceMetricsAggregator, local_hours,
+                                  merge_request_columns, run_replay)
+from metrics_storage import create_storage, write_json
+
+logger = logging.getLogger(__name__)
+
+# Arrays stored per partition; local_hour is derived on load so LOCAL_TIMEZONE can change
+ARCHIVE_COLUMNS = ('id', 'created', 'accepted', 'closed', 'status', 'technician')
+
+ARCHIVE_STATE_FILE = 'archive.json'
+PARTITION_MANIFEST = 'partition.json'
+
+def _day_start(day):
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+def _days(start_time, end_time):
+    """UTC calendar days overlapping [start_time, end_time)"""
+    day = start_time.astimezone(timezone.utc).date()
+    while _day_start(day) < end_time:
+        yield day
+        day += timedelta(days=1)
+
+class RequestArchive:
+    """Date-partitioned, memory-mapped request columns under `root`"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def read_state(self):
+        try:
+            with open(os.path.join(self.root, ARCHIVE_STATE_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def write_state(self, state):
+        write_json(os.path.join(self.root, ARCHIVE_STATE_FILE), state)
+
+    def covered_range(self):
+        """UTC (start, end) of the archived createdAt range, or None before the first export"""
+        state = self.read_state()
+        if not state.get('start'):
+            return None
+        return datetime.fromisoformat(state['start']), datetime.fromisoformat(state['end'])
+
+    def partition_path(self, day, name):
+        return os.path.join(self.root, day.isoformat(), name)
+
+    def read_manifest(self, day):
+        try:
+            with open(self.partition_path(day, PARTITION_MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def read_partition(self, day):
+        """Memory-map one day's columns (plus its labels), or None when nothing is archived for it"""
+        manifest = self.read_manifest(day)
+        if manifest is None:
+            return None
+        partition = {key: np.load(self.partition_path(day, f"{key}.{manifest['generation']}.npy"), mmap_mode='r')
+                     for key in ARCHIVE_COLUMNS}
+        partition.update(status_labels=manifest['status_labels'], technician_labels=manifest['technician_labels'])
+        return partition
+
+    def write_partition(self, day, columns):
+        """Replace one day's partition with `columns` (load_request_columns output plus an 'id' array)"""
+        previous = self.read_manifest(day)
+        generation = previous['generation'] + 1 if previous else 1
+        os.makedirs(os.path.join(self.root, day.isoformat()), exist_ok=True)
+        order = np.argsort(columns['created'], kind='stable')
+        for key in ARCHIVE_COLUMNS:
+            np.save(self.partition_path(day, f"{key}.{generation}.npy"), np.asarray(columns[key])[order])
+        write_json(self.partition_path(day, PARTITION_MANIFEST), {
+            'day': day.isoformat(),
+            'rows': int(order.size),
+            'generation': generation,
+            'status_labels': list(columns['status_labels']),
+            'technician_labels': list(columns['technician_labels']),
+            'written_at': datetime.now(timezone.utc).isoformat()
+        })
+        if previous:
+            # Open memory maps of the old generation stay readable after the unlink
+            for key in ARCHIVE_COLUMNS:
+                try:
+                    os.remove(self.partition_path(day, f"{key}.{previous['generation']}.npy"))
+                except FileNotFoundError:
+                    pass
+        return int(order.size)
+
+    def load_documents(self, aggregator, docs):
+        """load_request_columns over request documents, plus their IDs as an 'id' column"""
+        ids = []
+
+        def record_ids(docs):
+            for doc in docs:
+                ids.append(doc.id.encode())
+                yield doc
+
+        columns = aggregator.load_request_columns(record_ids(docs))
+        columns['id'] = np.array(ids, dtype=bytes) if ids else np.array([], dtype='S1')
+        return columns
+
+    def export(self, aggregator, start_time, end_time=None):
+        """Archive every request created on the UTC days from start_time to end_time (default now).
+
+        Whole days are re-read from the aggregator's storage and replace
+        their partitions. The archive must stay contiguous, so the range has
+        to overlap or touch what is already archived. The first export that
+        reaches now sets the watermark `sync` continues from. Returns the
+        number of requests archived.
+        """
+        exported_at = datetime.now(timezone.utc)
+        end_time = min(end_time or exported_at, exported_at)
+        start_time = _day_start(start_time.astimezone(timezone.utc).date())
+        covered = self.covered_range()
+        if covered and (start_time > covered[1] or end_time < covered[0]):
+            raise ValueError(f"Exporting {start_time} to {end_time} would leave a gap next to the archived "
+                             f"{covered[0]} to {covered[1]}")
+
+        rows = 0
+        for day in _days(start_time, end_time):
+            requests_data = aggregator.fetch_requests_data(_day_start(day), _day_start(day) + timedelta(days=1))
+            rows += self.write_partition(day, self.load_documents(aggregator, requests_data))
+            logger.info(f"Archived {day}")
+
+        state = self.read_state()
+        state['start'] = min(start_time, covered[0]).isoformat() if covered else start_time.isoformat()
+        state['end'] = max(end_time, covered[1]).isoformat() if covered else end_time.isoformat()
+        if end_time >= exported_at and not state.get('watermark'):
+            state['watermark'] = (exported_at - WATERMARK_OVERLAP).isoformat()
+        self.write_state(state)
+        logger.info(f"Exported {rows} requests from {start_time} to {end_time}")
+        return rows
+
+    def sync(self, aggregator):
+        """Fold requests updated since the watermark into their days and extend the archive to now.
+
+        Relies on `updatedAt` like the incremental backfill: a request
+        created after the watermark is picked up as an update. Requests
+        created before the archived range are ignored. Returns the number of
+        requests applied.
+        """
+        state = self.read_state()
+        if not state.get('watermark'):
+            raise ValueError("The archive has no watermark yet; export up to now first")
+        started = datetime.now(timezone.utc)
+        watermark = datetime.fromisoformat(state['watermark'])
+        covered_start = datetime.fromisoformat(state['start'])
+
+        changed, newest, scanned = defaultdict(list), None, 0
+        with aggregator.stats.stage('fetch'):
+            for doc in aggregator.storage.stream_updated_requests(watermark - WATERMARK_OVERLAP,
+                                                                  REQUEST_FIELDS + ['updatedAt']):
+                scanned += 1
+                data = doc.to_dict()
+                created, updated = data.get('createdAt'), data.get('updatedAt')
+                if updated and (newest is None or updated > newest):
+                    newest = updated
+                if created and created >= covered_start:
+                    changed[created.astimezone(timezone.utc).date()].append(doc)
+        aggregator.stats.record_reads(scanned, 0)
+
+        applied = 0
+        for day, docs in sorted(changed.items()):
+            updates = self.load_documents(aggregator, docs)
+            partition = self.read_partition(day)
+            if partition is not None:
+                keep = ~np.isin(partition['id'], updates['id'])
+                kept = {key: partition[key][keep] for key in ARCHIVE_COLUMNS}
+                kept.update(status_labels=partition['status_labels'], technician_labels=partition['technician_labels'],
+                            local_hour=np.full(kept['created'].size, -1, dtype=np.int8))
+                ids = np.concatenate([kept['id'], updates['id']])
+                updates = merge_request_columns([kept, updates])
+                updates['id'] = ids
+            self.write_partition(day, updates)
+            applied += len(docs)
+
+        state['watermark'] = (max(newest, watermark) if newest else max(watermark, started - WATERMARK_OVERLAP)).isoformat()
+        state['end'] = max(datetime.fromisoformat(state['end']), started).isoformat()
+        self.write_state(state)
+        logger.info(f"Synced {applied} updated requests into {len(changed)} archived days")
+        return applied
+
+    def load_columns(self, start_time, end_time):
+        """Return `load_request_columns`-shaped columns for requests created in [start_time, end_time).
+
+        A range within one day is sliced straight out of that partition's
+        memory maps; longer ranges are concatenated. Raises ValueError when
+        the range is not fully archived.
+        """
+        covered = self.covered_range()
+        if covered is None or start_time < covered[0] or end_time > covered[1]:
+            raise ValueError(f"{start_time} to {end_time} is outside the archived range "
+                             f"{'(empty)' if covered is None else f'{covered[0]} to {covered[1]}'}")
+        parts = []
+        for day in _days(start_time, end_time):
+            partition = self.read_partition(day)
+            if partition is None:
+                # Synced days only get a partition once a request is created on them
+                continue
+            first, last = np.searchsorted(partition['created'], [start_time.timestamp(), end_time.timestamp()],
+                                          side='left').tolist()
+            part = {key: partition[key][first:last] for key in ('created', 'accepted', 'closed', 'status', 'technician')}
+            part.update(status_labels=partition['status_labels'], technician_labels=partition['technician_labels'],
+                        local_hour=local_hours(part['created']))
+            parts.append(part)
+        return parts[0] if len(parts) == 1 else merge_request_columns(parts)
+
+def parse_day(value):
+    return _day_start(date.fromisoformat(value))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=('export', 'sync', 'replay'))
+    parser.add_argument('--archive', required=True, help='archive directory')
+    parser.add_argument('--start', type=parse_day, help='first UTC day (YYYY-MM-DD) to export or replay')
+    parser.add_argument('--end', type=parse_day, help='UTC day (YYYY-MM-DD) to stop before (default: now)')
+    parser.add_argument('--storage', default=None,
+                        help='storage spec to read requests from / write metrics to (default: METRICS_STORAGE)')
+    parser.add_argument('--processes', type=int, default=1, help='replay: shard across worker processes')
+    args = parser.parse_args()
+
+    archive = RequestArchive(args.archive)
+    storage = create_storage(args.storage)
+    if args.command == 'sync':
+        archive.sync(ServiceMetricsAggregator(storage=storage, classify=False, duplicate_index=False))
+        return
+    if args.start is None:
+        parser.error(f"{args.command} needs --start")
+    if args.command == 'export':
+        archive.export(ServiceMetricsAggregator(storage=storage, classify=False, duplicate_index=False), args.start, args.end)
+        return
+    covered = archive.covered_range()
+    if covered is None:
+        parser.error("the archive is empty; export first")
+    results = run_replay(archive, args.start, args.end or covered[1], storage=storage, processes=args.processes)
+    failures = sum(not result['success'] for result in results)
+    print(json.dumps({'intervals': len(results), 'failed': failures, 'stats': results.stats.to_dict()}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""Tests for aggregation_pipeline.py against InMemoryStorage"""
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+import aggregation_pipeline
+from aggregation_pipeline import (SKETCH_RELATIVE_ACCURACY, LatencySketch, MetricsSink, RealtimeAggregator,
+                                  get_rollup_doc_id, get_rollup_period, merge_metrics, parse_resolutions,
+                                  run_incremental, series_collection)
+from conftest import make_aggregator
+from duplicate_index import DuplicateIndex
+from metrics_storage import InMemoryStorage
+
+# Metrics both engines, the real-time accumulators and rollups must report identically
+COUNT_FIELDS = ('total_requests', 'requests_by_status', 'requests_by_technician', 'requests_by_hour',
+                'hourly_distribution', 'local_hourly_distribution', 'status_transitions', 'assign_count',
+                'resolution_count')
+DUPLICATE_FIELDS = ('duplicate_requests', 'unique_requests', 'unique_requests_by_technician')
+# Sums of float seconds, which the engines add up in different orders
+SUM_FIELDS = ('total_assign_time', 'total_resolution_time', 'avg_assign_time', 'avg_resolution_time')
+
+def documents_written(aggregator, run):
+    """Run, refresh rollups and return how many documents the sink committed"""
+    before = aggregator.stats.snapshot()
+    run()
+    aggregator.update_rollups()
+    return aggregator.stats.since(before).to_dict()['documents_written']
+
+def collection_metrics(storage, collection):
+    return {doc_id: doc['metrics'] for doc_id, doc in storage.collections.get(collection, {}).items()}
+
+def string_keys(value):
+    """Count maps as stored, with the integer hour keys of freshly computed metrics turned into strings"""
+    return {str(key): count for key, count in value.items()} if isinstance(value, dict) else value
+
+def assert_same_metrics(expected, actual, fields=COUNT_FIELDS):
+    for field in fields:
+        assert string_keys(actual.get(field)) == string_keys(expected.get(field)), field
+    for field in SUM_FIELDS:
+        assert actual[field] == pytest.approx(expected[field], rel=1e-9, abs=1e-6), field
+
+def update_request(storage, workload, doc_id, **changes):
+    """Change a request as the booking API would, bumping updatedAt past any saved watermark"""
+    data = dict(workload[doc_id], **changes, updatedAt=datetime.now(timezone.utc) + timedelta(seconds=1))
+    storage.put_request(doc_id, data)
+    return data
+
+def pending_request(workload, after):
+    return next(doc_id for doc_id, data in sorted(workload.items())
+                if data['status'] == 'pending' and data['createdAt'] >= after)
+
+@pytest.mark.parametrize('deduplicate', [False, True])
+def test_engines_write_the_same_intervals(storage, intervals, tmp_path, deduplicate):
+    written = {}
+    for engine in ('columnar', 'python'):
+        target = InMemoryStorage()
+        target.put_requests(storage.requests)
+        index = DuplicateIndex(str(tmp_path / engine)) if deduplicate else False
+        aggregator = make_aggregator(target, engine=engine, duplicate_index=index)
+        results = aggregator.run_backfill_scan(intervals)
+        aggregator.update_rollups()
+        assert all(result['success'] for result in results)
+        written[engine] = collection_metrics(target, 'service_metrics')
+
+    assert written['columnar'].keys() == written['python'].keys()
+    fields = COUNT_FIELDS + DUPLICATE_FIELDS if deduplicate else COUNT_FIELDS
+    for doc_id, metrics in written['columnar'].items():
+        assert_same_metrics(metrics, written['python'][doc_id], fields)
+    if deduplicate:
+        assert sum(metrics['duplicate_requests'] for metrics in written['columnar'].values()) > 0
+
+def test_concurrent_aggregation_with_duplicate_index_matches_serial(storage, intervals, tmp_path):
+    written = {}
+    for workers in (1, 8):
+        target = InMemoryStorage()
+        target.put_requests(storage.requests)
+        aggregator = make_aggregator(target, duplicate_index=DuplicateIndex(str(tmp_path / str(workers))))
+        assert all(result['success'] for result in aggregator.run_aggregation_concurrent(intervals, max_workers=workers))
+        written[workers] = {doc_id: metrics['duplicate_requests']
+                            for doc_id, metrics in collection_metrics(target, 'service_metrics').items()}
+    assert written[8] == written[1]
+    assert sum(written[1].values()) > 0
+
+def test_engines_agree_on_percentiles(storage, intervals):
+    window = (intervals[0][0], intervals[-1][1])
+    columnar, python = (make_aggregator(storage, engine=engine) for engine in ('columnar', 'python'))
+    exact = columnar.calculate_metrics(columnar.fetch_requests_data(*window))
+    sketched = python.calculate_metrics(python.fetch_requests_data(*window))
+    assert_same_metrics(exact, sketched)
+    for name in ('assign', 'resolution'):
+        for percentile in (50, 90):
+            assert sketched[f'p{percentile}_{name}_time'] == pytest.approx(exact[f'p{percentile}_{name}_time'], rel=0.02)
+
+def test_unchanged_intervals_are_not_rewritten(storage, intervals):
+    aggregator = make_aggregator(storage, resolutions=parse_resolutions('1m,5m,1h@local'))
+    assert documents_written(aggregator, lambda: aggregator.run_backfill_scan(intervals)) > len(intervals)
+    assert series_collection('1m') in storage.collections
+
+    results = []
+    assert documents_written(aggregator, lambda: results.extend(aggregator.run_backfill_scan(intervals))) == 0
+    assert all(result['skipped'] for result in results)
+
+def test_late_update_rewrites_interval_and_rollups(storage, workload, intervals):
+    aggregator = make_aggregator(storage)
+    run_incremental(aggregator, intervals, intervals[0][0], intervals[-1][1])
+    watermark = aggregator.load_watermark()
+    assert watermark is not None
+
+    doc_id = pending_request(workload, intervals[4][0])
+    data = update_request(storage, workload, doc_id, status='active', technicianId='tech_late',
+                          technicianName='Late Technician', acceptedAt=workload[doc_id]['createdAt'] + timedelta(minutes=3))
+    dirty, newest = aggregator.find_dirty_intervals(watermark)
+    start_time = next(start for start, end in intervals if start <= data['createdAt'] < end)
+    assert start_time in dirty
+    assert newest == data['updatedAt']
+
+    # Every interval updated within WATERMARK_OVERLAP is rescanned, but only the changed one
+    # and its hourly, daily and weekly rollups are written
+    assert documents_written(aggregator, lambda: run_incremental(aggregator, [], watermark, intervals[-1][1])) == 4
+    assert aggregator.load_watermark() >= newest
+    interval_doc = storage.collections['service_metrics'][aggregator.custom_doc_id(start_time, start_time + timedelta(minutes=15))]
+    assert interval_doc['metrics']['requests_by_technician']['Late Technician'] == 1
+    for granularity, collection in (('hourly', 'service_metrics_hourly'), ('daily', 'service_metrics_daily')):
+        rollup = storage.collections[collection][get_rollup_doc_id(granularity, get_rollup_period(granularity, start_time)[0])]
+        assert rollup['metrics']['requests_by_technician']['Late Technician'] == 1
+
+    assert documents_written(aggregator, lambda: run_incremental(aggregator, [], watermark, intervals[-1][1])) == 0
+
+def test_rollups_merge_their_intervals(storage, intervals):
+    aggregator = make_aggregator(storage)
+    aggregator.run_backfill_scan(intervals)
+    aggregator.update_rollups()
+    interval_docs = list(storage.collections['service_metrics'].values())
+    daily = list(storage.collections['service_metrics_daily'].values())
+    assert sum(doc['metrics']['total_requests'] for doc in daily) == len(storage.requests)
+    assert sum(doc['source_documents'] for doc in storage.collections['service_metrics_hourly'].values()) == len(interval_docs)
+
+    merged = merge_metrics(interval_docs)
+    window = (intervals[0][0], intervals[-1][1])
+    assert_same_metrics(aggregator.calculate_metrics(aggregator.fetch_requests_data(*window)), merged)
+
+def test_realtime_resumes_from_checkpoint(storage, workload, intervals):
+    storage.set_state('realtime', {'resume_from': intervals[0][0].isoformat()})
+    realtime = RealtimeAggregator(make_aggregator(storage), debounce_seconds=0)
+    realtime.start()
+    saved = realtime.flush(force=True)
+    realtime.watch.unsubscribe()
+    assert len(saved) == len({realtime.interval_start(data['createdAt']) for data in workload.values()})
+    assert datetime.fromisoformat(storage.get_state('realtime')['resume_from']) == intervals[0][0]
+
+    batch = InMemoryStorage()
+    batch.put_requests(workload)
+    make_aggregator(batch, engine='python').run_backfill_scan(intervals)
+    expected = collection_metrics(batch, 'service_metrics')
+    for doc_id, metrics in collection_metrics(storage, 'service_metrics').items():
+        assert_same_metrics(expected[doc_id], metrics)
+
+    # A restarted listener rebuilds the open intervals from the checkpoint and keeps applying changes
+    restarted = RealtimeAggregator(make_aggregator(storage), debounce_seconds=0)
+    restarted.start()
+    try:
+        assert restarted.flush(force=True) == saved
+        doc_id = pending_request(workload, intervals[2][0])
+        data = update_request(storage, workload, doc_id, status='closed', technicianId='tech_late',
+                              technicianName='Late Technician', acceptedAt=workload[doc_id]['createdAt'],
+                              closedAt=workload[doc_id]['createdAt'] + timedelta(minutes=30))
+        start_time = restarted.interval_start(data['createdAt'])
+        assert restarted.flush(force=True) == [restarted.aggregator.custom_doc_id(start_time, start_time + restarted.interval)]
+    finally:
+        restarted.watch.unsubscribe()
+    metrics = storage.collections['service_metrics'][restarted.aggregator.custom_doc_id(start_time, start_time + restarted.interval)]['metrics']
+    assert metrics['requests_by_technician']['Late Technician'] == 1
+    batch_aggregator = make_aggregator(storage, engine='python')
+    assert_same_metrics(batch_aggregator.calculate_metrics(
+        batch_aggregator.fetch_requests_data(start_time, start_time + restarted.interval)), metrics)
+
+def test_realtime_reattaches_listener_at_the_horizon(monkeypatch, storage, intervals):
+    monkeypatch.setattr(aggregation_pipeline, 'WATCH_RESUBSCRIBE_AFTER', timedelta(hours=1))
+    storage.set_state('realtime', {'resume_from': intervals[0][0].isoformat()})
+    realtime = RealtimeAggregator(make_aggregator(storage), debounce_seconds=0, retention_minutes=60)
+    realtime.start()
+    try:
+        assert realtime.flush(force=True)
+        assert realtime.horizon - intervals[0][0] >= timedelta(hours=1)
+        assert [since for since, _ in storage.watchers] == [realtime.horizon]
+        # The new listener's initial snapshot re-delivers requests that are already counted
+        assert realtime.flush(force=True) == []
+    finally:
+        realtime.watch.unsubscribe()
+    assert not storage.watchers
+
+def test_sketch_merge_matches_one_sketch():
+    rng = np.random.default_rng(5)
+    values = np.concatenate([np.zeros(20), rng.lognormal(6, 1.2, 5000)])
+    first, second, whole = LatencySketch(), LatencySketch(), LatencySketch()
+    first.add_array(values[:1000])
+    for value in values[1000:]:
+        second.add(float(value))
+    whole.add_array(values)
+    assert first.merge(second).to_dict() == whole.to_dict()
+    assert LatencySketch.from_dict(whole.to_dict()).to_dict() == whole.to_dict()
+
+    ordered = np.sort(values)
+    for q in (0.01, 0.5, 0.9, 0.99):
+        true = ordered[int(q * (len(values) - 1))]
+        assert whole.quantile(q) == pytest.approx(true, rel=SKETCH_RELATIVE_ACCURACY, abs=1e-9)
+
+    groups = rng.integers(3, size=values.size)
+    for group, sketch in enumerate(LatencySketch.from_groups(values, groups, 3)):
+        expected = LatencySketch()
+        expected.add_array(values[groups == group])
+        assert sketch.to_dict() == expected.to_dict()
+
+class FlakyStorage(InMemoryStorage):
+    """Fails every batch that writes to one of the `failing` collections"""
+
+    def __init__(self, failing=()):
+        super().__init__()
+        self.failing = set(failing)
+
+    def write_documents(self, documents):
+        if any(collection in self.failing for collection, _, _ in documents):
+            raise IOError(f"Write to {sorted(self.failing)} failed")
+        super().write_documents(documents)
+
+def test_failed_rollup_holds_the_watermark_and_is_rebuilt(workload, intervals):
+    storage = FlakyStorage(failing={'service_metrics_daily'})
+    storage.put_requests(workload)
+    aggregator = make_aggregator(storage)
+    aggregator.sink.max_retries = 0
+
+    results = run_incremental(aggregator, intervals, intervals[0][0], intervals[-1][1])
+    assert not all(result['success'] for result in results)
+    assert aggregator.load_watermark() is None
+    assert 'service_metrics_daily' not in storage.collections
+
+    # The intervals are unchanged and skipped, but their rollups are still rebuilt
+    storage.failing.clear()
+    results = run_incremental(aggregator, [], intervals[0][0], intervals[-1][1])
+    assert results and all(result['success'] and result.get('skipped') for result in results)
+    assert aggregator.load_watermark() is not None
+    daily = storage.collections['service_metrics_daily'].values()
+    assert sum(doc['metrics']['total_requests'] for doc in daily) == len(workload)
+    assert not aggregator.dirty_intervals
+
+def test_sink_drain_waits_for_a_flush_blocked_on_a_commit_slot():
+    class SlowStorage(InMemoryStorage):
+        def write_documents(self, documents):
+            time.sleep(0.1)
+            super().write_documents(documents)
+
+    storage = SlowStorage()
+    sink = MetricsSink(storage, batch_size=2, max_in_flight=1, flush_interval=60)
+    for index in range(4):
+        sink.write('service_metrics', str(index), {'index': index})
+    sink.write('service_metrics', 'late', {'index': 4})
+    flusher = threading.Thread(target=sink.flush)
+    flusher.start()
+    time.sleep(0.02)
+    assert sink.drain() == set()
+    assert sorted(storage.collections['service_metrics']) == ['0', '1', '2', '3', 'late']
+    flusher.join()
@@ -0,0 +1,61 @@
+"""Tests for duplicate_index.py"""
+import numpy as np
+import pytest
+
+from duplicate_index import DuplicateIndex
+
+COMPLAINT = 'AC not cooling in the cabin since the last service'
+
+def test_flags_a_reworded_repeat_by_the_same_author(tmp_path):
+    index = DuplicateIndex(str(tmp_path))
+    flags = index.check(['req_1', 'req_2', 'req_3'],
+                        [COMPLAINT, COMPLAINT.upper() + '!!', 'Brake pads squeal when stopping at low speed'],
+                        [0, 600, 1200], authors=['user_1', 'user_1', 'user_1'])
+    assert flags.tolist() == [False, True, False]
+    assert index.duplicate_of('req_2') == 'req_1'
+
+def test_author_scoping(tmp_path):
+    scoped = DuplicateIndex(str(tmp_path / 'scoped'))
+    unscoped = DuplicateIndex(str(tmp_path / 'unscoped'), author_scoped=False)
+    for index, expected in ((scoped, [False, False]), (unscoped, [False, True])):
+        flags = index.check(['req_1', 'req_2'], [COMPLAINT, COMPLAINT], [0, 60], authors=['user_1', 'user_2'])
+        assert flags.tolist() == expected
+
+def test_window_and_sticky_flags(tmp_path):
+    index = DuplicateIndex(str(tmp_path), window_hours=1)
+    assert index.check(['req_1', 'req_2'], [COMPLAINT, COMPLAINT], [0, 2 * 3600]).tolist() == [False, False]
+    assert index.check(['req_3'], [COMPLAINT], [2 * 3600 + 60]).tolist() == [True]
+    # Checked again, e.g. when an interval is re-aggregated, a request keeps its flag
+    assert index.check(['req_3', 'req_2'], [COMPLAINT, COMPLAINT], [2 * 3600 + 60, 2 * 3600]).tolist() == [True, False]
+
+def test_save_and_reload(tmp_path):
+    index = DuplicateIndex(str(tmp_path), window_hours=1)
+    index.check(['req_1', 'req_2'], [COMPLAINT, COMPLAINT], [0, 60], authors=['user_1', 'user_1'])
+    index.check(['req_3', 'req_4'], ['Engine light blinking after refuel'] * 2, [3 * 3600, 3 * 3600 + 60],
+                authors=['user_2', 'user_2'])
+    index.save()
+
+    reloaded = DuplicateIndex(str(tmp_path), window_hours=1)
+    # Rows and flags older than the window were dropped, the recent ones survive
+    assert reloaded.ids == ['req_3', 'req_4']
+    assert reloaded.duplicates == {'req_4': 'req_3'}
+    assert reloaded.check(['req_5', 'req_4'], ['engine light blinking after refuel'] * 2,
+                          [3 * 3600 + 120, 3 * 3600 + 60], authors=['user_2', 'user_2']).tolist() == [True, True]
+
+    with pytest.raises(ValueError):
+        DuplicateIndex(str(tmp_path), author_scoped=False)
+
+def test_batches_match_one_request_at_a_time(tmp_path):
+    rng = np.random.default_rng(3)
+    words = ['ac', 'cooling', 'brake', 'noise', 'engine', 'light', 'tyre', 'puncture', 'battery', 'weak', 'oil', 'leak']
+    texts = [' '.join(rng.choice(words, size=6).tolist()) for _ in range(400)]
+    texts += [texts[i] + ' again' for i in rng.integers(400, size=100).tolist()]
+    ids = [f"req_{i:04d}" for i in range(len(texts))]
+    created = np.arange(len(texts), dtype=np.float64) * 30
+
+    batched = DuplicateIndex(str(tmp_path / 'batched')).check(ids, texts, created)
+    single = DuplicateIndex(str(tmp_path / 'single'))
+    one_by_one = [single.check([request_id], [text], [when])[0] for request_id, text, when in zip(ids, texts, created)]
+    assert batched.tolist() == one_by_one
+    # MinHash only estimates similarity, so a few rewordings may be missed
+    assert batched[400:].mean() > 0.9
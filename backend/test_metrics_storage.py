@@ -0,0 +1,69 @@
+"""Tests for the offline storage backends in metrics_storage.py"""
+import threading
+from datetime import timedelta
+
+import pytest
+
+from metrics_storage import InMemoryStorage, SQLiteStorage
+
+REQUEST_FIELDS = ['createdAt', 'acceptedAt', 'closedAt', 'status', 'technicianName']
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path, workload):
+    storage = InMemoryStorage() if request.param == 'memory' else SQLiteStorage(str(tmp_path / 'metrics.db'))
+    storage.put_requests(workload)
+    return storage
+
+def test_stream_requests_in_created_order(backend, workload, intervals):
+    start_time, end_time = intervals[2][0], intervals[6][1]
+    expected = sorted((data['createdAt'], doc_id) for doc_id, data in workload.items()
+                      if start_time <= data['createdAt'] < end_time)
+    docs = list(backend.stream_requests(start_time, end_time, REQUEST_FIELDS, page_size=7))
+    assert [(doc.to_dict()['createdAt'], doc.id) for doc in docs] == expected
+    # SQLite leaves out NULL fields that the in-memory backend returns as None
+    for doc in docs[:50]:
+        assert {field: value for field, value in doc.to_dict().items() if value is not None} == \
+            {field: workload[doc.id][field] for field in REQUEST_FIELDS if workload[doc.id].get(field) is not None}
+
+def test_stream_updated_requests(backend, workload):
+    since = sorted(data['updatedAt'] for data in workload.values())[-25]
+    updated = {doc.id for doc in backend.stream_updated_requests(since, ['updatedAt'])}
+    assert updated == {doc_id for doc_id, data in workload.items() if data['updatedAt'] > since}
+
+def test_documents_and_state(backend):
+    backend.write_documents([('service_metrics', f"doc_{hour}", {'interval_start': f"2026-10-17T{hour:02d}:00:00"})
+                             for hour in range(5)])
+    docs = backend.query_documents('service_metrics', 'interval_start', '2026-10-17T01', '2026-10-17T03')
+    assert sorted(doc.id for doc in docs) == ['doc_1', 'doc_2']
+    assert backend.latest_document('service_metrics', 'interval_start').id == 'doc_4'
+    assert backend.get_state('aggregation') is None
+    backend.set_state('aggregation', {'watermark': '2026-10-17T00:00:00+00:00'})
+    assert backend.get_state('aggregation') == {'watermark': '2026-10-17T00:00:00+00:00'}
+
+def test_sqlite_watch_polls_updated_requests(tmp_path, workload, intervals):
+    storage = SQLiteStorage(str(tmp_path / 'metrics.db'))
+    storage.put_requests(workload)
+    since = intervals[-3][0]
+    snapshots, changed = [], threading.Event()
+
+    def callback(docs, changes, read_time):
+        snapshots.append({change.document.id: (change.type.name, change.document.to_dict()) for change in changes})
+        if len(snapshots) > 1:
+            changed.set()
+
+    watch = storage.watch_requests(since, callback, poll_seconds=0.05)
+    try:
+        assert set(snapshots[0]) == {doc_id for doc_id, data in workload.items() if data['createdAt'] >= since}
+        doc_id = next(doc_id for doc_id in sorted(snapshots[0]) if workload[doc_id]['status'] == 'pending')
+        old_id = next(doc_id for doc_id, data in sorted(workload.items()) if data['createdAt'] < since)
+        newest = max(data['updatedAt'] for data in workload.values())
+        storage.put_requests({
+            doc_id: dict(workload[doc_id], status='active', updatedAt=newest + timedelta(seconds=1)),
+            old_id: dict(workload[old_id], status='closed', updatedAt=newest + timedelta(seconds=1))
+        })
+        assert changed.wait(5)
+    finally:
+        watch.unsubscribe()
+    change_type, data = snapshots[1][doc_id]
+    assert (change_type, data['status']) == ('MODIFIED', 'active')
+    assert old_id not in snapshots[1]
@@ -0,0 +1,57 @@
+"""Tests for request_archive.py against InMemoryStorage"""
+from datetime import timedelta
+
+import numpy as np
+import pytest
+
+from aggregation_pipeline import get_interval_start, run_replay
+from conftest import make_aggregator
+from metrics_storage import InMemoryStorage
+from request_archive import RequestArchive
+
+@pytest.fixture
+def archive(tmp_path, storage, intervals):
+    archive = RequestArchive(str(tmp_path / 'archive'))
+    archive.export(make_aggregator(storage), get_interval_start(intervals[0][0], 24 * 60))
+    return archive
+
+def test_export_matches_storage(archive, storage, intervals):
+    aggregator = make_aggregator(storage)
+    start_time, end_time = intervals[1][0], intervals[-2][1]
+    archived = archive.load_columns(start_time, end_time)
+    loaded = aggregator.load_request_columns(aggregator.fetch_requests_data(start_time, end_time))
+    for key in ('created', 'accepted', 'closed', 'local_hour'):
+        assert np.array_equal(np.asarray(archived[key]), loaded[key], equal_nan=True), key
+    assert aggregator.calculate_metrics_columnar(archived) == aggregator.calculate_metrics_columnar(loaded)
+
+    with pytest.raises(ValueError):
+        archive.load_columns(start_time - timedelta(days=2), end_time)
+
+def test_replay_matches_backfill(archive, storage, intervals):
+    live = make_aggregator(storage)
+    live.run_backfill_scan(intervals)
+    live.update_rollups()
+
+    replayed = InMemoryStorage()
+    results = run_replay(archive, intervals[0][0], intervals[-1][0], aggregator=make_aggregator(replayed, archive=archive))
+    assert results and all(result['success'] for result in results)
+    assert not replayed.requests
+    # The current interval is still being archived, so only documents ending before it must agree
+    def finished(target, collection):
+        return {doc_id: doc['metrics'] for doc_id, doc in target.collections[collection].items()
+                if doc['interval_end'] <= intervals[-1][0].isoformat()}
+    for collection in ('service_metrics', 'service_metrics_hourly'):
+        assert finished(replayed, collection) == finished(storage, collection), collection
+
+def test_sync_folds_in_updates(archive, storage, workload, intervals):
+    doc_id = next(doc_id for doc_id, data in sorted(workload.items()) if data['status'] == 'active')
+    data = dict(workload[doc_id], status='closed', closedAt=workload[doc_id]['acceptedAt'] + timedelta(minutes=20))
+    data['updatedAt'] = max(request['updatedAt'] for request in workload.values()) + timedelta(seconds=1)
+    storage.put_requests({doc_id: data})
+
+    aggregator = make_aggregator(storage)
+    assert archive.sync(aggregator) >= 1
+    start_time = next(start for start, end in intervals if start <= data['createdAt'] < end)
+    end_time = start_time + timedelta(minutes=15)
+    assert aggregator.calculate_metrics_columnar(archive.load_columns(start_time, end_time)) == \
+        aggregator.calculate_metrics_columnar(aggregator.load_request_columns(aggregator.fetch_requests_data(start_time, end_time)))
@@ -0,0 +1,166 @@
+"""Synthetic service request workloads for benchmarking the aggregation pipeline.
+
+Requests arrive as a Poisson process at `arrival_rate` per minute, take a
+status from `status_mix`, are assigned to one of `technician_count`
+technicians with Zipf(`technician_skew`) popularity, and are accepted and
+closed after delays drawn from the configured distributions. Each request's
+requestDetails combines a vehicle complaint with a context and an odometer
+reading, so descriptions are nearly all distinct unless `details_pool`
+limits them. Requests come from `customer_count` authors, and a
+`repeat_share` of them resubmit the description of one of the last
+REPEAT_LOOKBACK requests under its author. Output is reproducible for a
+given seed.
+
+    generator = WorkloadGenerator(arrival_rate=120, status_mix={'closed': 0.7, 'active': 0.2, 'pending': 0.1})
+    storage.put_requests(generator.generate(100000, end_time))
+"""
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+DEFAULT_STATUS_MIX = {'pending': 0.2, 'active': 0.3, 'closed': 0.5}
+DELAY_DISTRIBUTIONS = ('exponential', 'lognormal', 'fixed')
+
+# A resubmitted request repeats one of this many requests before it
+REPEAT_LOOKBACK = 50
+
+# Building blocks of the synthetic requestDetails descriptions
+DETAIL_COMPLAINTS = (
+    'Engine overheating in traffic', 'Check engine light is on', 'Engine misfires at idle', 'White smoke from exhaust',
+    'Brakes squeal when stopping', 'Brake pedal feels spongy', 'ABS warning light stays on',
+    'Battery drains overnight', 'Headlight keeps flickering', 'Power windows stopped working', 'Car not starting',
+    'Gear shifting is hard', 'Clutch slipping under load', 'Jerking while changing gear',
+    'Steering wheel vibrates at speed', 'Car pulls to the left', 'Clunk from suspension over bumps',
+    'AC not cooling properly', 'Blower makes a rattling noise', 'Heater not working',
+    'Tyre pressure warning keeps coming', 'Frequent puncture on rear tyre', 'Wheel wobbles at high speed',
+    'Mileage has dropped a lot', 'Fuel gauge shows wrong level', 'Smell of diesel in the cabin',
+    'Water leakage from sunroof', 'Rust on door edges', 'Rattle from the dashboard',
+    'Touchscreen freezes often', 'Bluetooth keeps disconnecting', 'Reverse camera shows no display',
+    'Service appointment delayed twice', 'Overcharged at the dealer', 'Spare parts not available',
+    'Strange noise when turning', 'Vehicle feels unsafe to drive'
+)
+DETAIL_CONTEXTS = (
+    'for the past week', 'after the monsoon', 'on long highway drives', 'in the mornings',
+    'after a long trip', 'right after delivery', 'when the car is fully loaded', 'on rough roads', ''
+)
+
+def parse_status_mix(spec):
+    """Parse 'pending=0.2,active=0.3,closed=0.5' into a weight dict"""
+    mix = {}
+    for part in spec.split(','):
+        status, _, weight = part.partition('=')
+        mix[status.strip()] = float(weight)
+    return mix
+
+def parse_delay(spec):
+    """Parse '<distribution>:<mean seconds>[:<sigma>]', e.g. 'exponential:300' or 'lognormal:3600:1.0'"""
+    parts = spec.split(':')
+    distribution = parts[0]
+    if distribution not in DELAY_DISTRIBUTIONS:
+        raise ValueError(f"Unknown delay distribution '{distribution}', expected one of {DELAY_DISTRIBUTIONS}")
+    mean = float(parts[1]) if len(parts) > 1 else 300.0
+    sigma = float(parts[2]) if len(parts) > 2 else 1.0
+    return distribution, mean, sigma
+
+class WorkloadGenerator:
+    """Generates request documents shaped like those written by the booking API"""
+
+    def __init__(self, arrival_rate=60.0, status_mix=None, technician_count=10, technician_skew=1.0,
+                 accept_delay=('exponential', 300.0, 1.0), close_delay=('lognormal', 3600.0, 1.0), seed=7,
+                 details_pool=None, customer_count=10000, repeat_share=0.0):
+        total = sum((status_mix or DEFAULT_STATUS_MIX).values())
+        if total <= 0:
+            raise ValueError("status_mix weights must sum to a positive value")
+        self.arrival_rate = arrival_rate
+        self.status_mix = {status: weight / total for status, weight in (status_mix or DEFAULT_STATUS_MIX).items()}
+        self.technician_count = technician_count
+        self.technician_skew = technician_skew
+        self.accept_delay = accept_delay
+        self.close_delay = close_delay
+        self.seed = seed
+        self.details_pool = details_pool
+        self.customer_count = customer_count
+        self.repeat_share = repeat_share
+
+    def sample_delays(self, rng, delay, size):
+        """Draw `size` delays in seconds; lognormal is parameterised so its mean is `delay[1]`"""
+        distribution, mean, sigma = delay
+        if distribution == 'exponential':
+            return rng.exponential(mean, size)
+        if distribution == 'lognormal':
+            return rng.lognormal(np.log(mean) - sigma ** 2 / 2, sigma, size)
+        return np.full(size, mean)
+
+    def technician_weights(self):
+        ranks = np.arange(1, self.technician_count + 1, dtype=np.float64)
+        weights = ranks ** -self.technician_skew
+        return weights / weights.sum()
+
+    def sample_details(self, rng, count):
+        """Draw `count` descriptions, from `details_pool` distinct ones when set"""
+        distinct = self.details_pool or count
+        complaints = rng.choice(len(DETAIL_COMPLAINTS), size=distinct).tolist()
+        contexts = rng.choice(len(DETAIL_CONTEXTS), size=distinct).tolist()
+        odometer = rng.integers(500, 150000, size=distinct).tolist()
+        details = [f"{DETAIL_COMPLAINTS[complaint]} {DETAIL_CONTEXTS[context]} (odometer {km} km)".replace('  ', ' ')
+                   for complaint, context, km in zip(complaints, contexts, odometer)]
+        if self.details_pool is None:
+            return details
+        return [details[index] for index in rng.choice(distinct, size=count).tolist()]
+
+    def sample_authors(self, rng, details):
+        """Draw an author per request and let `repeat_share` of them resubmit an earlier request (in place)"""
+        count = len(details)
+        authors = [f"user_{author:06d}" for author in rng.integers(self.customer_count, size=count).tolist()]
+        repeats = np.flatnonzero(rng.random(count) < self.repeat_share)
+        sources = repeats - rng.integers(1, REPEAT_LOOKBACK + 1, size=repeats.size)
+        # In arrival order, so a repeat of a repeat copies the original
+        for request, source in zip(repeats.tolist(), sources.tolist()):
+            if source >= 0:
+                details[request], authors[request] = details[source], authors[source]
+        return authors
+
+    def span(self, count):
+        """Expected time covered by `count` arrivals"""
+        return timedelta(minutes=count / self.arrival_rate)
+
+    def generate(self, count, end_time=None):
+        """Return {doc_id: request} for `count` requests whose arrivals end before `end_time` (default now, UTC)"""
+        end_time = end_time or datetime.now(timezone.utc)
+        rng = np.random.default_rng(self.seed)
+
+        gaps = rng.exponential(60.0 / self.arrival_rate, count)
+        created = np.cumsum(gaps)
+        created = end_time.timestamp() - created[-1] - 1e-3 + created if count else created
+
+        statuses = list(self.status_mix)
+        status = rng.choice(len(statuses), size=count, p=[self.status_mix[name] for name in statuses])
+        accepted = created + self.sample_delays(rng, self.accept_delay, count)
+        closed = accepted + self.sample_delays(rng, self.close_delay, count)
+        technician = rng.choice(self.technician_count, size=count, p=self.technician_weights())
+        details = self.sample_details(rng, count)
+        authors = self.sample_authors(rng, details)
+
+        def timestamp(seconds):
+            return datetime.fromtimestamp(seconds, tz=timezone.utc)
+
+        # Plain lists index much faster than NumPy scalars in the per-request loop
+        created, accepted, closed = created.tolist(), accepted.tolist(), closed.tolist()
+        status, technician = status.tolist(), technician.tolist()
+        requests = {}
+        for i in range(count):
+            status_name = statuses[status[i]]
+            assigned = status_name != 'pending'
+            last_change = closed[i] if status_name == 'closed' else accepted[i] if assigned else created[i]
+            requests[f"req_{i:08d}"] = {
+                'createdAt': timestamp(created[i]),
+                'acceptedAt': timestamp(accepted[i]) if assigned else None,
+                'closedAt': timestamp(closed[i]) if status_name == 'closed' else None,
+                'updatedAt': timestamp(min(last_change, end_time.timestamp())),
+                'status': status_name,
+                'technicianId': f"tech_{technician[i]:03d}" if assigned else None,
+                'technicianName': f"Technician {technician[i]:03d}" if assigned else None,
+                'requestDetails': details[i],
+                'authorId': authors[i]
+            }
+        return requests